@@ -0,0 +1,77 @@
+#@ File(label="Stitch_Files_In_Directories.py script") stitcher_script
+#@ File(label="folder with the tiles of a mosaic", style="directory") source
+#@ String(label="file type", value=".czi") filetype
+#@ Double(label="Regression threshold", value=0.25) reg_threshold
+
+# Register the same mosaic with the Grid/Collection stitcher and with the
+# coarse-to-fine registration of the stitching script, then compare the time
+# taken and the registered positions.
+
+import imp
+import math
+import os
+import time
+
+from imcflibs import pathtools
+
+stitcher = imp.load_source("stitch_files", str(stitcher_script))
+
+source_dir = os.path.join(str(source), "")
+filetype = filetype if filetype.startswith(".") else "." + filetype
+all_images = pathtools.listdir_matching(source_dir, filetype, fullpath=True, sort=True)
+stage_metadata = stitcher.get_stage_coords_cached(source_dir, all_images)
+geometry = stitcher.get_tile_geometry(all_images[0])
+tiles = stitcher.get_stage_tiles(all_images, stage_metadata)
+
+stitcher.write_tileconfig(
+    source_dir,
+    stage_metadata.dimensions,
+    stage_metadata.series_names,
+    stage_metadata.relative_coordinates_x,
+    stage_metadata.relative_coordinates_y,
+    stage_metadata.relative_coordinates_z,
+)
+start = time.time()
+stitcher.run_GC_stitcher(
+    source_dir, stitcher.REGISTER_ONLY, True, False, reg_threshold
+)
+gc_time = time.time() - start
+gc_tiles = stitcher.read_tileconfig(
+    os.path.join(source_dir, "TileConfiguration.registered.txt"), source_dir
+)
+
+c2f_path = os.path.join(source_dir, "TileConfiguration.coarse_to_fine.txt")
+start = time.time()
+summary = stitcher.register_coarse_to_fine(
+    tiles,
+    stitcher.get_tile_boxes(stage_metadata, geometry)[1],
+    stage_metadata.dimensions,
+    reg_threshold,
+    c2f_path,
+)
+c2f_time = time.time() - start
+c2f_tiles = stitcher.read_tileconfig(c2f_path, source_dir)
+
+
+def relative_positions(tiles):
+    """Positions relative to the first tile, as both methods anchor differently"""
+    return [
+        [tile[axis] - tiles[0][axis] for axis in ["x", "y", "z"]] for tile in tiles
+    ]
+
+
+differences = [
+    math.sqrt(sum([(a - b) ** 2 for a, b in zip(gc, c2f)]))
+    for gc, c2f in zip(relative_positions(gc_tiles), relative_positions(c2f_tiles))
+]
+
+print("tiles: %i, overlapping pairs: %i" % (len(tiles), summary["pairs"]))
+print("Grid/Collection: %.1f s" % gc_time)
+print(
+    "coarse-to-fine: %.1f s, %i links used, %i removed, %.1f MB read"
+    % (c2f_time, summary["links"], summary["removed"], summary["bytes_read"] / 1024.0**2)
+)
+print(
+    "position difference: mean %.2f px, max %.2f px"
+    % (sum(differences) / len(differences), max(differences))
+)
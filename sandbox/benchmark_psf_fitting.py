@@ -0,0 +1,102 @@
+#@ File(label="PSF Inspector.py script") psf_script
+#@ Integer(label="beads", value=20) n_beads
+#@ Double(label="noise standard deviation", value=5) noise
+
+# Fit synthetic beads of known size with the CurveFitter calls the PSF
+# Inspector has been using, without initial parameters, and with the batch
+# fitting of the script in its 1D and 3D modes, then compare the time taken
+# and the error on the FWHM.
+
+import imp
+import jarray
+import math
+import random
+import time
+
+from ij import ImagePlus, ImageStack
+from ij.measure import CurveFitter
+from ij.process import FloatProcessor
+
+psf = imp.load_source("psf_inspector", str(psf_script))
+
+xy_voxel = 100.0
+z_voxel = 200.0
+size_xy = 33
+size_z = 41
+
+random.seed(42)
+windows = []
+truth = []
+for _ in range(n_beads):
+    center = [
+        size_xy / 2 + random.uniform(-0.5, 0.5),
+        size_xy / 2 + random.uniform(-0.5, 0.5),
+        size_z / 2 + random.uniform(-0.5, 0.5),
+    ]
+    sigmas = [random.uniform(1.0, 2.0), random.uniform(1.0, 2.0), random.uniform(2, 4)]
+    stack = ImageStack(size_xy, size_xy)
+    for z in range(size_z):
+        pixels = [
+            100
+            + random.gauss(0, noise)
+            + 2000
+            * math.exp(
+                -0.5
+                * (
+                    ((x - center[0]) / sigmas[0]) ** 2
+                    + ((y - center[1]) / sigmas[1]) ** 2
+                    + ((z - center[2]) / sigmas[2]) ** 2
+                )
+            )
+            for y in range(size_xy)
+            for x in range(size_xy)
+        ]
+        stack.addSlice(FloatProcessor(size_xy, size_xy, jarray.array(pixels, "f")))
+    bead_imp = ImagePlus("bead", stack)
+    windows.append(
+        psf.get_bead_window(bead_imp, size_xy / 2, size_xy / 2, size_z / 2 + 1)
+    )
+    truth.append(
+        [
+            psf.sigma_to_fwhm * sigma * voxel
+            for sigma, voxel in zip(sigmas, [xy_voxel, xy_voxel, z_voxel])
+        ]
+    )
+
+
+def fit_current(windows):
+    """Fit each profile the way the PSF Inspector main loop has been doing"""
+    results = {"FWHM_X": [], "FWHM_Y": [], "FWHM_Z": []}
+    for window in windows:
+        for axis, key, voxel in zip(
+            "xyz", ["FWHM_X", "FWHM_Y", "FWHM_Z"], [xy_voxel, xy_voxel, z_voxel]
+        ):
+            curve_fitter = CurveFitter(*psf.get_window_profile(window, axis))
+            curve_fitter.doFit(CurveFitter.GAUSSIAN)
+            sigma = curve_fitter.getParams()[3]
+            results[key].append(psf.sigma_to_fwhm * abs(sigma) * voxel)
+    return results
+
+
+def report(name, duration, results):
+    errors = [
+        abs(results[key][i] - truth[i][axis]) / truth[i][axis]
+        for i in range(n_beads)
+        for axis, key in enumerate(["FWHM_X", "FWHM_Y", "FWHM_Z"])
+    ]
+    print(
+        "%s: %.2f s, FWHM error mean %.2f%%, max %.2f%%"
+        % (name, duration, 100 * sum(errors) / len(errors), 100 * max(errors))
+    )
+    if "flag" in results:
+        print("    flags: %s" % sorted(set(results["flag"])))
+
+
+start = time.time()
+results = fit_current(windows)
+report("CurveFitter", time.time() - start, results)
+
+for mode in ["1D", "3D"]:
+    start = time.time()
+    results = psf.fit_psfs(windows, xy_voxel, z_voxel, mode)
+    report("fit_psfs %s" % mode, time.time() - start, results)
@@ -0,0 +1,51 @@
+#@ File(label="Stitch_Files_In_Directories.py script") stitcher_script
+#@ Integer(label="wells", value=20) n_wells
+#@ Integer(label="tiles per well side", value=10) well_side
+
+# Compare the uniform grid overlap search of the stitching script with testing
+# all tile pairs, on a synthetic plate of sparse wells (2000 tiles by default).
+
+import imp
+import random
+import time
+
+stitcher = imp.load_source("stitch_files", str(stitcher_script))
+
+tile_size = (512, 512, 1)
+step = 460  # ~10% overlap
+well_spacing = 20000
+
+random.seed(42)
+positions = []
+for well in range(n_wells):
+    origin_x = (well % 5) * well_spacing
+    origin_y = (well // 5) * well_spacing
+    for tile in range(well_side**2):
+        positions.append(
+            (
+                origin_x + (tile % well_side) * step + random.uniform(-5, 5),
+                origin_y + (tile // well_side) * step + random.uniform(-5, 5),
+                0.0,
+            )
+        )
+
+start = time.time()
+pairs = stitcher.find_overlapping_tiles(positions, tile_size)
+groups = stitcher.find_connected_tiles(len(positions), pairs)
+grid_time = time.time() - start
+
+start = time.time()
+all_pairs = []
+for i in range(len(positions)):
+    for j in range(i + 1, len(positions)):
+        if all([abs(positions[i][a] - positions[j][a]) < tile_size[a] for a in range(3)]):
+            all_pairs.append((i, j))
+brute_time = time.time() - start
+
+n_possible = len(positions) * (len(positions) - 1) / 2
+print("tiles: %i" % len(positions))
+print("possible pairs: %i" % n_possible)
+print("overlapping pairs: %i (-%.2f%%)" % (len(pairs), 100.0 * (n_possible - len(pairs)) / n_possible))
+print("connected groups: %i" % len(groups))
+print("uniform grid: %.3f s, all pairs: %.3f s" % (grid_time, brute_time))
+print("same result: %s" % (pairs == all_pairs))
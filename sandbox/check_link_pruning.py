@@ -0,0 +1,48 @@
+#@ File(label="Stitch_Files_In_Directories.py script") stitcher_script
+#@ Integer(label="tiles per grid side", value=10) side
+
+# Check the removal of links by the global optimization of the coarse-to-fine
+# registration on a synthetic grid: links agreeing with each other up to a
+# sub-pixel error must all be kept, a single wrong link must be the only one
+# removed.
+
+import imp
+import random
+
+stitcher = imp.load_source("stitch_files", str(stitcher_script))
+
+step = 460.0  # ~10% overlap of 512 px tiles
+
+random.seed(42)
+true_positions = [
+    [x * step + random.uniform(-3, 3), y * step + random.uniform(-3, 3), 0.0]
+    for y in range(side)
+    for x in range(side)
+]
+initial = [[(i % side) * step, (i // side) * step, 0.0] for i in range(side**2)]
+
+links = []
+for first in range(side**2):
+    neighbours = [first + side] if first + side < side**2 else []
+    if (first + 1) % side:
+        neighbours.append(first + 1)
+    for second in neighbours:
+        shift = [
+            true_positions[second][axis]
+            - true_positions[first][axis]
+            + random.gauss(0, 0.1)
+            for axis in range(2)
+        ]
+        links.append({"pair": (first, second), "shift": shift + [0.0]})
+
+_, removed = stitcher.prune_links(initial, list(links))
+print("consistent links: %i of %i removed (expected 0)" % (removed, len(links)))
+
+wrong_links = list(links)
+wrong_link = dict(wrong_links[7], shift=[wrong_links[7]["shift"][0] + 25, 0.0, 0.0])
+wrong_links[7] = wrong_link
+_, removed = stitcher.prune_links(initial, wrong_links)
+print(
+    "one wrong link: %i removed, wrong link removed: %s (expected 1, True)"
+    % (removed, wrong_link not in wrong_links)
+)
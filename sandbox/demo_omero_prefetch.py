@@ -0,0 +1,109 @@
+#@ File(label="PSF Inspector.py script") psf_script
+#@ Integer(label="images", value=8) n_images
+#@ Double(label="download time per image (s)", value=1.0) download_time
+#@ Double(label="processing time per image (s)", value=1.0) processing_time
+#@ Integer(label="images to download ahead", value=2) depth
+#@ Double(label="memory for downloaded images (MB)", value=200) memory_mb
+
+# Run the prefetching of the PSF Inspector against a local stand-in for an
+# OMERO server, whose images take a fixed time to download, and compare it
+# with downloading each image only when it gets processed.
+
+import imp
+import threading
+import time
+
+from ij import IJ
+
+psf = imp.load_source("psf_inspector", str(psf_script))
+
+
+class FakeClient(object):
+    """Stand-in for fr.igred.omero.Client keeping track of the downloads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held_bytes = 0
+        self.max_held_bytes = 0
+
+    def downloaded(self, size):
+        with self.lock:
+            self.held_bytes += size
+            self.max_held_bytes = max(self.max_held_bytes, self.held_bytes)
+
+    def released(self, size):
+        with self.lock:
+            self.held_bytes -= size
+
+
+class FakePixels(object):
+    def getSizeX(self):
+        return 1024
+
+    def getSizeY(self):
+        return 1024
+
+    def getSizeZ(self):
+        return 25
+
+    def getSizeC(self):
+        return 2
+
+    def getSizeT(self):
+        return 1
+
+    def getPixelType(self):
+        return "uint16"
+
+
+class FakeImageWrapper(object):
+    """Stand-in for fr.igred.omero.repository.ImageWrapper"""
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+
+    def getId(self):
+        return self.image_id
+
+    def getPixels(self):
+        return FakePixels()
+
+    def toImagePlus(self, client):
+        time.sleep(download_time)
+        client.downloaded(psf.get_image_size(self))
+        return IJ.createImage("image %i" % self.image_id, "16-bit black", 64, 64, 2)
+
+    def getROIs(self, client):
+        return []
+
+
+def fetch(client, image_wpr):
+    return {
+        "imp": image_wpr.toImagePlus(client),
+        "rois": image_wpr.getROIs(client),
+        "acq_metadata": {},
+    }
+
+
+def run(depth):
+    client = FakeClient()
+    image_wrappers = [FakeImageWrapper(i) for i in range(n_images)]
+    start = time.time()
+    for image_wpr, fetched in psf.prefetch_images(
+        image_wrappers,
+        lambda image_wpr: fetch(client, image_wpr),
+        depth,
+        int(memory_mb * 1024**2),
+    ):
+        time.sleep(processing_time)
+        fetched["imp"].close()
+        client.released(psf.get_image_size(image_wpr))
+    return time.time() - start, client.max_held_bytes / 1024.0**2
+
+
+for run_depth in [0, depth]:
+    duration, max_held = run(run_depth)
+    print(
+        "%i images ahead: %.1f s, at most %.0f MB of images held"
+        % (run_depth, duration, max_held)
+    )
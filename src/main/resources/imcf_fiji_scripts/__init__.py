@@ -0,0 +1 @@
+"""Code shared by several of the IMCF Fiji scripts."""
@@ -0,0 +1,324 @@
+"""Parsing of the mosaics of a (FluoView) project, cached next to the project file.
+
+Parsing a project means reading the headers of all its tiles, which can take
+minutes. The parsed mosaics are therefore stored in a file next to the project
+and re-used as long as neither the project file nor the tiles have changed.
+"""
+
+import copy
+import hashlib
+import logging
+import pickle
+from os import listdir, remove
+from os.path import exists, getmtime, join
+
+import ij  # pylint: disable-msg=import-error
+import micrometa  # pylint: disable-msg=import-error
+from imcflibs.imagej.misc import show_progress, show_status  # pylint: disable-msg=import-error
+from java.util.concurrent import Callable, ExecutorCompletionService, Executors  # pylint: disable-msg=import-error
+
+log = logging.getLogger(__name__)
+
+# parsed mosaics are cached in a file next to the project file:
+MOSAIC_CACHE_SUFFIX = ".mosaics.pickle"
+MOSAIC_CACHE_VERSION = 2
+# only these files are tracked in the tile folders, the outputs written
+# there (e.g. when the project folder is the output folder) are ignored:
+TILE_EXTENSIONS = (".oib", ".oif", ".oir")
+
+# parsing is I/O latency bound, so more threads than CPUs could be used - but
+# micrometa hasn't been verified to be thread-safe yet, so parse sequentially:
+PARSER_THREADS = 1
+
+
+def get_file_hash(filename):
+    """Calculate the SHA-1 hash of a file's content."""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as infh:
+        for chunk in iter(lambda: infh.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_mtimes(paths):
+    """Get the modification times of the given paths, None for missing ones."""
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = getmtime(path)
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def get_folder_listings(folders):
+    """Get the (sorted) names of the tile files in the given folders."""
+    listings = {}
+    for folder in folders:
+        try:
+            listings[folder] = sorted([name for name in listdir(folder)
+                                       if name.lower().endswith(TILE_EXTENSIONS)])
+        except OSError:
+            listings[folder] = None
+    return listings
+
+
+def get_referenced_paths(mosaics):
+    """Get the tile files of all parsed mosaics and the folders holding them.
+
+    The folders are required so that adding a tile that was missing before
+    (making the mosaic being skipped) also invalidates a cached parse.
+
+    Returns
+    -------
+    tuple(list(str), list(str))
+        The tile files and the folders.
+    """
+    files = set()
+    folders = set([mosaics.infile["path"]])
+    for mosaic in mosaics:
+        for subvol in mosaic.subvol:
+            files.add(subvol.storage["full"])
+            folders.add(subvol.storage["path"])
+    return sorted(files), sorted(folders)
+
+
+class MosaicParseTask(Callable):
+    """Parse a single mosaic into its own container, to be run by an executor.
+
+    Every task creates a separate (empty) container from the project file, so
+    the tasks don't share any state (e.g. the common tile size) and the parsed
+    datasets can be merged back in the original order afterwards.
+    """
+
+    def __init__(self, mosaics, index):
+        self.container = mosaics.__class__(mosaics.infile["full"], runparser=False)
+        self.subtree = self.container.mosaictrees[index]
+        self.index = index
+
+    def call(self):
+        """Parse the mosaic, returning its index and the error (if any)."""
+        log.info("Parsing mosaic %s...", self.index + 1)
+        try:
+            self.container.add_mosaic(self.subtree, self.index)
+        except (ValueError, IOError) as err:
+            log.warn("Skipping mosaic %s: %s", self.index, err)
+            return self.index, str(err)
+        except RuntimeError as err:
+            log.warn("Error parsing mosaic %s, SKIPPING: %s", self.index, err)
+            return self.index, str(err)
+        return self.index, None
+
+
+def parse_mosaics(mosaics):
+    """Parse all mosaics of the project, skipping the ones that fail.
+
+    Parsing is dominated by reading the tile headers, so the mosaics can be
+    parsed concurrently by a pool of PARSER_THREADS threads.
+
+    Returns
+    -------
+    list(tuple(int, str))
+        The index and the reason of every skipped mosaic.
+    """
+    tasks = [MosaicParseTask(mosaics, i) for i in range(len(mosaics.mosaictrees))]
+    total = len(tasks)
+    ij.IJ.showProgress(0.0)
+    show_status("Parsed %s / %s mosaics" % (0, total))
+    errors = {}
+    pool = Executors.newFixedThreadPool(max(1, min(PARSER_THREADS, total)))
+    try:
+        completion = ExecutorCompletionService(pool)
+        for task in tasks:
+            completion.submit(task)
+        for done in range(total):
+            index, err = completion.take().get()
+            if err is not None:
+                errors[index] = err
+            show_progress(done, total)
+            show_status("Parsed %s / %s mosaics" % (done + 1, total))
+    finally:
+        pool.shutdown()
+    show_progress(total, total)
+    show_status("Parsed %i mosaics." % total)
+
+    for task in tasks:
+        mosaics.extend(task.container)
+    # some mosaic classes skip incomplete mosaics without raising an exception:
+    parsed = [mosaic.supplement["index"] for mosaic in mosaics]
+    return [(i, errors.get(i, "incomplete subvolumes"))
+            for i in range(total) if i not in parsed]
+
+
+def read_mosaic_cache(cache_file, project_hash):
+    """Read a cached mosaic parse, return None if missing or outdated."""
+    if not exists(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as infh:
+            cached = pickle.load(infh)
+    except Exception as err:  # pylint: disable-msg=broad-except
+        log.warn("Ignoring unreadable mosaic cache [%s]: %s", cache_file, err)
+        return None
+    if not isinstance(cached, dict) or \
+            cached.get("version") != MOSAIC_CACHE_VERSION or \
+            cached.get("micrometa") != micrometa.__version__:
+        log.info("Mosaic cache was written by a different version, ignoring.")
+        return None
+    if cached["project_hash"] != project_hash:
+        log.info("Project file has changed, ignoring mosaic cache.")
+        return None
+    if get_mtimes(cached["mtimes"].keys()) != cached["mtimes"] or \
+            get_folder_listings(cached["listings"].keys()) != cached["listings"]:
+        log.info("Tile files have changed, ignoring mosaic cache.")
+        return None
+    return cached
+
+
+def write_mosaic_cache(cache_file, project_hash, mosaics, skipped):
+    """Store the parsed mosaics (without their metadata parsers) in a file.
+
+    Only the dimensions of the tiles are required later on, so they are parsed
+    now and the parser objects are dropped from copies of the datasets as they
+    can't be serialized (the mosaics themselves are still in use afterwards).
+    """
+    datasets = []
+    for mosaic in mosaics:
+        mosaic_copy = copy.copy(mosaic)
+        mosaic_copy.subvol = []
+        for subvol in mosaic.subvol:
+            subvol.get_dimensions()
+            subvol_copy = copy.copy(subvol)
+            subvol_copy.parser = None
+            subvol_copy._xml = None  # pylint: disable-msg=protected-access
+            mosaic_copy.subvol.append(subvol_copy)
+        datasets.append(mosaic_copy)
+    files, folders = get_referenced_paths(mosaics)
+    cached = {
+        "version": MOSAIC_CACHE_VERSION,
+        "micrometa": micrometa.__version__,
+        "project_hash": project_hash,
+        "mtimes": get_mtimes(files),
+        "listings": get_folder_listings(folders),
+        "datasets": datasets,
+        "skipped": skipped,
+    }
+    try:
+        with open(cache_file, "wb") as outfh:
+            pickle.dump(cached, outfh, pickle.HIGHEST_PROTOCOL)
+    except (IOError, TypeError, pickle.PicklingError) as err:
+        log.warn("Unable to write mosaic cache [%s]: %s", cache_file, err)
+        if exists(cache_file):
+            remove(cache_file)
+        return
+    log.info("Wrote mosaic cache to [%s].", cache_file)
+
+
+def load_mosaics(mosaic_class, infile):
+    """Parse the mosaics of a project file, re-using a cached parse if valid.
+
+    The cache is stored next to the project file and is keyed by the hash of
+    the project file, the modification times of all referenced tiles and the
+    tile files present in the folders holding them.
+
+    Parameters
+    ----------
+    mosaic_class : class
+        The micrometa mosaic experiment class to use for the project file.
+    infile : str
+        The path to the project file.
+
+    Returns
+    -------
+    micrometa.experiment.MosaicExperiment
+    """
+    mosaics = mosaic_class(infile, runparser=False)
+    cache_file = infile + MOSAIC_CACHE_SUFFIX
+    project_hash = get_file_hash(infile)
+    cached = read_mosaic_cache(cache_file, project_hash)
+    if cached is None:
+        skipped = parse_mosaics(mosaics)
+        write_mosaic_cache(cache_file, project_hash, mosaics, skipped)
+        return mosaics
+
+    log.info("Using cached mosaics from [%s].", cache_file)
+    for index, reason in cached["skipped"]:
+        log.warn("Skipping mosaic %s (cached): %s", index, reason)
+    mosaics.extend(cached["datasets"])
+    show_status("Loaded %i mosaics from cache." % len(mosaics))
+    return mosaics
+
+
+def write_if_changed(filename, lines):
+    """Write lines to a file, unless it exists already with the same content.
+
+    Returns
+    -------
+    bool
+        True if the file has been written, False if it was up to date.
+    """
+    content = "".join(lines)
+    if exists(filename):
+        with open(filename, "r") as infh:
+            if infh.read() == content:
+                log.info("Up to date, skipping: [%s]", filename)
+                return False
+    with open(filename, "w") as out:
+        out.write(content)
+    log.info("Wrote [%s].", filename)
+    return True
+
+
+def get_tile_config_name(mosaic, padlen, suffix=""):
+    """Get the name of the tile config of a mosaic, as used by micrometa."""
+    fname = "mosaic_%0" + str(padlen) + "i%s.txt"
+    return fname % (mosaic.supplement["index"], suffix)
+
+
+def write_tile_configs(mosaics, out_dir, suffix="", force_2d=False):
+    """Write the tile configs of all mosaics, skipping the unchanged ones.
+
+    Uses the same file names and content as micrometa's write_all_tile_configs
+    but leaves configs untouched that already have the expected content.
+
+    Returns
+    -------
+    list(str), bool
+        The names of the tile configs and whether any of them was written.
+    """
+    padlen = len(str(len(mosaics)))
+    names = []
+    changed = False
+    for mosaic in mosaics:
+        fname = get_tile_config_name(mosaic, padlen, suffix)
+        config = micrometa.imagej.gen_tile_config(mosaic, suffix=suffix,
+                                                  force_2d=force_2d)
+        changed = write_if_changed(join(out_dir, fname), config) or changed
+        names.append(fname)
+    return names, changed
+
+
+def has_fused_results(out_dir, config_names, export_format):
+    """Check if the fused images of all tile configs exist in out_dir.
+
+    The file name of the fused image of a tile config is expected to start
+    with the name of the config (without its ".txt" suffix) and to end with
+    the extension given by the export format.
+
+    Parameters
+    ----------
+    out_dir : str
+        The folder with the tile configs and the results of the stitcher.
+    config_names : list(str)
+        The names of the tile configs, as returned by write_tile_configs().
+    export_format : str
+        The format option of the stitching macro, e.g. '".ids"'.
+    """
+    suffix = export_format.strip('"')
+    names = listdir(out_dir)
+    for config_name in config_names:
+        prefix = config_name[:-4]
+        if not [name for name in names
+                if name.startswith(prefix) and name.endswith(suffix)]:
+            return False
+    return True
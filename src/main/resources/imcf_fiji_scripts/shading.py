@@ -0,0 +1,259 @@
+"""Shading correction and projections of multi-channel stacks in parallel.
+
+Same results as `imcflibs.imagej.shading.process_files`, but every stack is
+read only once and several stacks are processed by a pool of threads.
+"""
+
+import logging
+from os import makedirs
+from os.path import exists
+
+import ij  # pylint: disable-msg=import-error
+from ij import ImagePlus, ImageStack  # pylint: disable-msg=import-error
+from ij.measure import Calibration  # pylint: disable-msg=import-error
+from ij.process import Blitter, FloatProcessor  # pylint: disable-msg=import-error
+from imcflibs.imagej import bioformats, misc  # pylint: disable-msg=import-error
+from imcflibs.imagej.misc import show_progress, show_status  # pylint: disable-msg=import-error
+from imcflibs.pathtools import gen_name_from_orig  # pylint: disable-msg=import-error
+from java.lang import Exception as JavaException  # pylint: disable-msg=import-error
+from java.util.concurrent import Callable, Executors  # pylint: disable-msg=import-error
+from loci.formats import ChannelSeparator, MetadataTools  # pylint: disable-msg=import-error
+from loci.plugins.util import ImageProcessorReader, LociPrefs  # pylint: disable-msg=import-error
+from ome.units import UNITS  # pylint: disable-msg=import-error
+
+log = logging.getLogger(__name__)
+
+
+def load_shading_model(model_file):
+    """Load the shading model as a FloatProcessor, None if no model is used."""
+    if model_file.upper() in ["-", "NONE"]:
+        return None
+    model = ij.IJ.openImage(model_file)
+    if model is None:
+        misc.error_exit("Opening shading model [%s] failed!" % model_file)
+    return model.getProcessor().convertToFloatProcessor()
+
+
+def get_result_tags(model, write_stack=True):
+    """Get the file name tags of the results created for every file.
+
+    Like `imcflibs.imagej.shading`, the (uncorrected) stack is not written if
+    no shading model is used, only the projections.
+    """
+    if write_stack and model is not None:
+        return ["", "-avg", "-max"]
+    return ["-avg", "-max"]
+
+
+def create_image(title, planes, n_channels, n_slices, n_frames, calibration):
+    """Assemble a (hyper-) stack from a list of planes in CZT order."""
+    stack = ImageStack(planes[0].getWidth(), planes[0].getHeight())
+    for plane in planes:
+        stack.addSlice(plane)
+    imp = ImagePlus(title, stack)
+    imp.setDimensions(n_channels, n_slices, n_frames)
+    imp.setOpenAsHyperStack(True)
+    imp.setCalibration(calibration.copy())
+    return imp
+
+
+def to_bit_depth(processor, bit_depth):
+    """Convert a corrected FloatProcessor back to the bit depth of the tile."""
+    if bit_depth == 8:
+        return processor.convertToByteProcessor(False)
+    if bit_depth == 16:
+        return processor.convertToShortProcessor(False)
+    return processor
+
+
+def correct_and_project_stack(filename, out_dir, model, fmt, write_stack=True):
+    """Apply the shading model and create the projections in a single pass.
+
+    Every plane is read once, divided by the model and added to the average
+    and maximum projections of its channel and timepoint, so neither the
+    corrected stack nor the projections have to be re-read from disk. The
+    model is only read, so it can be shared by several threads.
+
+    Parameters
+    ----------
+    filename : str
+        The full path to a multi-channel image stack.
+    out_dir : str
+        The directory for storing the results.
+    model : ij.process.FloatProcessor or None
+        The normalized shading model, None to only create the projections.
+    fmt : str
+        The file format suffix of the results, e.g. '.ics'.
+    write_stack : bool, optional
+        Whether to keep the corrected stack or only the projections. Ignored
+        if no model is given, the stack is never written then.
+
+    Returns
+    -------
+    list(tuple(str, ij.ImagePlus))
+        The target file names and the corresponding images, to be exported.
+    """
+    write_stack = "" in get_result_tags(model, write_stack)
+    meta = MetadataTools.createOMEXMLMetadata()
+    reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+    reader.setMetadataStore(meta)
+    reader.setId(filename)
+    try:
+        width, height = reader.getSizeX(), reader.getSizeY()
+        n_c, n_z, n_t = reader.getSizeC(), reader.getSizeZ(), reader.getSizeT()
+        if model is not None and (model.getWidth(), model.getHeight()) != (width, height):
+            raise ValueError("Shading model doesn't match the size of %s" % filename)
+        calibration = Calibration()
+        pixel_width = meta.getPixelsPhysicalSizeX(0)
+        pixel_depth = meta.getPixelsPhysicalSizeZ(0)
+        if pixel_width is not None:
+            calibration.pixelWidth = pixel_width.value(UNITS.MICROMETER).doubleValue()
+            calibration.pixelHeight = calibration.pixelWidth
+            calibration.setUnit("micron")
+        if pixel_depth is not None:
+            calibration.pixelDepth = pixel_depth.value(UNITS.MICROMETER).doubleValue()
+
+        # planes are read in the CZT order of ImageJ hyperstacks:
+        planes, avg_planes, max_planes = [], [], []
+        for t in range(n_t):
+            sums = [FloatProcessor(width, height) for _ in range(n_c)]
+            maxs = [None] * n_c
+            for z in range(n_z):
+                for c in range(n_c):
+                    plane = reader.openProcessors(reader.getIndex(z, c, t))[0]
+                    bit_depth = plane.getBitDepth()
+                    corrected = plane.convertToFloatProcessor()
+                    if model is not None:
+                        corrected.copyBits(model, 0, 0, Blitter.DIVIDE)
+                    sums[c].copyBits(corrected, 0, 0, Blitter.ADD)
+                    if maxs[c] is None:
+                        maxs[c] = corrected.duplicate()
+                    else:
+                        maxs[c].copyBits(corrected, 0, 0, Blitter.MAX)
+                    if write_stack:
+                        planes.append(to_bit_depth(corrected, bit_depth))
+            for c in range(n_c):
+                sums[c].multiply(1.0 / n_z)
+                avg_planes.append(sums[c])
+                max_planes.append(to_bit_depth(maxs[c], bit_depth))
+    finally:
+        reader.close()
+
+    results = []
+    if write_stack:
+        results.append((gen_name_from_orig(out_dir, filename, "", fmt),
+                        create_image("stack", planes, n_c, n_z, n_t, calibration)))
+    for tag, projection in [("-avg", avg_planes), ("-max", max_planes)]:
+        results.append((gen_name_from_orig(out_dir, filename, tag, fmt),
+                        create_image(tag, projection, n_c, 1, n_t, calibration)))
+    return results
+
+
+class ShadingTask(Callable):
+    """Correct a single file and create its projections, to be run by an executor."""
+
+    def __init__(self, filename, out_dir, model, fmt, write_stack):
+        self.args = (filename, out_dir, model, fmt, write_stack)
+
+    def call(self):
+        """Process the file, returning the results and the error (if any)."""
+        try:
+            return correct_and_project_stack(*self.args), None
+        except (Exception, JavaException) as err:  # pylint: disable-msg=broad-except
+            return None, str(err)
+
+
+def export_results(results):
+    """Save the results of a file, closing all images even if saving fails.
+
+    Returns
+    -------
+    str or None
+        The error message of the first failing export, None on success.
+    """
+    error = None
+    for target, imp in results:
+        try:
+            if error is None:
+                bioformats.export(imp, target, overwrite=True)
+        except (Exception, JavaException) as err:  # pylint: disable-msg=broad-except
+            error = str(err)
+        finally:
+            imp.close()
+    return error
+
+
+def process_files(files, out_dir, model, fmt, n_workers, write_stack=True,
+                  skip_existing=False, on_done=None):
+    """Run the shading correction and projections using a pool of threads.
+
+    Files are processed by `n_workers` threads, the results are exported by
+    the calling thread in the order of the files. At most twice as many files
+    as there are workers are held in memory. A failing file doesn't abort the
+    others.
+
+    Parameters
+    ----------
+    files : list(str)
+        The files to be processed, as a list of strings with the full path.
+    out_dir : str
+        The output folder for the results, created if missing.
+    model : ij.process.FloatProcessor or None
+        The normalized shading model, shared by all workers. If None, only the
+        projections are created.
+    fmt : str
+        The file format suffix of the results, e.g. '.ics'.
+    n_workers : int
+        The number of worker threads.
+    write_stack : bool, optional
+        Whether to save the corrected stacks or only the projections.
+    skip_existing : bool, optional
+        Whether to skip files whose results all exist already, by default any
+        existing results are overwritten.
+    on_done : callable, optional
+        Called with the name of every file once its results have been saved.
+
+    Returns
+    -------
+    list(tuple(str, str))
+        The name and the error message of every file that failed.
+    """
+    todo = files
+    if skip_existing:
+        tags = get_result_tags(model, write_stack)
+        todo = []
+        for filename in files:
+            targets = [gen_name_from_orig(out_dir, filename, tag, fmt) for tag in tags]
+            if all([exists(target) for target in targets]):
+                log.info("Found results, not re-creating them: %s", filename)
+            else:
+                todo.append(filename)
+    if not exists(out_dir):
+        makedirs(out_dir)
+
+    failed = []
+    futures = []
+    pool = Executors.newFixedThreadPool(n_workers)
+    try:
+        for i, filename in enumerate(todo):
+            while len(futures) < min(len(todo), i + 2 * n_workers):
+                futures.append(pool.submit(ShadingTask(
+                    todo[len(futures)], out_dir, model, fmt, write_stack)))
+            results, err = futures[i].get()
+            futures[i] = None  # don't keep the images of finished files
+            if err is not None:
+                log.error("Processing [%s] failed: %s", filename, err)
+                failed.append((filename, err))
+            else:
+                err = export_results(results)
+                if err is not None:
+                    log.error("Saving the results of [%s] failed: %s", filename, err)
+                    failed.append((filename, err))
+                elif on_done is not None:
+                    on_done(filename)
+            show_progress(i, len(todo))
+            show_status("Processed %s / %s files" % (i+1, len(todo)))
+    finally:
+        pool.shutdown()
+    show_progress(len(todo), len(todo))
+    return failed
@@ -0,0 +1,142 @@
+"""Running jobs in separate (headless) Fiji processes, within a RAM budget.
+
+Each job is run by a Fiji process of its own, so its memory is given back to
+the system as soon as it has finished and a failing job can't take down the
+others or the instance dispatching them.
+"""
+
+import logging
+import subprocess
+import time
+from os.path import isfile
+
+from java.lang import Exception as JavaException  # pylint: disable-msg=import-error
+from java.lang import Runtime, System  # pylint: disable-msg=import-error
+from java.lang.management import ManagementFactory  # pylint: disable-msg=import-error
+
+log = logging.getLogger(__name__)
+
+# heap used by Fiji itself, on top of the data of a worker:
+FIJI_BASE_HEAP_BYTES = 1024**3
+
+# lower limit for the heap given to a single worker process:
+MIN_WORKER_HEAP_BYTES = 2 * 1024**3
+
+
+def get_physical_memory():
+    """Get the total amount of physical memory of this machine.
+
+    Falls back to the maximum heap size of this instance if the JVM doesn't
+    expose the physical memory size.
+
+    Returns
+    -------
+    long
+        The size of the physical memory in bytes.
+    """
+    try:
+        return ManagementFactory.getOperatingSystemMXBean().getTotalPhysicalMemorySize()
+    except (AttributeError, JavaException):
+        return Runtime.getRuntime().maxMemory()
+
+
+def get_fiji_executable():
+    """Get the path to the launcher of the running Fiji instance.
+
+    Returns
+    -------
+    str or None
+        The path to the executable, None if it can't be determined.
+    """
+    for prop in ["fiji.executable", "ij.executable", "scijava.app.executable"]:
+        executable = System.getProperty(prop)
+        if executable and isfile(executable):
+            return executable
+    return None
+
+
+def get_worker_heap(footprint, ram_budget):
+    """Get the heap for a worker from the predicted footprint of its job."""
+    return min(max(footprint, MIN_WORKER_HEAP_BYTES), ram_budget)
+
+
+def start_fiji(fiji_executable, heap_bytes, args, log_path):
+    """Launch a headless Fiji process, its output being written to a file.
+
+    Parameters
+    ----------
+    fiji_executable : str
+        The path to the Fiji launcher.
+    heap_bytes : long
+        The maximum heap size of the process.
+    args : list(str)
+        The arguments telling Fiji what to run, e.g. ["-batch", macro_path].
+    log_path : str
+        The file to which the output of the process will be written.
+
+    Returns
+    -------
+    tuple(subprocess.Popen, file)
+        The process and the handle to its log file.
+    """
+    command = [
+        fiji_executable,
+        "--mem=%im" % (heap_bytes / 1024**2),
+        "--headless",
+        "--console",
+    ] + args
+    log_handle = open(log_path, "w")
+    process = subprocess.Popen(command, stdout=log_handle, stderr=subprocess.STDOUT)
+    return process, log_handle
+
+
+def run_workers(jobs, n_workers, ram_budget, start, on_finished, poll_interval=2.0):
+    """Run jobs in worker processes, limited by their number and by the RAM.
+
+    Jobs are dispatched in the given order as long as less than `n_workers`
+    are running and the sum of their heaps stays within the RAM budget. A job
+    larger than the budget is only started when no other one is running.
+
+    Parameters
+    ----------
+    jobs : list(dict)
+        The jobs to run, each one having its heap in bytes stored as "heap".
+        The process, its start time and its duration are added to the dicts.
+    n_workers : int
+        The maximum number of concurrent worker processes.
+    ram_budget : long
+        The RAM available for all workers together, in bytes.
+    start : callable
+        Called with a job to launch its process, has to return the process
+        and the handle to its log file (e.g. the result of `start_fiji`).
+    on_finished : callable
+        Called with a job and the exit code as soon as its process has ended.
+    poll_interval : float, optional
+        The time in seconds between checks of the running processes.
+    """
+    pending = list(jobs)
+    running = []
+    while pending or running:
+        for job in running[:]:
+            exit_code = job["process"].poll()
+            if exit_code is None:
+                continue
+            job["log_handle"].close()
+            job["duration"] = time.time() - job["start_time"]
+            running.remove(job)
+            on_finished(job, exit_code)
+
+        reserved = sum([job["heap"] for job in running])
+        for job in pending[:]:
+            if len(running) >= n_workers:
+                break
+            if running and reserved + job["heap"] > ram_budget:
+                continue
+            job["start_time"] = time.time()
+            job["process"], job["log_handle"] = start(job)
+            pending.remove(job)
+            running.append(job)
+            reserved += job["heap"]
+
+        if pending or running:
+            time.sleep(poll_interval)
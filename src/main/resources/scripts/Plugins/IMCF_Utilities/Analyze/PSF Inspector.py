@@ -4,7 +4,11 @@
 # @ Integer(label="Reference channel for shift calculation", value=1) ref_chnl
 # @ File(label="Temp path for storage", style="directory", description="Script need to store temp image") destination
 # @ Boolean(label="Delete previous kv pairs", value=False) delete_previous_kv
-# @ RoiManager rm
+# @ Boolean(label="Analyse all beads", description="Detect every bead inside the ROIs instead of only the brightest one", value=False) all_beads
+# @ String(label="Gaussian fit", choices={"1D", "3D"}, description="Fit the X, Y and Z profiles separately or the whole bead in 3D", style="radioButtonHorizontal", value="1D") fit_mode
+# @ Integer(label="Images to download ahead", description="Images fetched from OMERO while the current one is processed", value=1) prefetch_depth
+# @ Double(label="Memory for downloaded images (GB)", value=4) prefetch_memory_gb
+# @ Boolean(label="Batch mode", description="Never display images, images without ROIs on OMERO get skipped", value=False) batch_mode
 
 # ─── IMPORTS ────────────────────────────────────────────────────────────────────
 
@@ -12,15 +16,16 @@ import math
 import os
 import re
 import sys
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import date
 
 import sjlogging
 from fr.igred.omero.roi import ROIWrapper
-from ij import IJ
+from ij import IJ, ImageStack
 from ij import WindowManager as wm
 from ij.gui import Line, Overlay, Plot, Roi, TextRoi, WaitForUserDialog
-from ij.measure import CurveFitter
+from ij.macro import Interpreter
+from ij.measure import CurveFitter, Minimizer
 from ij.plugin import (
     Concatenator,
     Duplicator,
@@ -28,6 +33,7 @@ from ij.plugin import (
     ImagesToStack,
     ZProjector,
 )
+from ij.plugin.filter import MaximumFinder
 from ij.plugin.frame import RoiManager
 from imcflibs.imagej import bioformats as bf
 from imcflibs.imagej import misc, omerotools
@@ -36,6 +42,7 @@ from java.awt import Color, Font
 # java imports
 from java.lang import Double, Long, String
 from java.util import ArrayList
+from java.util.concurrent import Callable, ExecutionException, Executors
 from java.text import SimpleDateFormat
 
 from loci.plugins import BF, LociExporter
@@ -55,11 +62,6 @@ from omero.cmd import OriginalMetadataRequest
 from omero.gateway.exception import DSAccessException
 # ─── FUNCTIONS ──────────────────────────────────────────────────────────────────
 
-def BFImport(indivFile):
-    """Import the file using BioFormats
-
-# ─── FUNCTIONS ──────────────────────────────────────────────────────────────────
-
 
 def coord_brightest_point(input_imp, selected_roi, best_slice):
     """Get the brightest spot coordinates in an image
@@ -120,33 +122,246 @@ def scan_for_best_slice(input_imp, selected_roi):
         Different stats for the stack
     """
 
-    best_slice = 0
-    max_stack = 0
-    min_stack = 65500
-    # max_int    = 0
+    return scan_rois_through_stack(input_imp, [selected_roi])[0]
 
-    input_imp.setRoi(selected_roi)
-    input_imp_dup = Duplicator().run(input_imp, 1, 1, 1, input_imp.getNSlices(), 1, 1)
-    input_imp_dup.setCalibration(input_imp.getCalibration())
 
-    for slice in range(1, input_imp_dup.getNSlices() + 1):
-        input_imp_dup.setSlice(slice)
-        slice_stats = input_imp_dup.getStatistics()
-        # pixel_value = input_imp.getPixel(bright_spot['X_coord'], bright_spot['Y_coord'])[0]
-        if slice_stats.max > max_stack:
-            # max_int    = pixel_value
-            max_stack = slice_stats.max
-            min_stack = slice_stats.min
-            best_slice = slice
-
-    stack_stats = {
-        "max_stack": max_stack,
-        "min_stack": min_stack,
-        "best_slice": best_slice,
-    }
+def get_roi_indices(roi, width, height):
+    """Get the indices of the pixels of a ROI in the pixel array of a plane
 
-    input_imp_dup.close()
-    return stack_stats
+    Parameters
+    ----------
+    roi : ij.gui.Roi
+        ROI of which to get the pixels
+    width : int
+        Width of the plane
+    height : int
+        Height of the plane
+
+    Returns
+    -------
+    list(int)
+        Indices of the pixels inside the ROI and the plane
+    """
+    return [
+        point.y * width + point.x
+        for point in roi.getContainedPoints()
+        if 0 <= point.x < width and 0 <= point.y < height
+    ]
+
+
+def scan_rois_through_stack(input_imp, rois, channel=1):
+    """Find the slice and value of the spots of several ROIs through a stack
+
+    The stack is read in place, plane by plane, measuring all the ROIs on each
+    plane before moving to the next one. The pixel arrays of the planes are
+    read directly, only the indices of the pixels of each ROI are computed
+    once beforehand.
+
+    Parameters
+    ----------
+    input_imp : ij.ImagePlus
+        ImagePlus on which to do measurements
+    rois : list(ij.gui.Roi)
+        ROIs where to look for the best slice
+    channel : int, optional
+        Channel to scan, by default 1
+
+    Returns
+    -------
+    list(dict)
+        Stats for each ROI, in the same order, with the "max_stack" and
+        "min_stack" of the best slice and the "best_slice" itself
+    """
+    width, height = input_imp.getWidth(), input_imp.getHeight()
+    roi_indices = [get_roi_indices(roi, width, height) for roi in rois]
+    # 8 and 16 bit pixels are stored in signed Java types
+    mask = {8: 0xFF, 16: 0xFFFF}.get(input_imp.getBitDepth())
+    scans = [{"max_stack": 0, "min_stack": 65500, "best_slice": 0} for _ in rois]
+
+    stack = input_imp.getStack()
+    for slice in range(1, input_imp.getNSlices() + 1):
+        pixels = stack.getPixels(input_imp.getStackIndex(channel, slice, 1))
+        for indices, scan in zip(roi_indices, scans):
+            if not indices:
+                continue
+            if mask:
+                values = [pixels[i] & mask for i in indices]
+            else:
+                values = [pixels[i] for i in indices]
+            slice_max = max(values)
+            if slice_max > scan["max_stack"]:
+                scan["max_stack"] = slice_max
+                scan["min_stack"] = min(values)
+                scan["best_slice"] = slice
+
+    return scans
+
+
+def estimate_noise(planes, n_samples=100000):
+    """Estimate the background level and noise of a stack
+
+    Uses the median and the median absolute deviation (MAD) of a regular
+    sample of the pixels, which are not affected by the few bright beads.
+
+    Parameters
+    ----------
+    planes : list(ij.process.ImageProcessor)
+        Planes of the stack
+    n_samples : int, optional
+        Approximate number of pixels to sample, by default 100000
+
+    Returns
+    -------
+    tuple of (float, float)
+        Median and MAD of the sampled pixels
+    """
+    n_pixels = planes[0].getPixelCount()
+    step = max(1, (n_pixels * len(planes)) // n_samples)
+    samples = []
+    for plane in planes:
+        samples.extend([plane.getf(i) for i in xrange(0, n_pixels, step)])
+
+    samples.sort()
+    median = samples[len(samples) // 2]
+    deviations = sorted([abs(value - median) for value in samples])
+    mad = deviations[len(deviations) // 2]
+
+    return median, mad
+
+
+def find_beads(imp, channel, noise_factor, xy_distance, z_distance):
+    """Find all the beads of a channel as 3D local maxima
+
+    The stack is scanned once, collecting the 2D maxima of every plane which
+    are above the noise-adaptive threshold (median + noise_factor * sigma,
+    sigma being estimated from the MAD). Candidates are then kept from the
+    brightest to the dimmest, dropping any candidate closer than the given
+    distances to an already kept one, leaving the 3D local maxima.
+
+    Parameters
+    ----------
+    imp : ij.ImagePlus
+        ImagePlus in which to find the beads
+    channel : int
+        Channel to use, 1-based
+    noise_factor : float
+        Number of noise standard deviations above the background for a
+        maximum to be considered as a bead
+    xy_distance : int
+        Minimal distance in pixels between two beads in X and Y
+    z_distance : int
+        Minimal distance in slices between two beads in Z
+
+    Returns
+    -------
+    list(dict)
+        Beads sorted by decreasing intensity, each with its "X_coord",
+        "Y_coord", "best_slice" (1-based) and "value"
+    """
+    stack = imp.getStack()
+    planes = [
+        stack.getProcessor(imp.getStackIndex(channel, z, 1))
+        for z in range(1, imp.getNSlices() + 1)
+    ]
+    median, mad = estimate_noise(planes)
+    prominence = noise_factor * 1.4826 * max(mad, 1)
+    threshold = median + prominence
+
+    candidates = []
+    finder = MaximumFinder()
+    for z, plane in enumerate(planes):
+        maxima = finder.getMaxima(plane, prominence, True)
+        for i in range(maxima.npoints):
+            value = plane.getf(maxima.xpoints[i], maxima.ypoints[i])
+            if value > threshold:
+                candidates.append(
+                    {
+                        "X_coord": maxima.xpoints[i],
+                        "Y_coord": maxima.ypoints[i],
+                        "best_slice": z + 1,
+                        "value": value,
+                    }
+                )
+
+    candidates.sort(key=lambda bead: bead["value"], reverse=True)
+    beads = []
+    for candidate in candidates:
+        if not [
+            bead
+            for bead in beads
+            if abs(bead["X_coord"] - candidate["X_coord"]) <= xy_distance
+            and abs(bead["Y_coord"] - candidate["Y_coord"]) <= xy_distance
+            and abs(bead["best_slice"] - candidate["best_slice"]) <= z_distance
+        ]:
+            beads.append(candidate)
+
+    return beads
+
+
+def find_nearest_bead(beads, reference, max_distance):
+    """Find the bead closest to a reference position
+
+    Parameters
+    ----------
+    beads : list(dict)
+        Beads as returned by find_beads
+    reference : dict
+        Bead to look for
+    max_distance : float
+        Maximal distance in pixels in X and Y for a bead to be matched
+
+    Returns
+    -------
+    dict
+        Closest bead or None if none is close enough
+    """
+    nearest = None
+    nearest_distance = max_distance
+    for bead in beads:
+        distance = math.hypot(
+            bead["X_coord"] - reference["X_coord"],
+            bead["Y_coord"] - reference["Y_coord"],
+        )
+        if distance <= nearest_distance:
+            nearest = bead
+            nearest_distance = distance
+    return nearest
+
+
+def get_bead_regions(beads, rois, ROI_size):
+    """Create one square ROI around each bead found inside the given ROIs
+
+    Parameters
+    ----------
+    beads : list(dict)
+        Beads as returned by find_beads
+    rois : list(ij.gui.Roi)
+        ROIs in which to keep the beads
+    ROI_size : int
+        Size in pixels of the ROIs to create
+
+    Returns
+    -------
+    tuple of (list(ij.gui.Roi), list(dict))
+        ROIs centered on the beads and the matching beads
+    """
+    regions = []
+    region_beads = []
+    for roi in rois:
+        roi_beads = [
+            bead for bead in beads if roi.contains(bead["X_coord"], bead["Y_coord"])
+        ]
+        for bead_index, bead in enumerate(roi_beads):
+            region = Roi(
+                bead["X_coord"] - ROI_size / 2,
+                bead["Y_coord"] - ROI_size / 2,
+                ROI_size,
+                ROI_size,
+            )
+            region.setName(str(roi.getName()) + "_bead" + str(bead_index + 1))
+            regions.append(region)
+            region_beads.append(bead)
+    return regions, region_beads
 
 
 def parse_url(omero_str):
@@ -367,6 +582,131 @@ def get_info_from_original_metadata(user_client, image_id, field):
     return gm.get(field).getValue()
 
 
+def fetch_image(user_client, image_wpr):
+    """Download an image from OMERO with its ROIs and acquisition metadata
+
+    Parameters
+    ----------
+    user_client : fr.igred.omero.Client
+        Client used for login to OMERO
+    image_wpr : fr.igred.omero.repositor.ImageWrapper
+        Wrapper to the image to download
+
+    Returns
+    -------
+    dict
+        The "imp" (ij.ImagePlus), its "rois" (list of ij.gui.Roi) and the
+        "acq_metadata" (dict) of the image
+    """
+    return {
+        "imp": image_wpr.toImagePlus(user_client),
+        "rois": ROIWrapper.toImageJ(image_wpr.getROIs(user_client)),
+        "acq_metadata": omerotools.get_acquisition_metadata(user_client, image_wpr),
+    }
+
+
+def get_image_size(image_wpr):
+    """Get the size of an OMERO image once downloaded
+
+    Parameters
+    ----------
+    image_wpr : fr.igred.omero.repositor.ImageWrapper
+        Wrapper to the image
+
+    Returns
+    -------
+    int
+        Size of the pixels of the image in bytes
+    """
+    pixels = image_wpr.getPixels()
+    bytes_per_pixel = {"int8": 1, "uint8": 1, "int16": 2, "uint16": 2, "double": 8}
+    return (
+        pixels.getSizeX()
+        * pixels.getSizeY()
+        * pixels.getSizeZ()
+        * pixels.getSizeC()
+        * pixels.getSizeT()
+        * bytes_per_pixel.get(pixels.getPixelType(), 4)
+    )
+
+
+class FetchTask(Callable):
+    """Callable fetching one image, to be run on a background thread"""
+
+    def __init__(self, fetch, image_wpr):
+        self.fetch = fetch
+        self.image_wpr = image_wpr
+
+    def call(self):
+        return self.fetch(self.image_wpr)
+
+
+def prefetch_images(image_wrappers, fetch, depth=1, max_bytes=None, get_size=None):
+    """Fetch images on a background thread ahead of their processing
+
+    The next images are downloaded one after the other while the current one
+    is being processed, without going further than depth images ahead and
+    without holding more than max_bytes, the current image included. An image
+    bigger than that is still fetched, but only once the previous ones have
+    been processed.
+
+    Parameters
+    ----------
+    image_wrappers : list
+        Images to fetch, in the order they are processed
+    fetch : callable
+        Function fetching one image, e.g. fetch_image bound to a client
+    depth : int, optional
+        How many images to fetch ahead of the current one, 0 fetching them
+        only when needed, by default 1
+    max_bytes : int, optional
+        Maximal size of the fetched images, including the current one, by
+        default None (no limit)
+    get_size : callable, optional
+        Function giving the size in bytes of an image before fetching it, by
+        default get_image_size
+
+    Yields
+    ------
+    tuple
+        Each image with what fetch returned for it or None if it failed
+    """
+    get_size = get_size or get_image_size
+    executor = Executors.newSingleThreadExecutor()
+    pending = deque()
+    pending_bytes = 0
+    next_index = 0
+
+    try:
+        while pending or next_index < len(image_wrappers):
+            while next_index < len(image_wrappers) and len(pending) <= depth:
+                image_wpr = image_wrappers[next_index]
+                size = get_size(image_wpr) if max_bytes else 0
+                if pending and max_bytes and pending_bytes + size > max_bytes:
+                    break
+                future = executor.submit(FetchTask(fetch, image_wpr))
+                pending.append((image_wpr, future, size))
+                pending_bytes += size
+                next_index += 1
+
+            image_wpr, future, size = pending.popleft()
+            try:
+                fetched = future.get()
+            except ExecutionException as err:
+                IJ.log(
+                    "Fetching image %s failed: %s" % (image_wpr.getId(), err.getCause())
+                )
+                fetched = None
+            future = None
+            yield image_wpr, fetched
+            # the image must not be referenced from here any more once its
+            # memory is given to the next ones
+            fetched = None
+            pending_bytes -= size
+    finally:
+        executor.shutdownNow()
+
+
 def duplicate_imp_and_calibrate(
     imp, specific_chnl=None, specific_z=None, specific_t=None, roi=None
 ):
@@ -463,12 +803,18 @@ def reslice_based_on_roi(
         + " slice_count=1"
         + (" rotate" if do_y else "")
     )
-    IJ.run(
-        imp,
-        "Reslice [/]...",
-        "output=" + output,
-    )
-    imp_proj = IJ.getImage()
+    # run the command in batch mode so the reslice doesn't get displayed
+    previous_batch_mode = Interpreter.batchMode
+    Interpreter.batchMode = True
+    try:
+        IJ.run(
+            imp,
+            "Reslice [/]...",
+            "output=" + output,
+        )
+        imp_proj = wm.getCurrentImage()
+    finally:
+        Interpreter.batchMode = previous_batch_mode
     if do_y:
         imp_proj.setTitle("Y_Proj")
     else:
@@ -480,6 +826,558 @@ def reslice_based_on_roi(
     return imp_proj
 
 
+def center_stack_on_slice(imp, best_slice, max_z):
+    """Crop and pad a stack in Z so it is centered on a given slice
+
+    The stack is rebuilt in one go from the existing planes: it ends half of
+    max_z slices after best_slice and holds max_z slices, missing slices
+    being filled with black. Padding needed at the start is inserted after
+    the first slice, the same way adding slices to the first one did before.
+
+    Parameters
+    ----------
+    imp : ij.ImagePlus
+        ImagePlus to center, its stack is replaced
+    best_slice : int
+        Slice on which to center the stack, 1-based
+    max_z : int
+        Number of slices of the centered stack
+    """
+    stack = imp.getStack()
+    width = stack.getWidth()
+    height = stack.getHeight()
+    last_slice = best_slice + max_z / 2
+
+    def blank_planes(count):
+        return [
+            (None, stack.getProcessor(1).createProcessor(width, height).getPixels())
+            for _ in range(count)
+        ]
+
+    planes = [
+        (stack.getSliceLabel(i), stack.getPixels(i))
+        for i in range(1, min(stack.getSize(), last_slice) + 1)
+    ]
+    planes.extend(blank_planes(last_slice - len(planes)))
+    planes = planes[-max_z:]
+    planes[1:1] = blank_planes(max_z - len(planes))
+
+    centered_stack = ImageStack(width, height)
+    for label, pixels in planes:
+        centered_stack.addSlice(label, pixels)
+    imp.setStack(centered_stack)
+
+
+def get_bead_window(imp, x_coord, y_coord, best_slice, half_xy=8, half_z=20, channel=1):
+    """Read the voxels around a bead
+
+    Parameters
+    ----------
+    imp : ij.ImagePlus
+        ImagePlus containing the bead
+    x_coord : int
+        X coordinate of the bead
+    y_coord : int
+        Y coordinate of the bead
+    best_slice : int
+        Slice of the bead, 1-based
+    half_xy : int, optional
+        Half size of the window in X and Y, by default 8
+    half_z : int, optional
+        Half size of the window in Z, by default 20
+    channel : int, optional
+        Channel to read, by default 1
+
+    Returns
+    -------
+    dict of {str: list}
+        Offsets of the voxels from the bead in "x", "y" and "z" with their
+        "values", voxels outside of the image are left out
+    """
+    stack = imp.getStack()
+    window = {"x": [], "y": [], "z": [], "values": []}
+    for dz in range(-half_z, half_z + 1):
+        if not 1 <= best_slice + dz <= imp.getNSlices():
+            continue
+        plane = stack.getProcessor(imp.getStackIndex(channel, best_slice + dz, 1))
+        for dy in range(-half_xy, half_xy + 1):
+            if not 0 <= y_coord + dy < plane.getHeight():
+                continue
+            for dx in range(-half_xy, half_xy + 1):
+                if not 0 <= x_coord + dx < plane.getWidth():
+                    continue
+                window["x"].append(dx)
+                window["y"].append(dy)
+                window["z"].append(dz)
+                window["values"].append(plane.getf(x_coord + dx, y_coord + dy))
+    return window
+
+
+def get_window_profile(window, axis):
+    """Get the profile of a bead window along one axis through its center
+
+    Parameters
+    ----------
+    window : dict
+        Window as returned by get_bead_window
+    axis : str
+        Axis of the profile, "x", "y" or "z"
+
+    Returns
+    -------
+    tuple of (list(int), list(float))
+        Positions and values of the profile
+    """
+    others = [other for other in ["x", "y", "z"] if other != axis]
+    profile = sorted(
+        [
+            (window[axis][i], window["values"][i])
+            for i in range(len(window["values"]))
+            if window[others[0]][i] == 0 and window[others[1]][i] == 0
+        ]
+    )
+    return [position for position, _ in profile], [value for _, value in profile]
+
+
+def gaussian_moments(x, y):
+    """Estimate the parameters of a Gaussian profile from its moments
+
+    The offset and peak come from the extrema, the center and sigma from the
+    first and second moments of the part of the profile above half maximum,
+    which keeps the background noise out of the estimate.
+
+    Parameters
+    ----------
+    x : list(float)
+        Positions of the profile
+    y : list(float)
+        Values of the profile
+
+    Returns
+    -------
+    list(float)
+        Offset, peak, center and sigma, in the order used by CurveFitter
+    """
+    offset = min(y)
+    peak = max(y)
+    half_max = offset + (peak - offset) / 2.0
+    weights = [max(value - half_max, 0) for value in y]
+    total = sum(weights)
+    if not total:
+        return [offset, peak, x[y.index(peak)], 1.0]
+
+    center = sum([w * pos for w, pos in zip(weights, x)]) / total
+    variance = sum([w * (pos - center) ** 2 for w, pos in zip(weights, x)]) / total
+    sigma = max(math.sqrt(variance) * top_half_to_sigma, abs(x[1] - x[0]) / 2.0)
+
+    return [offset, peak, center, sigma]
+
+
+def fit_gaussian_1d(x, y):
+    """Fit a Gaussian to a profile, starting from its moments
+
+    Parameters
+    ----------
+    x : list(float)
+        Positions of the profile
+    y : list(float)
+        Values of the profile
+
+    Returns
+    -------
+    dict
+        Fitted "params" (offset, peak, center, sigma), "residual" as the RMS
+        of the residuals relative to the amplitude and "converged"
+    """
+    curve_fitter = CurveFitter(x, y)
+    curve_fitter.setInitialParameters(gaussian_moments(x, y))
+    curve_fitter.doFit(CurveFitter.GAUSSIAN)
+    params = list(curve_fitter.getParams())[:4]
+    amplitude = abs(params[1] - params[0]) or 1
+
+    return {
+        "params": params,
+        "residual": math.sqrt(curve_fitter.getSSE() / len(x)) / amplitude,
+        "converged": curve_fitter.getStatus() == Minimizer.SUCCESS,
+    }
+
+
+def invert_matrix(matrix):
+    """Invert a square matrix using Gauss-Jordan elimination
+
+    Parameters
+    ----------
+    matrix : list(list(float))
+        Matrix to invert
+
+    Returns
+    -------
+    list(list(float))
+        Inverse of the matrix
+
+    Raises
+    ------
+    ValueError
+        If the matrix is singular
+    """
+    size = len(matrix)
+    rows = [
+        list(row) + [1.0 if i == j else 0.0 for j in range(size)]
+        for i, row in enumerate(matrix)
+    ]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(rows[row][col]))
+        if abs(rows[pivot][col]) < 1e-300:
+            raise ValueError("singular matrix")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        pivot_value = rows[col][col]
+        rows[col] = [value / pivot_value for value in rows[col]]
+        for row in range(size):
+            factor = rows[row][col]
+            if row != col and factor:
+                rows[row] = [a - factor * b for a, b in zip(rows[row], rows[col])]
+    return [row[size:] for row in rows]
+
+
+def evaluate_gaussian_3d(params, points):
+    """Evaluate a 3D Gaussian and its derivatives on a list of points
+
+    Parameters
+    ----------
+    params : list(float)
+        Offset, amplitude, X, Y and Z centers and X, Y and Z sigmas
+    points : list(tuple)
+        X, Y and Z positions where to evaluate the Gaussian
+
+    Returns
+    -------
+    tuple of (list(float), list(list(float)))
+        Values of the Gaussian and derivatives against each parameter
+    """
+    _, amplitude, x0, y0, z0, sx, sy, sz = params
+    model = []
+    jacobian = []
+    for x, y, z in points:
+        dx = (x - x0) / sx
+        dy = (y - y0) / sy
+        dz = (z - z0) / sz
+        gauss = math.exp(-0.5 * (dx * dx + dy * dy + dz * dz))
+        scaled = amplitude * gauss
+        model.append(params[0] + scaled)
+        jacobian.append(
+            [
+                1.0,
+                gauss,
+                scaled * dx / sx,
+                scaled * dy / sy,
+                scaled * dz / sz,
+                scaled * dx * dx / sx,
+                scaled * dy * dy / sy,
+                scaled * dz * dz / sz,
+            ]
+        )
+    return model, jacobian
+
+
+def normal_equations(jacobian, residuals):
+    """Build the normal equations of a least squares problem
+
+    Parameters
+    ----------
+    jacobian : list(list(float))
+        Derivatives of the model against each parameter, for each value
+    residuals : list(float)
+        Differences between the measured values and the model
+
+    Returns
+    -------
+    tuple of (list(list(float)), list(float))
+        The products of the transposed jacobian with the jacobian and with
+        the residuals
+    """
+    n_params = len(jacobian[0])
+    jtj = [[0.0] * n_params for _ in range(n_params)]
+    jtr = [0.0] * n_params
+    for row, residual in zip(jacobian, residuals):
+        for i in range(n_params):
+            jtr[i] += row[i] * residual
+            for j in range(i, n_params):
+                jtj[i][j] += row[i] * row[j]
+    for i in range(n_params):
+        for j in range(i):
+            jtj[i][j] = jtj[j][i]
+    return jtj, jtr
+
+
+def levenberg_marquardt(evaluate, params, values, max_iterations=100, tolerance=1e-8):
+    """Least squares fit of a model using the Levenberg-Marquardt algorithm
+
+    Parameters
+    ----------
+    evaluate : callable
+        Function returning the model values and their derivatives against
+        each parameter for a list of parameters
+    params : list(float)
+        Initial parameters
+    values : list(float)
+        Measured values to fit
+    max_iterations : int, optional
+        Maximal number of iterations, by default 100
+    tolerance : float, optional
+        Relative decrease of the sum of squares under which the fit is
+        considered converged, by default 1e-8
+
+    Returns
+    -------
+    dict
+        Fitted "params", their "covariance" (None if it cannot be computed),
+        the "sse" (sum of squared residuals) and "converged"
+    """
+    n_params = len(params)
+    model, jacobian = evaluate(params)
+    residuals = [value - fit for value, fit in zip(values, model)]
+    sse = sum([r * r for r in residuals])
+    damping = 1e-3
+    converged = False
+
+    for _ in range(max_iterations):
+        jtj, jtr = normal_equations(jacobian, residuals)
+
+        improved = False
+        while damping < 1e10:
+            damped = [
+                [
+                    jtj[i][j] * (1 + damping) if i == j else jtj[i][j]
+                    for j in range(n_params)
+                ]
+                for i in range(n_params)
+            ]
+            try:
+                inverse = invert_matrix(damped)
+            except ValueError:
+                damping *= 10
+                continue
+            trial = [
+                params[i] + sum([inverse[i][j] * jtr[j] for j in range(n_params)])
+                for i in range(n_params)
+            ]
+            trial_model, trial_jacobian = evaluate(trial)
+            trial_residuals = [value - fit for value, fit in zip(values, trial_model)]
+            trial_sse = sum([r * r for r in trial_residuals])
+            if trial_sse < sse:
+                improved = True
+                break
+            damping *= 10
+
+        if not improved:
+            converged = True
+            break
+        decrease = sse - trial_sse
+        params, jacobian, residuals = trial, trial_jacobian, trial_residuals
+        sse = trial_sse
+        damping /= 10
+        if decrease <= tolerance * sse:
+            converged = True
+            break
+
+    # the covariance needs the derivatives at the final parameters
+    jtj, _ = normal_equations(jacobian, residuals)
+    try:
+        scale = sse / max(len(values) - n_params, 1)
+        covariance = [[value * scale for value in row] for row in invert_matrix(jtj)]
+    except ValueError:
+        covariance = None
+
+    return {
+        "params": params,
+        "covariance": covariance,
+        "sse": sse,
+        "converged": converged,
+    }
+
+
+def fit_gaussian_3d(window):
+    """Fit a 3D Gaussian to a bead window
+
+    The initial parameters come from the moments of the profiles through the
+    center of the window, which also limit the fit to the voxels within three
+    sigmas of the bead.
+
+    Parameters
+    ----------
+    window : dict
+        Window as returned by get_bead_window
+
+    Returns
+    -------
+    dict
+        Fitted "params" (offset, amplitude, X, Y and Z centers, X, Y and Z
+        sigmas), their "covariance", "residual" as the RMS of the residuals
+        relative to the amplitude and "converged"
+    """
+    moments = [gaussian_moments(*get_window_profile(window, axis)) for axis in "xyz"]
+    offset = min(window["values"])
+    params = [offset, max(window["values"]) - offset]
+    params.extend([axis_moments[2] for axis_moments in moments])
+    params.extend([axis_moments[3] for axis_moments in moments])
+
+    limits = [max(3 * axis_moments[3], 2) for axis_moments in moments]
+    points = []
+    values = []
+    for i, value in enumerate(window["values"]):
+        position = (window["x"][i], window["y"][i], window["z"][i])
+        if all([abs(position[a] - params[2 + a]) <= limits[a] for a in range(3)]):
+            points.append(position)
+            values.append(value)
+
+    fit = levenberg_marquardt(
+        lambda trial: evaluate_gaussian_3d(trial, points), params, values
+    )
+    fit["residual"] = math.sqrt(fit["sse"] / len(values)) / (abs(fit["params"][1]) or 1)
+    return fit
+
+
+def fit_psfs(windows, xy_voxel, z_voxel, mode="1D"):
+    """Fit the PSF of a batch of beads and measure their FWHM
+
+    Parameters
+    ----------
+    windows : list(dict)
+        Windows around the beads, as returned by get_bead_window, they can
+        come from any image and channel
+    xy_voxel : float
+        Pixel size in X and Y
+    z_voxel : float
+        Voxel size in Z
+    mode : str, optional
+        "1D" to fit the profiles through the center of the beads along each
+        axis separately or "3D" to fit a 3D Gaussian, by default "1D"
+
+    Returns
+    -------
+    dict of {str: list}
+        For each bead, in the same order, the "FWHM_X", "FWHM_Y" and "FWHM_Z"
+        in the unit of the voxel sizes, the "residual" of the fit relative to
+        its amplitude, the "covariance" of the parameters (3D mode only,
+        None otherwise), a "flag" being "ok", "not converged" or
+        "out of window" and the "profiles" of the fit through the center of
+        the window along X, Y and Z, as offset, peak, center and sigma in
+        voxels
+    """
+    results = {
+        "FWHM_X": [],
+        "FWHM_Y": [],
+        "FWHM_Z": [],
+        "residual": [],
+        "covariance": [],
+        "flag": [],
+        "profiles": [],
+    }
+    voxels = [xy_voxel, xy_voxel, z_voxel]
+
+    for window in windows:
+        if mode == "3D":
+            fit = fit_gaussian_3d(window)
+            centers = fit["params"][2:5]
+            sigmas = fit["params"][5:8]
+            residual = fit["residual"]
+            converged = fit["converged"] and fit["params"][1] > 0 and all(sigmas)
+            covariance = fit["covariance"]
+            offset, amplitude = fit["params"][:2]
+            profiles = []
+            for axis in range(3):
+                # the profiles go through the center of the window, not the bead
+                scale = math.exp(
+                    -0.5
+                    * sum(
+                        [
+                            (centers[other] / sigmas[other]) ** 2
+                            for other in range(3)
+                            if other != axis
+                        ]
+                    )
+                )
+                profiles.append(
+                    [offset, offset + amplitude * scale, centers[axis], sigmas[axis]]
+                )
+        else:
+            fits = [
+                fit_gaussian_1d(*get_window_profile(window, axis)) for axis in "xyz"
+            ]
+            centers = [fit["params"][2] for fit in fits]
+            sigmas = [fit["params"][3] for fit in fits]
+            residual = max([fit["residual"] for fit in fits])
+            converged = all([fit["converged"] for fit in fits]) and all(sigmas)
+            covariance = None
+            profiles = [fit["params"] for fit in fits]
+
+        fwhms = [
+            sigma_to_fwhm * abs(sigma) * voxel for sigma, voxel in zip(sigmas, voxels)
+        ]
+        in_window = all(
+            [
+                min(window[axis]) <= center <= max(window[axis])
+                and sigma_to_fwhm * abs(sigma) <= max(window[axis]) - min(window[axis])
+                for axis, center, sigma in zip("xyz", centers, sigmas)
+            ]
+        )
+
+        results["FWHM_X"].append(fwhms[0])
+        results["FWHM_Y"].append(fwhms[1])
+        results["FWHM_Z"].append(fwhms[2])
+        results["residual"].append(residual)
+        results["covariance"].append(covariance)
+        results["profiles"].append(profiles)
+        if not converged:
+            results["flag"].append("not converged")
+        elif not in_window:
+            results["flag"].append("out of window")
+        else:
+            results["flag"].append("ok")
+
+    return results
+
+
+def get_profile_plot_data(window, profile, axis, voxel, steps=4):
+    """Get the measured and fitted values of a bead profile to plot them
+
+    Parameters
+    ----------
+    window : dict
+        Window as returned by get_bead_window
+    profile : list(float)
+        Offset, peak, center and sigma of the fit along the axis, as returned
+        by fit_psfs
+    axis : str
+        Axis of the profile, "x", "y" or "z"
+    voxel : float
+        Voxel size along the axis
+    steps : int, optional
+        Number of fitted values per voxel, by default 4
+
+    Returns
+    -------
+    tuple of (list(float), list(float), list(float), list(float))
+        Positions and values of the measured profile, then of the fit
+    """
+    positions, values = get_window_profile(window, axis)
+    offset, peak, center, sigma = profile
+    fit_positions = [
+        positions[0] + i / float(steps)
+        for i in range((positions[-1] - positions[0]) * steps + 1)
+    ]
+    fit_values = [
+        offset + (peak - offset) * math.exp(-0.5 * ((position - center) / sigma) ** 2)
+        for position in fit_positions
+    ]
+    return (
+        [position * voxel for position in positions],
+        values,
+        [position * voxel for position in fit_positions],
+        fit_values,
+    )
+
+
 def set_roi_color_and_position(
     roi, color, position_channel=1, position_slice=1, position_frame=1
 ):
@@ -678,11 +1576,17 @@ PORT = 4064
 # datasetId = datasetid
 groupId = "-1"
 
+# minimal distance between beads, in pixels and slices
 x_range = 12
 y_range = 12
 z_range = 12
+# how many noise standard deviations a bead needs to be above the background
+bead_noise_factor = 10
 
-line_thickness = 1
+# FWHM of a Gaussian of sigma 1
+sigma_to_fwhm = 2 * math.sqrt(2 * math.log(2))
+# sigma of a Gaussian whose part above half maximum has a standard deviation of 1
+top_half_to_sigma = 1.9813
 
 roi_size_cal = 15000
 final_size = 550
@@ -696,8 +1600,17 @@ if __name__ == "__main__":
 
     today = date.today()
     destination = str(destination)
+
+    # in batch mode nothing gets displayed, not even the ROI Manager
+    previous_batch_mode = Interpreter.batchMode
+    Interpreter.batchMode = batch_mode
+    if batch_mode:
+        rm = RoiManager(True)
+    else:
+        rm = RoiManager.getRoiManager()
     rm.reset()
 
+    fetched_images = None
     try:
         user_client = omerotools.connect(HOST, PORT, USERNAME, PASSWORD)
 
@@ -711,7 +1624,13 @@ if __name__ == "__main__":
         omero_avg_columns = OrderedDict()
 
         # imps = BFImport(file_to_open)
-        for image_index, image_wpr in enumerate(image_wrappers):
+        fetched_images = prefetch_images(
+            image_wrappers,
+            lambda image_wpr: fetch_image(user_client, image_wpr),
+            prefetch_depth,
+            int(prefetch_memory_gb * 1024**3),
+        )
+        for image_index, (image_wpr, fetched) in enumerate(fetched_images):
             kv_dict = ArrayList()
             kv_dict.clear()
 
@@ -719,21 +1638,19 @@ if __name__ == "__main__":
 
             misc.progressbar(image_index + 1, len(image_wrappers), 2, "Processing : ")
 
-            rm = RoiManager.getInstance()
             rm.reset()
 
+            if fetched is None:
+                continue
+
             # image_wpr = image_wrapper.toImagePlus()
             dataset_wpr = image_wpr.getDatasets(user_client)[0]
             dataset_id = dataset_wpr.getId()
             dataset_name = dataset_wpr.getName()
             project_name = dataset_wpr.getProjects(user_client)[0].getName()
 
-            acq_metadata_dict = omerotools.get_acquisition_metadata(
-                user_client, image_wpr
-            )
-
-            IJ.log("\\Update5:Fetching image from OMERO...")
-            imp = image_wpr.toImagePlus(user_client)
+            acq_metadata_dict = fetched["acq_metadata"]
+            imp = fetched["imp"]
 
             # Set calibration in nm
             average_values.extend([imp.getTitle()])
@@ -757,12 +1674,17 @@ if __name__ == "__main__":
 
             omero_roi = True
 
-            rois_wpr = image_wpr.getROIs(user_client)
-            list_roi = ROIWrapper.toImageJ(rois_wpr)
+            list_roi = fetched["rois"]
             if len(list_roi):
                 for roi in list_roi:
                     rm.addRoi(roi)
 
+            if batch_mode and rm.getCount() == 0:
+                IJ.log("No ROI found for image " + imp.getTitle() + ", skipping it")
+                imp.close()
+                imp = fetched = None
+                continue
+
             while (imp.getRoi() is None) and (rm.getCount() == 0):
                 omero_roi = False
                 imp.show()
@@ -787,15 +1709,60 @@ if __name__ == "__main__":
 
             omero_avg_columns["Image Name"] = String
 
-            for region_index, region_roi in enumerate(rm.getRoisAsArray()):
-                misc.progressbar(
-                    region_index + 1, rm.getCount(), 3, "Processing ROI : "
+            regions = rm.getRoisAsArray()
+            if all_beads:
+                IJ.log("\\Update5:Detecting beads...")
+                beads = [
+                    find_beads(imp, channel, bead_noise_factor, x_range, z_range)
+                    for channel in range(1, imp.getNChannels() + 1)
+                ]
+                regions, region_beads = get_bead_regions(
+                    beads[ref_chnl - 1], regions, round(roi_size_cal / xy_voxel)
                 )
-                concat_array = []
+                IJ.log("Found " + str(len(regions)) + " beads in " + imp.getTitle())
+                if not regions:
+                    imp.close()
+                    imp = fetched = None
+                    continue
+
+            # a bead matched in a channel gives its best slice directly, the
+            # stack only has to be scanned for the regions without one
+            matched_beads = [[None] * len(regions) for _ in range(imp.getNChannels())]
+            if all_beads:
+                matched_beads = [
+                    [
+                        find_nearest_bead(channel_beads, region_bead, x_range)
+                        for region_bead in region_beads
+                    ]
+                    for channel_beads in beads
+                ]
+            stack_scans = []
+            for channel in range(1, imp.getNChannels() + 1):
+                unmatched = [
+                    region_index
+                    for region_index, bead in enumerate(matched_beads[channel - 1])
+                    if not bead
+                ]
+                scans = {}
+                if unmatched:
+                    IJ.log("\\Update5:Scanning the stack...")
+                    scans = dict(
+                        zip(
+                            unmatched,
+                            scan_rois_through_stack(
+                                imp, [regions[i] for i in unmatched], channel
+                            ),
+                        )
+                    )
+                stack_scans.append(scans)
 
-                if region_index == 0:
-                    channel_order = range(1, imp.getNChannels() + 1)
-                    channel_order.insert(0, channel_order.pop(ref_chnl - 1))
+            # prepare the montage and the window around the bead of every
+            # channel of every region, all beads get fitted together afterwards
+            channel_order = range(1, imp.getNChannels() + 1)
+            channel_order.insert(0, channel_order.pop(ref_chnl - 1))
+            beads_data = []
+            for region_index, region_roi in enumerate(regions):
+                misc.progressbar(region_index + 1, len(regions), 3, "Processing ROI : ")
 
                 for channel_index, channel in enumerate(channel_order):
                     misc.progressbar(
@@ -817,19 +1784,18 @@ if __name__ == "__main__":
                         imp, specific_chnl=channel
                     )
 
-                    stack_stats = scan_for_best_slice(imp_current_channel, region_roi)
-
-                    brightest_spot = coord_brightest_point(
-                        imp_current_channel, region_roi, stack_stats["best_slice"]
-                    )
+                    bead = matched_beads[channel - 1][region_index]
+                    if bead:
+                        stack_stats = bead
+                        brightest_spot = bead
+                    else:
+                        stack_stats = stack_scans[channel - 1][region_index]
+                        brightest_spot = coord_brightest_point(
+                            imp_current_channel, region_roi, stack_stats["best_slice"]
+                        )
 
                     max_z = min(imp.getNSlices(), 100)
 
-                    if channel == ref_chnl:
-                        ref_chnl_x_coord = brightest_spot["X_coord"]
-                        ref_chnl_y_coord = brightest_spot["Y_coord"]
-                        ref_chnl_z_coord = stack_stats["best_slice"]
-
                     ROI_size = round(roi_size_cal / xy_voxel)
                     # ROI_size = region_roi.getBounds().width
                     half_ROI_size = round(ROI_size / 2)
@@ -852,34 +1818,16 @@ if __name__ == "__main__":
                         stack_stats["best_slice"],
                         bg_ROI,
                     )
-                    imp_centered_ROI_current_channel.show()
 
                     x2 = int(min(brightest_spot["X_coord"], half_ROI_size))
                     y2 = int(min(brightest_spot["Y_coord"], half_ROI_size))
 
                     # Redimension stack
-                    while (
-                        stack_stats["best_slice"] + (max_z / 2)
-                        > imp_centered_ROI_current_channel.getNSlices()
-                    ):
-                        imp_centered_ROI_current_channel.setSlice(
-                            imp_centered_ROI_current_channel.getNSlices()
-                        )
-                        IJ.run(imp_centered_ROI_current_channel, "Add Slice", "")
-                    while (
-                        stack_stats["best_slice"] + (max_z / 2)
-                        < imp_centered_ROI_current_channel.getNSlices()
-                    ):
-                        imp_centered_ROI_current_channel.setSlice(
-                            imp_centered_ROI_current_channel.getNSlices()
-                        )
-                        IJ.run(imp_centered_ROI_current_channel, "Delete Slice", "")
-                    while imp_centered_ROI_current_channel.getNSlices() > max_z:
-                        imp_centered_ROI_current_channel.setSlice(1)
-                        IJ.run(imp_centered_ROI_current_channel, "Delete Slice", "")
-                    while imp_centered_ROI_current_channel.getNSlices() < max_z:
-                        imp_centered_ROI_current_channel.setSlice(1)
-                        IJ.run(imp_centered_ROI_current_channel, "Add Slice", "")
+                    center_stack_on_slice(
+                        imp_centered_ROI_current_channel,
+                        stack_stats["best_slice"],
+                        max_z,
+                    )
 
                     best_slice = max_z / 2
 
@@ -950,16 +1898,10 @@ if __name__ == "__main__":
                     )
                     # scale_value = half_final_size / ROI_size
 
-                    imp_centered_ROI_current_channel.show()
-                    imp_centered_ROI_current_channel_proj.show()
-                    imp_x_proj.show()
-                    imp_y_proj.show()
-
                     ic = ImageCalculator()
                     imp_montage = ic.run(
                         "Add create", imp_centered_ROI_current_channel_proj, imp_x_proj
                     )
-                    imp_montage.show()
 
                     imp_montage_2 = ic.run("Add create", imp_montage, imp_y_proj)
 
@@ -971,10 +1913,7 @@ if __name__ == "__main__":
 
                     # imp_montage2 = imp_montage_2.resize(final_size, final_size, "none")
 
-                    text_position_start = half_final_size
-
                     imp_montage_2.setTitle("Project")
-                    imp_montage_2.show()
 
                     # sys.exit()
 
@@ -997,75 +1936,52 @@ if __name__ == "__main__":
                     IJ.run(imp_montage_2, "8-bit", "")
                     IJ.run(imp_montage_2, "RGB Color", "")
 
-                    # ─── FWHM AXIAL ─────────────────────────────────────────────────────────────────
+                    beads_data.append(
+                        {
+                            "brightest_spot": brightest_spot,
+                            "stack_stats": stack_stats,
+                            "montage": imp_montage_2,
+                            "window": get_bead_window(
+                                imp_centered_ROI_current_channel, x2, y2, best_slice
+                            ),
+                        }
+                    )
+                    imp_centered_ROI_current_channel.changes = False
+                    imp_centered_ROI_current_channel.close()
 
-                    z_profile_x = range(imp_centered_ROI_current_channel.getNSlices())
-                    z_profile_y = []
-                    for i in z_profile_x:
-                        imp_centered_ROI_current_channel.setSlice(i + 1)
-                        z_profile_y.append(
-                            imp_centered_ROI_current_channel.getPixel(x2, y2)[0]
-                        )
+            IJ.log("\\Update5:Fitting " + str(len(beads_data)) + " beads...")
+            fits = fit_psfs(
+                [bead_data["window"] for bead_data in beads_data],
+                xy_voxel,
+                z_voxel,
+                fit_mode,
+            )
 
-                    curve_fitter_axial = CurveFitter(z_profile_x, z_profile_y)
-                    curve_fitter_axial.doFit(CurveFitter.GAUSSIAN)
-                    fit_results = curve_fitter_axial.getParams()
-                    rounded_fit_results = [round(num, 4) for num in fit_results]
-
-                    # ─── PLOT ───────────────────────────────────────────────────────────────────────
-
-                    amplitude = min(40, imp_centered_ROI_current_channel.getNSlices())
-                    max_graph = 0
-                    x_plot_ax_real = []
-                    y_plot_ax_real = []
-                    for i in range(amplitude):
-                        x_plot_ax_real.append((i - amplitude / 2) * z_voxel)
-                        y_plot_ax_real.append(
-                            z_profile_y[best_slice - amplitude / 2 + i]
-                        )
-                        if y_plot_ax_real[i] >= max_graph:
-                            max_graph = y_plot_ax_real[i]
-
-                    y_min = 66000
-                    y_max = 0
-                    x_plot_ax_fit = []
-                    y_plot_ax_fit = []
-                    for i in range(amplitude * 4):
-                        x_plot_ax_fit.append((i / 4.0 - amplitude / 2.0) * z_voxel)
-                        x = best_slice - amplitude / 2.0 + i / 4.0
-                        y_plot_ax_fit.append(
-                            fit_results[0]
-                            + (fit_results[1] - fit_results[0])
-                            * math.exp(
-                                (-(x - fit_results[2]) * (x - fit_results[2]))
-                                / (2 * fit_results[3] * fit_results[3])
-                            )
-                        )
+            text_position_start = half_final_size
+            for region_index, region_roi in enumerate(regions):
+                concat_array = []
+                text_overlay = Overlay()
 
-                        if y_plot_ax_fit[i] >= max_graph:
-                            max_graph = y_plot_ax_fit[i]
-                        if y_min > y_plot_ax_fit[i]:
-                            y_min = y_plot_ax_fit[i]
-                        if y_max < y_plot_ax_fit[i]:
-                            y_max = y_plot_ax_fit[i]
-
-                    HM = (y_max - y_min) / 2
-                    try:
-                        k = (
-                            -2
-                            * fit_results[3]
-                            * fit_results[3]
-                            * math.log(
-                                (HM - fit_results[0])
-                                / (fit_results[1] - fit_results[0])
-                            )
-                        )
-                    except (ValueError, ZeroDivisionError):
+                for channel_index, channel in enumerate(channel_order):
+                    bead_index = region_index * len(channel_order) + channel_index
+                    bead_data = beads_data[bead_index]
+                    brightest_spot = bead_data["brightest_spot"]
+                    stack_stats = bead_data["stack_stats"]
+                    imp_montage_2 = bead_data["montage"]
+
+                    if channel == ref_chnl:
+                        ref_chnl_x_coord = brightest_spot["X_coord"]
+                        ref_chnl_y_coord = brightest_spot["Y_coord"]
+                        ref_chnl_z_coord = stack_stats["best_slice"]
+
+                    if fits["flag"][bead_index] != "ok":
                         IJ.log(
                             "ISSUE WITH CHANNEL "
                             + str(channel)
                             + " AND ROI "
                             + str(region_index)
+                            + ", FIT IS "
+                            + fits["flag"][bead_index].upper()
                             + ", WILL BE SKIPPED"
                         )
                         temp_imp = IJ.createImage(
@@ -1084,10 +2000,23 @@ if __name__ == "__main__":
                         avg_FWHM_Y[channel - 1].append(None)
                         avg_FWHM_Z[channel - 1].append(None)
                         continue
-                    try:
-                        FWHMa = 2 * z_voxel * math.sqrt(k)
-                    except ValueError:
-                        FWHMa = 0
+
+                    FWHMl = fits["FWHM_X"][bead_index]
+                    FWHMly = fits["FWHM_Y"][bead_index]
+                    FWHMa = fits["FWHM_Z"][bead_index]
+                    profiles = fits["profiles"][bead_index]
+
+                    # ─── FWHM AXIAL ─────────────────────────────────────────────────────────────────
+
+                    (
+                        x_plot_ax_real,
+                        y_plot_ax_real,
+                        x_plot_ax_fit,
+                        y_plot_ax_fit,
+                    ) = get_profile_plot_data(
+                        bead_data["window"], profiles[2], "z", z_voxel
+                    )
+                    max_graph = max(y_plot_ax_real + y_plot_ax_fit)
 
                     fwhm_axial_plot = Plot(
                         "FWHM axial", "Z", "Intensity", x_plot_ax_fit, y_plot_ax_fit
@@ -1100,151 +2029,30 @@ if __name__ == "__main__":
                         fwhm_axial_imp, final_size, final_size, "Center", False
                     )
 
-                    # fwhm_axial_imp.show()
                     # ─── FWHM LATERAL ───────────────────────────────────────────────────────────────
 
-                    imp_centered_ROI_current_channel.setSlice(best_slice)
-                    x = range(-8, 9)
-                    y = []
-                    yy = []
-
-                    for i in range(17):
-                        temp_y = 0
-                        temp_yy = 0
-
-                        for k in range(
-                            int(-(math.floor(line_thickness / 2))),
-                            int(-(math.floor(line_thickness / 2)) + line_thickness),
-                        ):
-                            temp_y = (
-                                temp_y
-                                + imp_centered_ROI_current_channel.getPixel(
-                                    x2 - 8 + i, y2 + k
-                                )[0]
-                                / line_thickness
-                            )
-                            temp_yy = (
-                                temp_yy
-                                + imp_centered_ROI_current_channel.getPixel(
-                                    x2 + k, y2 - 8 + i
-                                )[0]
-                                / line_thickness
-                            )
-
-                        y.append(temp_y)
-                        yy.append(temp_yy)
-
-                    curve_fitter_lateral_1 = CurveFitter(x, y)
-                    curve_fitter_lateral_1.doFit(CurveFitter.GAUSSIAN)
-                    fit_results_lateral_1 = curve_fitter_lateral_1.getParams()
-
-                    curve_fitter_lateral_2 = CurveFitter(x, yy)
-                    curve_fitter_lateral_2.doFit(CurveFitter.GAUSSIAN)
-                    fit_results_lateral_2 = curve_fitter_lateral_2.getParams()
-
-                    # ─── PLOT ───────────────────────────────────────────────────────────────────────
-
-                    x_plot_lat_real = []
-                    y_plot_lat_real = []
-                    yy_plot_lat_real = []
-
-                    y_min = 66000
-                    y_max = 0
-                    max_graph = 0
-                    for i in range(17):
-                        x_plot_lat_real.append((i - 8) * xy_voxel)
-                        y_plot_lat_real.append(y[i])
-                        yy_plot_lat_real.append(yy[i])
-
-                        if max(y[i], yy[i]) >= max_graph:
-                            max_graph = max(y[i], yy[i])
-
-                    x_plot_lat_fit = []
-                    y_plot_lat_fit = []
-                    yy_plot_lat_fit = []
-
-                    for i in range(65):
-                        x = i / 4.0 - 8.0
-                        x_plot_lat_fit.append(x * xy_voxel)
-                        y_plot_lat_fit.append(
-                            fit_results_lateral_1[0]
-                            + (fit_results_lateral_1[1] - fit_results_lateral_1[0])
-                            * math.exp(
-                                (
-                                    -(x - fit_results_lateral_1[2])
-                                    * (x - fit_results_lateral_1[2])
-                                )
-                                / (
-                                    2
-                                    * fit_results_lateral_1[3]
-                                    * fit_results_lateral_1[3]
-                                )
-                            )
-                        )
-                        yy_plot_lat_fit.append(
-                            fit_results_lateral_2[0]
-                            + (fit_results_lateral_2[1] - fit_results_lateral_2[0])
-                            * math.exp(
-                                (
-                                    -(x - fit_results_lateral_2[2])
-                                    * (x - fit_results_lateral_2[2])
-                                )
-                                / (
-                                    2
-                                    * fit_results_lateral_2[3]
-                                    * fit_results_lateral_2[3]
-                                )
-                            )
-                        )
-
-                        if max(y_plot_lat_fit[i], yy_plot_lat_fit[i]) >= max_graph:
-                            max_graph = max(y_plot_lat_fit[i], yy_plot_lat_fit[i])
-                        if y_min > min(y_plot_lat_fit[i], yy_plot_lat_fit[i]):
-                            y_min = min(y_plot_lat_fit[i], yy_plot_lat_fit[i])
-                        if y_max < max(y_plot_lat_fit[i], yy_plot_lat_fit[i]):
-                            y_max = max(y_plot_lat_fit[i], yy_plot_lat_fit[i])
-
-                    HM = (y_max - y_min) / 2
-                    try:
-                        k = (
-                            -2
-                            * fit_results_lateral_1[3]
-                            * fit_results_lateral_1[3]
-                            * math.log(
-                                (HM - fit_results_lateral_1[0])
-                                / (fit_results_lateral_1[1] - fit_results_lateral_1[0])
-                            )
-                        )
-                    except (ValueError, ZeroDivisionError):
-                        IJ.log(
-                            "ISSUE WITH CHANNEL "
-                            + str(channel)
-                            + " AND ROI "
-                            + str(region_index)
-                            + ", WILL BE SKIPPED"
-                        )
-
-                    try:
-                        FWHMl = 2 * xy_voxel * math.sqrt(k)
-                    except ValueError:
-                        FWHMl = 0
-
-                    try:
-                        ky = (
-                            -2
-                            * fit_results_lateral_2[3]
-                            * fit_results_lateral_2[3]
-                            * math.log(
-                                (HM - fit_results_lateral_2[0])
-                                / (fit_results_lateral_2[1] - fit_results_lateral_2[0])
-                            )
-                        )
-                    except ZeroDivisionError:
-                        ky = 0
-                    try:
-                        FWHMly = 2 * xy_voxel * math.sqrt(ky)
-                    except ValueError:
-                        FWHMly = 0
+                    (
+                        x_plot_lat_real,
+                        y_plot_lat_real,
+                        x_plot_lat_fit,
+                        y_plot_lat_fit,
+                    ) = get_profile_plot_data(
+                        bead_data["window"], profiles[0], "x", xy_voxel
+                    )
+                    (
+                        x_plot_lat_real_y,
+                        yy_plot_lat_real,
+                        x_plot_lat_fit_y,
+                        yy_plot_lat_fit,
+                    ) = get_profile_plot_data(
+                        bead_data["window"], profiles[1], "y", xy_voxel
+                    )
+                    max_graph = max(
+                        y_plot_lat_real
+                        + y_plot_lat_fit
+                        + yy_plot_lat_real
+                        + yy_plot_lat_fit
+                    )
 
                     fwhm_lateral_plot = Plot(
                         "FWHM lateral",
@@ -1257,8 +2065,10 @@ if __name__ == "__main__":
                         -8 * xy_voxel, 8 * xy_voxel, 0, max_graph * 1.1
                     )
                     fwhm_lateral_plot.setColor("blue")
-                    fwhm_lateral_plot.add("line", x_plot_lat_fit, yy_plot_lat_fit)
-                    fwhm_lateral_plot.add("circles", x_plot_lat_real, yy_plot_lat_real)
+                    fwhm_lateral_plot.add("line", x_plot_lat_fit_y, yy_plot_lat_fit)
+                    fwhm_lateral_plot.add(
+                        "circles", x_plot_lat_real_y, yy_plot_lat_real
+                    )
                     fwhm_lateral_plot.setColor("black")
                     fwhm_lateral_plot.add("circles", x_plot_lat_real, y_plot_lat_real)
                     fwhm_lateral_plot.addLabel(
@@ -1277,9 +2087,6 @@ if __name__ == "__main__":
                         fwhm_lateral_imp, final_size, final_size, "Center", False
                     )
 
-                    imp_centered_ROI_current_channel.changes = False
-                    imp_centered_ROI_current_channel.close()
-
                     stack_imp = ImagesToStack().run(
                         [imp_montage_2, fwhm_axial_imp, fwhm_lateral_imp]
                     )
@@ -1289,8 +2096,6 @@ if __name__ == "__main__":
                     # stack_position = 1 + ((channel-1) * 3)
                     stack_position = channel
 
-                    if channel == ref_chnl:
-                        text_overlay = Overlay()
                     text_font = Font("Arial", Font.PLAIN, 14)
                     date_text = TextRoi(
                         text_position_start + 20,
@@ -1504,7 +2309,7 @@ if __name__ == "__main__":
                     IJ.log("\\Update5:Image is saved : " + out_path)
 
             for i in range(imp.getNChannels()):
-                if rm.getCount() > 1:
+                if len(regions) > 1:
                     kv_dict.add(
                         NamedValue(
                             "AVERAGE_FWHM_X_All_ROIS_C" + str(i + 1),
@@ -1585,6 +2390,10 @@ if __name__ == "__main__":
             imp.close()
             omero_avg_table.append(average_values)
 
+            # closing a hidden image doesn't free its pixels, drop the references
+            # to it before the next images get fetched
+            imp = imp_current_channel = beads_data = fetched = None
+
             # omero_columns = create_table_columns(omero_columns)
 
         # upload_array_as_omero_table(ctx, gateway, map(list, zip(*omero_table)), omero_columns, image_id)
@@ -1597,6 +2406,9 @@ if __name__ == "__main__":
         )
 
     finally:
+        Interpreter.batchMode = previous_batch_mode
+        if fetched_images:
+            fetched_images.close()
         user_client.disconnect()
 
     IJ.log("Script finished.")
@@ -1,7 +1,9 @@
 """Apply a normalized shading model to all multi-channel stacks in a given
 directory and export the result to another directory, using the ICS2 format.
 
-WARNING: existing files in the output directory will be silently overwritten!
+Files whose results all exist already in the output directory are skipped.
+
+WARNING: partial results of the other files will be silently overwritten!
 """
 
 # pylint: disable-msg=invalid-name
@@ -11,11 +13,13 @@ WARNING: existing files in the output directory will be silently overwritten!
 #@ File (label="Folder with image files to be corrected",style="directory") in_dir
 #@ String (label="Image file suffix",description='e.g. "oir", "ics", "czi"') suffix
 #@ File (label="Output directory",style="directory") out_dir
-#@ String(visibility=MESSAGE,persist=false,label="WARNING:",value="existing files in the output location will be overwritten without confirmation!") msg_warning
+#@ Integer (label="Parallel threads",description="number of stacks corrected in parallel, each one is held in memory",value=1,min=1) n_workers
+#@ String(visibility=MESSAGE,persist=false,label="WARNING:",value="partial results in the output location will be overwritten without confirmation!") msg_warning
 #@ LogService sjlogservice
 
 import imcflibs  # pylint: disable-msg=import-error
-from imcflibs.imagej.shading import process_folder  # pylint: disable-msg=import-error
+from imcflibs.pathtools import listdir_matching  # pylint: disable-msg=import-error
+from imcf_fiji_scripts.shading import load_shading_model, process_files  # pylint: disable-msg=import-error
 
 
 # type checks / default values and explicit pylint disabling for scijava params
@@ -23,6 +27,7 @@ in_dir = str(in_dir)  # pylint: disable-msg=used-before-assignment
 suffix = str(suffix)  # pylint: disable-msg=used-before-assignment
 out_dir = str(out_dir)  # pylint: disable-msg=used-before-assignment
 model_file = str(model_file)  # pylint: disable-msg=used-before-assignment
+n_workers = int(n_workers)  # pylint: disable-msg=used-before-assignment
 logservice = sjlogservice  # pylint: disable-msg=undefined-variable
 
 FORMAT = ".ics"
@@ -30,4 +35,13 @@ FORMAT = ".ics"
 log = imcflibs.imagej.sjlog.scijava_logger(logservice)
 log.info("Processing '%s' files in [%s]...", suffix, in_dir)
 
-process_folder(in_dir, suffix, out_dir, model_file, FORMAT)
+files = listdir_matching(in_dir, suffix, fullpath=True)
+log.info("Running shading correction and projections on %s files using "
+         "%s threads...", len(files), n_workers)
+failed = process_files(
+    files, out_dir, load_shading_model(model_file), FORMAT, n_workers,
+    skip_existing=True
+)
+for filename, err in failed:
+    log.error("FAILED: [%s] %s", filename, err)
+log.info("Processed %s files, %s failed.", len(files), len(failed))
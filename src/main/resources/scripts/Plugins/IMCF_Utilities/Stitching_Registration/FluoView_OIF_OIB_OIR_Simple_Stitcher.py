@@ -1,4 +1,11 @@
-"""Simplified wrapper script to stitch Olympus OIF / OIB / OIR mosaics."""
+"""Simplified wrapper script to stitch Olympus OIF / OIB / OIR mosaics.
+
+NOTE: the OVERVIEW mode still writes the projections of all tiles to ICS
+files in the output directory and the stitcher reads them back from there,
+as the generated stitching macro only works on tile configs referring to
+files. The projections are small compared to the stacks, and the files are
+re-used by subsequent runs with unchanged tiles.
+"""
 
 # pylint: disable-msg=C0103
 # pylint: disable-msg=E0401
@@ -8,7 +15,8 @@
 #@ File(label="<html><div align='left'><h3>Supported input files</h3>&bull; [ <tt>MATL_Mosaic.log</tt> ]<br/>&bull; [ <tt>matl.omp2info</tt> ]</div></html>",description="[ MATL_Mosaic.log ] or [ matl.omp2info ] file") infile
 #@ File(label="Shading correction model",description="single slice, single channel, 32-bit float TIFF file",style="extensions:tif/tiff") model_file
 #@ File(label="Output directory",description="location for results and intermediate processing files, type 'NONE' or '-' to use input dir",style="directory", value="NONE", persist=false) out_dir
-#@ String(label="Operation mode",choices={"FULL - preprocess + fuse","PREPROCESS ONLY - no fusion"}) mode
+#@ Integer(label="Pre-processing threads",description="number of stacks corrected in parallel, each one is held in memory",value=1,min=1) n_workers
+#@ String(label="Operation mode",choices={"FULL - preprocess + fuse","OVERVIEW - projections only + fuse","PREPROCESS ONLY - no fusion"}) mode
 
 #@ String(visibility=MESSAGE,label="<html><br/><h3>Citation note</h3></html>",value="<html><br/>Stitching is based on a publication, if you're using it for your research please <br>be so kind to cite it:<br><a href=''>Preibisch et al., Bioinformatics (2009)</a></html>",persist=false) msg_citation
 #@ LogService sjlogservice
@@ -19,11 +27,17 @@
 # fail as 'io' is by then already populated with the corresponding Java class:
 import io  # pylint: disable-msg=unused-import
 
-import sys
-from os.path import basename, dirname, join
+import json
+from os import makedirs
+from os.path import basename, dirname, exists, getmtime, getsize, join
 
 import imcflibs
-from imcflibs.imagej.misc import show_status, show_progress
+from imcflibs.imagej.misc import error_exit, show_status
+from imcflibs.pathtools import gen_name_from_orig
+from imcf_fiji_scripts.mosaics import (get_file_hash, has_fused_results,
+                                       load_mosaics, write_if_changed,
+                                       write_tile_configs)
+from imcf_fiji_scripts.shading import load_shading_model, process_files
 
 import micrometa
 import ij
@@ -31,10 +45,102 @@ import ij
 from java.lang.System import getProperty
 
 
-def error_exit(msg):
-    """Convenience wrapper to log an error and exit then."""
-    log.error(msg)
-    sys.exit(msg)
+# inputs and parameters of the pre-processing results are recorded here:
+PREPROCESSING_STATE = 'preprocessing_state.json'
+
+
+def get_tile_files(mosaics):
+    """Get the (unique) tile files of all mosaics, in the order of the mosaics."""
+    files = []
+    for mosaic in mosaics:
+        for subvol in mosaic.subvol:
+            if subvol.storage['full'] not in files:
+                files.append(subvol.storage['full'])
+    return files
+
+
+def get_preprocessing_entry(filename, model_hash, fmt, write_stack):
+    """Describe the inputs and parameters the results of a tile depend on."""
+    return {
+        'tile': [getmtime(filename), getsize(filename)],
+        'model': model_hash,
+        'format': fmt,
+        'stack': write_stack,
+    }
+
+
+def is_preprocessed(entry, expected, out_dir, filename):
+    """Check if the recorded pre-processing of a tile is still up to date.
+
+    Results including the corrected stack also satisfy a projections-only
+    run, all results have to exist in the output directory.
+    """
+    if entry is None:
+        return False
+    if expected['stack'] and not entry['stack']:
+        return False
+    for key in ['tile', 'model', 'format']:
+        if entry[key] != expected[key]:
+            return False
+    tags = ['', '-avg', '-max'] if expected['stack'] else ['-avg', '-max']
+    return all([exists(gen_name_from_orig(out_dir, filename, tag, entry['format']))
+                for tag in tags])
+
+
+def preprocess_tiles(files, out_dir, model_file, fmt, n_workers, write_stack=True):
+    """Run the single-pass shading correction and projections on stale tiles.
+
+    Tiles are skipped if their results exist and neither the tile, the model
+    nor the output format have changed since, as recorded in the state file
+    in the output directory.
+
+    Returns
+    -------
+    bool
+        True if any tile has been (re-)processed, False if all were up to date.
+    """
+    if not exists(out_dir):
+        makedirs(out_dir)
+    state_file = join(out_dir, PREPROCESSING_STATE)
+    state = {}
+    if exists(state_file):
+        with open(state_file, 'r') as infh:
+            state = json.load(infh)
+    model_hash = None
+    if model_file.upper() not in ['-', 'NONE']:
+        model_hash = get_file_hash(model_file)
+    else:
+        # without a model only the projections are created:
+        write_stack = False
+    expected = dict([(filename, get_preprocessing_entry(filename, model_hash,
+                                                        fmt, write_stack))
+                     for filename in files])
+    stale = [filename for filename in files
+             if not is_preprocessed(state.get(filename), expected[filename],
+                                    out_dir, filename)]
+    if not stale:
+        log.info("Pre-processing of all %s files is up to date, skipping.",
+                 len(files))
+        return False
+    log.info("Running shading correction and projections on %s of %s files "
+             "using %s threads (the others are up to date)...",
+             len(stale), len(files), n_workers)
+
+    def record_done(filename):
+        """Record the inputs and parameters of a freshly processed tile."""
+        state[filename] = expected[filename]
+
+    model = load_shading_model(model_file)
+    try:
+        failed = process_files(stale, out_dir, model, fmt, n_workers,
+                               write_stack, on_done=record_done)
+    finally:
+        with open(state_file, 'w') as out:
+            json.dump(state, out, indent=1, sort_keys=True)
+    if failed:
+        error_exit("Pre-processing failed for %i file(s), see the log for "
+                   "details!" % len(failed))
+    return True
 
 
 # type checks and explicit pylint disabling for scijava parameters
@@ -42,6 +148,7 @@ infile = str(infile)  # pylint: disable-msg=E0601
 model_file = str(model_file)  # pylint: disable-msg=E0601
 out_dir = str(out_dir)  # pylint: disable-msg=E0601,E0602
 mode = str(mode)  # pylint: disable-msg=E0601
+n_workers = int(n_workers)  # pylint: disable-msg=E0601
 logservice = sjlogservice  # pylint: disable-msg=E0602
 
 
@@ -63,22 +170,7 @@ else:
 log.info("Parsing project file: [%s]" % infile)
 ij.IJ.showStatus("Parsing mosaics...")
 
-mosaics = MosaicClass(infile, runparser=False)
-total = len(mosaics.mosaictrees)
-ij.IJ.showProgress(0.0)
-show_status("Parsed %s / %s mosaics" % (0, total))
-for i, subtree in enumerate(mosaics.mosaictrees):
-    log.info("Parsing mosaic %s...", i+1)
-    try:
-        mosaics.add_mosaic(subtree, i)
-    except (ValueError, IOError) as err:
-        log.warn('Skipping mosaic %s: %s', i, err)
-    except RuntimeError as err:
-        log.warn('Error parsing mosaic %s, SKIPPING: %s', i, err)
-    show_progress(i, total)
-    show_status("Parsed %s / %s mosaics" % (i+1, total))
-show_progress(total, total)
-show_status("Parsed %i mosaics." % total)
+mosaics = load_mosaics(MosaicClass, infile)
 
 if not mosaics:
     error_exit("Couldn't find any (valid) mosaics in the project file!")
@@ -90,20 +182,23 @@ if out_dir in ["-", "NONE"]:
 else:
     log.info("Using directory [%s] for results and temp files." % out_dir)
 
+# the overview mode only stitches the projections, no need for the stacks:
+overview = mode[:8] == 'OVERVIEW'
+
 log.info("Pre-processing stacks: shading correction and projections...")
-imcflibs.imagej.shading.process_folder(
-    indir,
-    'oir',
-    out_dir,
-    model_file,
-    '.ics'
-)
+changed = preprocess_tiles(get_tile_files(mosaics), out_dir, model_file,
+                           '.ics', n_workers, write_stack=not overview)
 
 log.info('Writing tile configuration files.')
-write_tile_configs = micrometa.imagej.write_all_tile_configs
-write_tile_configs(mosaics, out_dir, '.ics')
-write_tile_configs(mosaics, out_dir, '-avg.ics', force_2d=True)
-write_tile_configs(mosaics, out_dir, '-max.ics', force_2d=True)
+config_names = []
+configs = [('-avg.ics', True), ('-max.ics', True)]
+if not overview:
+    configs.insert(0, ('.ics', False))
+for suffix, force_2d in configs:
+    names, configs_changed = write_tile_configs(mosaics, out_dir, suffix,
+                                                force_2d=force_2d)
+    config_names += names
+    changed = configs_changed or changed
 
 
 stitcher_options = {
@@ -133,9 +228,13 @@ log.debug(imcflibs.strtools.flatten(code))
 log.debug("============= end of generated  macro code =============")
 
 log.info('Writing stitching macro.')
-micrometa.imagej.write_stitching_macro(code, 'stitch_all.ijm', indir)
-if mode[:4] == 'FULL':
+changed = write_if_changed(join(indir, 'stitch_all.ijm'), code) or changed
+if mode[:4] != 'FULL' and not overview:
+    log.warn('PREPROCESSING mode selected, NOT running the stitcher now!')
+elif not changed and has_fused_results(out_dir, config_names,
+                                       stitcher_options['export_format']):
+    log.warn('Tiles, tile configs and stitching macro are unchanged and the '
+             'results exist, NOT running the stitcher again!')
+else:
     log.info('Finished preprocessing, now launching the stitcher.')
     ij.IJ.runMacro(imcflibs.strtools.flatten(code))
-else:
-    log.warn('PREPROCESSING mode selected, NOT running the stitcher now!')
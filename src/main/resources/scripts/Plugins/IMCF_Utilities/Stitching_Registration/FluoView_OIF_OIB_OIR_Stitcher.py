@@ -14,6 +14,8 @@
 #@ String(visibility=MESSAGE,persist=false,label="<html><br/><br/><h3>Output options</h3></html>",value="") msg_sec_output
 #@ File(label="Output directory",description="location for results and intermediate processing files, type 'NONE' or '-' to use input dir",style="directory", value="NONE", persist=false) out_dir
 #@ Integer(label="Rotate result (clock-wise)", style="slider", min=0, max=270, value=0, stepSize=90) angle
+#@ Integer(label="Parallel worker processes",description="number of headless Fiji instances stitching mosaics concurrently, 1 = all mosaics in this instance",value=1,min=1) n_workers
+#@ Integer(label="RAM budget for parallel workers [GB]",description="0 = use the physical RAM of this machine",value=0,min=0) ram_budget_gb
 #@ String(visibility=MESSAGE,label="<html><br/><h3>Citation note</h3></html>",value="<html><br/>Stitching is based on a publication, if you're using it for your research please <br>be so kind to cite it:<br><a href=''>Preibisch et al., Bioinformatics (2009)</a></html>",persist=false) msg_citation
 #@ LogService sjlogservice
 
@@ -23,11 +25,18 @@
 # fail as 'io' is by then already populated with the corresponding Java class:
 import io  # pylint: disable-msg=unused-import
 
-import sys
-from os.path import basename, dirname, join
+import shutil
+from os import listdir, makedirs, remove, rmdir
+from os.path import basename, dirname, exists, isdir, isfile, join, relpath
 
 import imcflibs
-from imcflibs.imagej.misc import show_status, show_progress
+from imcflibs.imagej.misc import error_exit, show_status, show_progress
+from imcf_fiji_scripts.mosaics import (get_tile_config_name, has_fused_results,
+                                       load_mosaics, write_if_changed,
+                                       write_tile_configs)
+from imcf_fiji_scripts.workers import (FIJI_BASE_HEAP_BYTES, get_fiji_executable,
+                                       get_physical_memory, get_worker_heap,
+                                       run_workers, start_fiji)
 
 import micrometa
 import ij
@@ -35,10 +44,209 @@ import ij
 from java.lang.System import getProperty
 
 
-def error_exit(msg):
-    """Convenience wrapper to log an error and exit then."""
-    log.error(msg)
-    sys.exit(msg)
+# mosaics stitched by separate worker processes are prepared in this folder:
+MOSAIC_JOBS_DIR = 'mosaic_jobs'
+MOSAIC_JOB_MACRO = 'stitch_mosaic.ijm'
+
+# margin applied to the predicted memory footprint of a mosaic:
+RAM_SAFETY_FACTOR = 1.25
+
+
+
+def predict_mosaic_footprint(mosaic):
+    """Predict the heap required to stitch and fuse a mosaic in a worker.
+
+    The stitcher keeps all tiles and the fused image in memory, so roughly
+    twice the size of the raw tiles is needed on top of Fiji itself.
+    """
+    tile_bytes = 0
+    for subvol in mosaic.subvol:
+        dims = subvol.get_dimensions()
+        bytes_per_px = 1 if dims['B'] <= 8 else 2
+        tile_bytes += (dims['X'] * dims['Y'] * max(dims['Z'], 1) *
+                       max(dims['C'], 1) * bytes_per_px)
+    return long(2 * tile_bytes * RAM_SAFETY_FACTOR) + FIJI_BASE_HEAP_BYTES
+
+
+def write_mosaic_job(mosaic, job_dir, padlen, macro_args):
+    """Prepare a folder with the tile config and the macro for a single mosaic.
+
+    The generated macro processes all tile configs in its input folder, so
+    every mosaic gets a folder of its own. The tile file names are rewritten
+    relative to that folder.
+
+    Parameters
+    ----------
+    mosaic : micrometa.dataset.MosaicDataCuboid
+        The mosaic to stitch.
+    job_dir : str
+        The folder for the tile config, the macro and the results.
+    padlen : int
+        The padding length for the mosaic index in the tile config name.
+    macro_args : dict
+        Arguments for gen_stitching_macro(), except for the path.
+
+    Returns
+    -------
+    tuple(str, str)
+        The path to the macro for stitching this mosaic and the name of its
+        tile config.
+    """
+    if not exists(job_dir):
+        makedirs(job_dir)
+    tiles_dir = relpath(mosaic.storage['path'], job_dir).replace('\\', '/')
+    config = []
+    for line in micrometa.imagej.gen_tile_config(mosaic):
+        if '; ; (' in line:
+            line = tiles_dir + '/' + line
+        config.append(line)
+    config_name = get_tile_config_name(mosaic, padlen)
+    with open(join(job_dir, config_name), 'w') as out:
+        out.writelines(config)
+
+    code = micrometa.imagej.gen_stitching_macro(path=job_dir, **macro_args)
+    micrometa.imagej.write_stitching_macro(code, MOSAIC_JOB_MACRO, job_dir)
+    return join(job_dir, MOSAIC_JOB_MACRO), config_name
+
+
+def get_missing_outputs(job_dir, config_name, macro_args):
+    """Get the expected results of a mosaic job that don't exist.
+
+    Fiji exits with 0 after running a macro via '-batch' even if the macro
+    failed, so the results are checked instead: the fused image and, unless
+    the tiles were only fused, the registered tile config.
+
+    Returns
+    -------
+    list(str)
+        The names of the missing results, empty if the job has succeeded.
+    """
+    opts = macro_args['opts']
+    missing = []
+    if opts.get('compute') != 'false':
+        registered = config_name[:-4] + '.registered.txt'
+        if not isfile(join(job_dir, registered)):
+            missing.append(registered)
+    suffix = opts['export_format'].strip('"')
+    if not [name for name in listdir(job_dir) if name.endswith(suffix)]:
+        missing.append('fused image (%s)' % suffix)
+    return missing
+
+
+def collect_mosaic_outputs(job_dir, out_dir):
+    """Move the results of a mosaic job to the output folder, drop the rest."""
+    for name in listdir(job_dir):
+        if name == MOSAIC_JOB_MACRO or name.startswith('mosaic_') and \
+                name.endswith('.txt') and not name.endswith('.registered.txt'):
+            continue
+        target = join(out_dir, name)
+        if exists(target):
+            log.warn('Replacing existing result [%s].', target)
+            if isdir(target):
+                shutil.rmtree(target)
+            else:
+                remove(target)
+        shutil.move(join(job_dir, name), target)
+    shutil.rmtree(job_dir)
+
+
+def run_mosaic_jobs(mosaics, out_dir, macro_args, n_workers, ram_budget):
+    """Stitch the mosaics concurrently using several headless Fiji processes.
+
+    Jobs are dispatched as long as less than `n_workers` are running and the
+    sum of their predicted memory footprints stays within the RAM budget. A
+    mosaic larger than the budget is only started when no other job is
+    running. A mosaic only counts as done if its results exist, the exit code
+    of the worker alone doesn't tell.
+
+    Parameters
+    ----------
+    mosaics : micrometa.experiment.MosaicExperiment
+        The parsed mosaics.
+    out_dir : str
+        The output directory, results are moved there once a job has finished.
+    macro_args : dict
+        Arguments for gen_stitching_macro(), except for the path.
+    n_workers : int
+        The maximum number of concurrent worker processes.
+    ram_budget : long
+        The RAM available for all workers together, in bytes.
+
+    Returns
+    -------
+    list(dict) or None
+        The index, status, exit code, duration, heap and log file of every
+        mosaic, or None if no workers could be launched (any jobs prepared so
+        far are removed then).
+    """
+    fiji_executable = get_fiji_executable()
+    if fiji_executable is None:
+        log.warn("Can't locate the Fiji launcher for the worker processes!")
+        return None
+
+    jobs_dir = join(out_dir, MOSAIC_JOBS_DIR)
+    padlen = len(str(len(mosaics)))
+    jobs = []
+    for mosaic in mosaics:
+        index = mosaic.supplement['index']
+        job_dir = join(jobs_dir, 'mosaic_%03i' % index)
+        try:
+            macro, config_name = write_mosaic_job(mosaic, job_dir, padlen,
+                                                  macro_args)
+        except ValueError as err:  # tiles and out_dir on different drives
+            log.warn("Can't prepare a separate job for mosaic %s: %s", index, err)
+            for job in jobs:
+                shutil.rmtree(job['job_dir'])
+            if exists(job_dir):
+                shutil.rmtree(job_dir)
+            if not listdir(jobs_dir):
+                rmdir(jobs_dir)
+            return None
+        jobs.append({
+            'index': index,
+            'job_dir': job_dir,
+            'macro': macro,
+            'config_name': config_name,
+            'heap': get_worker_heap(predict_mosaic_footprint(mosaic), ram_budget),
+            'log_path': job_dir + '.log',
+        })
+
+    total = len(jobs)
+    results = []
+
+    def start(job):
+        """Launch the worker process stitching the mosaic of a job."""
+        log.info('Started stitching mosaic %s (%.1f GB heap).',
+                 job['index'], job['heap'] / 1024.0**3)
+        return start_fiji(fiji_executable, job['heap'], ['-batch', job['macro']],
+                          job['log_path'])
+
+    def on_finished(job, exit_code):
+        """Check the results of a finished worker, move them to out_dir."""
+        job['exit_code'] = exit_code
+        job['status'] = 'failed'
+        if exit_code == 0:
+            missing = get_missing_outputs(job['job_dir'], job['config_name'],
+                                          macro_args)
+            if missing:
+                log.error('Mosaic %s: no results found (%s), see [%s].',
+                          job['index'], ', '.join(missing), job['log_path'])
+            else:
+                job['status'] = 'done'
+                collect_mosaic_outputs(job['job_dir'], out_dir)
+        log.info('Mosaic %s %s after %.1f s (exit code %s).',
+                 job['index'], job['status'], job['duration'], exit_code)
+        results.append(job)
+        show_progress(len(results) - 1, total)
+        show_status("Stitched %s / %s mosaics" % (len(results), total))
+
+    ij.IJ.showProgress(0.0)
+    run_workers(jobs, n_workers, ram_budget, start, on_finished)
+
+    results.sort(key=lambda job: job['index'])
+    return [dict((key, job[key]) for key in
+                 ['index', 'status', 'exit_code', 'duration', 'heap', 'log_path'])
+            for job in results]
 
 
 # type checks and explicit pylint disabling for scijava parameters
@@ -49,6 +257,8 @@ stitch_maxavg_ratio = float(stitch_maxavg_ratio)  # pylint: disable-msg=E0601
 stitch_abs_displace = float(stitch_abs_displace)  # pylint: disable-msg=E0601
 out_dir = str(out_dir)  # pylint: disable-msg=E0601,E0602
 angle = int(angle)   # pylint: disable-msg=E0601
+n_workers = int(n_workers)  # pylint: disable-msg=E0601
+ram_budget_gb = int(ram_budget_gb)  # pylint: disable-msg=E0601
 logservice = sjlogservice  # pylint: disable-msg=E0602
 
 
@@ -63,6 +273,7 @@ log.info("> Regression threshold: %s", stitch_regression)
 log.info("> Max/Avg displacement ratio: %s", stitch_maxavg_ratio)
 log.info("> Max absolute displacement: %s", stitch_abs_displace)
 log.info("> rotation angle: %s", angle)
+log.info("> parallel worker processes: %s", n_workers)
 
 indir = dirname(infile)
 
@@ -76,22 +287,7 @@ else:
 log.info("Parsing project file: [%s]" % infile)
 ij.IJ.showStatus("Parsing mosaics...")
 
-mosaics = MosaicClass(infile, runparser=False)
-total = len(mosaics.mosaictrees)
-ij.IJ.showProgress(0.0)
-show_status("Parsed %s / %s mosaics" % (0, total))
-for i, subtree in enumerate(mosaics.mosaictrees):
-    log.info("Parsing mosaic %s...", i+1)
-    try:
-        mosaics.add_mosaic(subtree, i)
-    except (ValueError, IOError) as err:
-        log.warn('Skipping mosaic %s: %s', i, err)
-    except RuntimeError as err:
-        log.warn('Error parsing mosaic %s, SKIPPING: %s', i, err)
-    show_progress(i, total)
-    show_status("Parsed %s / %s mosaics" % (i+1, total))
-show_progress(total, total)
-show_status("Parsed %i mosaics." % total)
+mosaics = load_mosaics(MosaicClass, infile)
 
 if not mosaics:
     error_exit("Couldn't find any (valid) mosaics in the project file!")
@@ -104,8 +300,7 @@ else:
     log.info("Using directory [%s] for results and temp files." % out_dir)
 
 log.info('Writing tile configuration files.')
-write_tile_configs = micrometa.imagej.write_all_tile_configs
-write_tile_configs(mosaics, out_dir)
+config_names, configs_changed = write_tile_configs(mosaics, out_dir)
 
 stitcher_options = {
     'export_format': '".ids"',
@@ -122,19 +317,45 @@ template_path = join(getProperty('fiji.dir'), 'jars', 'python-micrometa.jar')
 log.info("Using macro templates from [%s]." % template_path)
 log.info("Using [%s] as base directory." % indir)
 
-code = micrometa.imagej.gen_stitching_macro(
-    name=mosaics.infile['dname'],
-    path=out_dir,
-    tplpfx='templates/imagej-macro/stitching',
-    tplpath=template_path,
-    opts=stitcher_options
-)
+macro_args = {
+    'name': mosaics.infile['dname'],
+    'tplpfx': 'templates/imagej-macro/stitching',
+    'tplpath': template_path,
+    'opts': stitcher_options,
+}
+code = micrometa.imagej.gen_stitching_macro(path=out_dir, **macro_args)
 
 log.debug("============= generated macro code =============")
 log.debug(imcflibs.strtools.flatten(code))
 log.debug("============= end of generated  macro code =============")
 
 log.info('Writing stitching macro.')
-micrometa.imagej.write_stitching_macro(code, 'stitch_all.ijm', indir)
-log.warn('Finished preprocessing, now launching the stitcher.')
-ij.IJ.runMacro(imcflibs.strtools.flatten(code))
+macro_changed = write_if_changed(join(indir, 'stitch_all.ijm'), code)
+
+up_to_date = not (configs_changed or macro_changed) and \
+    has_fused_results(out_dir, config_names, stitcher_options['export_format'])
+
+results = None
+if up_to_date:
+    log.warn('Tile configs and stitching macro are unchanged and the results '
+             'exist, NOT running the stitcher again!')
+elif n_workers > 1 and len(mosaics) > 1:
+    ram_budget = ram_budget_gb * 1024**3 if ram_budget_gb else get_physical_memory()
+    log.warn('Finished preprocessing, now stitching %i mosaics using up to %i '
+             'workers (%.1f GB RAM).', len(mosaics), n_workers,
+             ram_budget / 1024.0**3)
+    results = run_mosaic_jobs(mosaics, out_dir, macro_args, n_workers, ram_budget)
+
+if results is None and not up_to_date:
+    log.warn('Finished preprocessing, now launching the stitcher.')
+    ij.IJ.runMacro(imcflibs.strtools.flatten(code))
+elif results is not None:
+    log.info("Per-mosaic stitching summary:")
+    for result in results:
+        log.info("> mosaic %s: %s, %.1f s, %.1f GB heap, log: [%s]",
+                 result['index'], result['status'], result['duration'],
+                 result['heap'] / 1024.0**3, result['log_path'])
+    failed = [result for result in results if result['status'] != 'done']
+    if failed:
+        log.error("Stitching failed for %i mosaic(s), see the logs in [%s]." %
+                  (len(failed), join(out_dir, MOSAIC_JOBS_DIR)))
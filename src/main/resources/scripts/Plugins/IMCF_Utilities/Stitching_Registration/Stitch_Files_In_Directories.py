@@ -2,12 +2,25 @@
 # @String(label="file type") filetype
 # @Boolean(label="quick stitch by stage coordinates", value="False") quick
 # @Boolean(label="save as BigDataViewer hdf5 instead", value="False") bdv
+# @Boolean(label="save as OME-Zarr instead", description="chunked multi-resolution pyramid, viewable without converting, takes precedence over hdf5", value=False) ome_zarr
 # @Double(label="Regression threshold", value=0.25) reg_threshold
 # @Boolean(label="conserve RAM but be slower", description="tick this if your previous attempt failed with <Out of memory> error", value="False") bigdata
 # @Boolean (label="convert stitched & fused image to Imaris5", description="convert the fused image to *.ims", value=True) convert_to_ims
 # @String (label="Send info email to: ", description="empty = skip", required="False") email_address
 # @Boolean(label="Individual multi-series files ?", value=False) individual_series
 # @Boolean(label="Only output TileConfiguration.registered txt file ?", value=False) only_register
+# @Integer(label="Free RAM target before next folder [% of max]", description="RAM is reclaimed after each folder until this share of the max heap is available again", value=80, min=0, max=100) gc_target_pct
+# @Integer(label="Max wait for freeing RAM [s]", description="continue with the next folder anyway after this time", value=180, min=0) gc_timeout
+# @Integer(label="Parallel worker processes", description="number of headless Fiji instances stitching folders concurrently, 1 = all folders in this instance", value=1, min=1) n_workers
+# @Integer(label="RAM budget for parallel workers [GB]", description="0 = use the physical RAM of this machine", value=0, min=0) ram_budget_gb
+# @Boolean(label="Only report the memory plan (dry-run)", description="predict the peak RAM of each folder and the mode to use without stitching anything", value=False) plan_only
+# @Integer(label="Max queued Imaris conversions", description="folders waiting for ImarisConvert while the next ones are stitched, stitching pauses when the queue is full", value=2, min=1) imaris_queue_depth
+# @Boolean(label="Coarse-to-fine registration", description="estimate the shifts on binned projections first, then refine them in small windows at full resolution (faster for large 3D overlaps)", value=False) coarse_to_fine
+# @Boolean(label="Only stitch a low-resolution preview", description="register and fuse binned tiles for a quick check of the stage coordinates", value=False) preview
+# @Integer(label="Preview binning factor", description="pyramid levels of the files are used where available", value=8, min=1) preview_binning
+# @Boolean(label="Start from the registered preview positions", description="use the positions registered by a previous preview run instead of the stage coordinates", value=False) use_preview_positions
+# @String(visibility=INVISIBLE, persist=false, required=false, value="") worker_job
+# @String(visibility=INVISIBLE, persist=false, required=false, value="") series_file
 # @DatasetIOService io
 # @ImageDisplayService ImageDisplayService
 
@@ -17,23 +30,157 @@
 
 # ─── Imports ──────────────────────────────────────────────────────────────────
 
+import codecs
+import json
+import math
 import os
+import Queue
+import re
 import shutil
+import subprocess
+import tempfile
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import jarray
+from com.google.gson import GsonBuilder
 from io.scif.util import MemoryTools
 
 # Imagej imports
-from ij import IJ
+from ij import IJ, ImagePlus, ImageStack
 from ij import WindowManager as wm
-from ij.plugin import FolderOpener, HyperStackConverter
+from ij.macro import Interpreter
+from ij.process import Blitter, ImageProcessor
+from java.lang import Exception as JavaException
+from java.lang import Runtime
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.util import ArrayList
+from java.util.concurrent import Callable, Executors
+from loci.formats import ChannelSeparator, FormatTools, ImageReader
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+from mpicbg.models import (
+    Point,
+    PointMatch,
+    Tile,
+    TileConfiguration,
+    TranslationModel3D,
+)
+from mpicbg.stitching import PairWiseStitchingImgLib, StitchingParameters
+from org.janelia.saalfeldlab.n5 import (
+    ByteArrayDataBlock,
+    DataType,
+    DoubleArrayDataBlock,
+    FloatArrayDataBlock,
+    GzipCompression,
+    IntArrayDataBlock,
+    RawCompression,
+    ShortArrayDataBlock,
+)
+from org.janelia.saalfeldlab.n5.hdf5 import N5HDF5Writer
+from org.janelia.saalfeldlab.n5.zarr import N5ZarrWriter
 from imcflibs import pathtools
 from imcflibs.imagej import bioformats as bf
 from imcflibs.imagej import misc
+from imcf_fiji_scripts.workers import (
+    FIJI_BASE_HEAP_BYTES,
+    get_fiji_executable,
+    get_physical_memory,
+    get_worker_heap,
+    run_workers,
+    start_fiji,
+)
 
 # requirements:
 # BigStitcher
 # faim-imagej-imaris-tools-0.0.1.jar (https://maven.scijava.org/service/local/repositories/releases/content/org/scijava/faim-imagej-imaris-tools/0.0.1/faim-imagej-imaris-tools-0.0.1.jar)
 
+# ─── Variables ────────────────────────────────────────────────────────────────
+
+# margin applied to the predicted peak memory of the stitcher
+RAM_SAFETY_FACTOR = 1.25
+
+# location of this script in the jar, extracted from there for the workers
+SCRIPT_RESOURCE = (
+    "scripts/Plugins/IMCF_Utilities/Stitching_Registration/"
+    + "Stitch_Files_In_Directories.py"
+)
+
+# fusion method of the Grid/Collection stitcher to only register the tiles
+REGISTER_ONLY = "Do not fuse images (only write TileConfiguration)"
+
+# edge length of the chunks written in BigData mode, in px
+FUSION_BLOCK_SIZE = 128
+
+# maximum number of resolution levels written in BigData mode
+MAX_RESOLUTION_LEVELS = 5
+
+# spatial units of the metadata as named by the OME-Zarr (NGFF) specification,
+# micro signs are replaced by "u" before looking them up
+NGFF_UNITS = {
+    "nm": "nanometer",
+    "um": "micrometer",
+    "micron": "micrometer",
+    "mm": "millimeter",
+}
+
+# planes written by the Grid/Collection stitcher to its output directory
+GC_PLANE_NAME = re.compile(r"^img_t(\d+)_z(\d+)_c(\d+)")
+
+# "name; series; (x, y[, z])" lines of a TileConfiguration file
+TILECONFIG_LINE = re.compile(r"^([^;#]+);\s*(\d*)\s*;\s*\(([^)]*)\)")
+
+# downscaling of the projections used for the coarse registration
+COARSE_REGISTRATION_BINNING = 4
+
+# margin around the predicted overlap searched at full resolution, in px
+REFINE_MARGIN = 3 * COARSE_REGISTRATION_BINNING
+
+# number of phase correlation peaks checked for each pair of tiles
+CHECK_PEAKS = 5
+
+# links removed from the global optimization as by the Grid/Collection stitcher
+MAX_AVG_DISPLACEMENT = 2.5
+ABSOLUTE_DISPLACEMENT = 3.5
+
+# convergence of the global optimization as in the Grid/Collection stitcher:
+# maximal allowed error in px, maximal number of iterations and number of
+# iterations the error must not improve before stopping
+OPTIMIZER_MAX_ERROR = 10.0
+OPTIMIZER_MAX_ITERATIONS = 1000
+OPTIMIZER_MAX_PLATEAU = 200
+
+# folder holding the binned tiles during a preview run
+PREVIEW_DIR = "stitch_preview"
+
+# report written by the memory planner
+MEMORY_PLAN_FILE = "stitch_memory_plan.csv"
+
+# run manifest in the source directory, allowing to resume interrupted runs
+STITCH_MANIFEST = "stitch_manifest.json"
+
+# per-stage measurements of every folder, appended to by each run
+STAGE_LOG = "stitch_stages.jsonl"
+
+# time between two samples of the used heap, in s
+HEAP_SAMPLE_INTERVAL = 0.5
+
+# sidecar file caching the stage metadata of the tiles of a folder
+STAGE_METADATA_CACHE = "stage_metadata_cache.json"
+
+# attributes of bf.get_stage_coords results stored in the cache
+STAGE_METADATA_FIELDS = [
+    "dimensions",
+    "series_names",
+    "relative_coordinates_x",
+    "relative_coordinates_y",
+    "relative_coordinates_z",
+    "image_calibration",
+    "calibration_unit",
+    "image_dimensions_czt",
+]
+
 # ─── Functions ────────────────────────────────────────────────────────────────
 
 
@@ -58,7 +205,13 @@ def fix_ij_dirs(path):
 
 
 def write_tileconfig(
-    source, dimensions, imagenames, x_coordinates, y_coordinates, z_coordinates
+    source,
+    dimensions,
+    imagenames,
+    x_coordinates,
+    y_coordinates,
+    z_coordinates,
+    filename="TileConfiguration.txt",
 ):
     """Write a TileConfiguration.txt for the Grid/collection stitcher
 
@@ -76,11 +229,13 @@ def write_tileconfig(
         The relative stage y-coordinates in px
     z_coordinates : list
         The relative stage z-coordinates in px
+    filename : str, optional
+        Name of the file to write, by default "TileConfiguration.txt"
     """
 
     image_filenames = [os.path.basename(i) for i in imagenames]
 
-    outCSV = str(source) + "TileConfiguration.txt"
+    outCSV = str(source) + filename
 
     row_1 = "# Define the number of dimensions we are working on"
     row_2 = "dim = " + str(dimensions)
@@ -115,33 +270,46 @@ def write_tileconfig(
     f.close()
 
 
-def run_GC_stitcher(source, fusion_method, bigdata, quick, reg_threshold):
+def run_GC_stitcher(
+    source,
+    fusion_method,
+    bigdata,
+    quick,
+    reg_threshold,
+    layout_file="TileConfiguration.txt",
+    output_dir=None,
+):
     """Run the Grid/Collection stitching using a TileConfiguration.txt
 
     Parameters
     ----------
     source : str
-        Directory to the TileConfiguration.txt and the imagefiles
+        Directory to the TileConfiguration.txt and the imagefiles, or the path
+        to a multi-series file
     fusion_method : str
         Fusion method to use
+    bigdata : bool
+        Use virtual input images to save RAM
+    quick : bool
+        Only use the given positions, skip the registration
+    reg_threshold : float
+        Regression threshold for the registration
+    layout_file : str, optional
+        Name of the TileConfiguration file in `source`, by default
+        "TileConfiguration.txt". For a multi-series file, the positions from
+        its metadata are written to this file (next to the file).
+    output_dir : str, optional
+        Write the fused planes to this directory instead of displaying the
+        fused image, see `write_gc_planes`, by default None
     """
 
-    if bigdata is True:
-        temp = source + "temp"
-        if not os.path.exists(temp):
-            os.mkdir(temp)
-        mode = (
-            "use_virtual_input_images "
-            + "computation_parameters=[Save computation time (but use more RAM)] "
-            + "image_output=[Write to disk] output_directory=["
-            + temp
-            + "]"
-        )
+    mode = "computation_parameters=[Save computation time (but use more RAM)] "
+    if output_dir:
+        mode += "image_output=[Write to disk] output_directory=[" + output_dir + "]"
     else:
-        mode = (
-            "computation_parameters=[Save computation time (but use more RAM)] "
-            + "image_output=[Fuse and display]"
-        )
+        mode += "image_output=[Fuse and display]"
+    if bigdata is True:
+        mode = "use_virtual_input_images " + mode
 
     if os.path.isfile(source):
         params = (
@@ -149,7 +317,9 @@ def run_GC_stitcher(source, fusion_method, bigdata, quick, reg_threshold):
             + "order=[Defined by image metadata] "
             + "multi_series_file=["
             + source
-            + "]"
+            + "] "
+            + "output_textfile_name="
+            + layout_file
         )
     else:
         params = (
@@ -157,7 +327,8 @@ def run_GC_stitcher(source, fusion_method, bigdata, quick, reg_threshold):
             + "directory=["
             + source
             + "] "
-            + "layout_file=TileConfiguration.txt"
+            + "layout_file="
+            + layout_file
         )
 
     params += (
@@ -216,7 +387,7 @@ def save_current_image_as_bdv(filename, filetype, target):
 
     imp = wm.getCurrentImage()
     savename = filename.replace(filetype, "_stitched.xml")
-    savepath = target + savename
+    savepath = os.path.join(target, savename)
     IJ.log("now saving: " + str(savepath))
     print("now saving " + savepath)
     IJ.run(
@@ -319,192 +490,3514 @@ def open_sequential_gcimages_withBF(source, image_dimensions_czt):
     )
 
 
-def open_sequential_gcimages_from_folder(source, image_dimensions_czt):
-    """Open sequential images produced by Grid/Collection stitcher.
+def read_tileconfig(tileconfig_path, source_dir):
+    """Read the tiles and their positions from a TileConfiguration file
+
+    Parameters
+    ----------
+    tileconfig_path : str
+        Path to a TileConfiguration(.registered).txt
+    source_dir : str
+        Directory the tile names in the file are relative to
+
+    Returns
+    -------
+    list of dict
+        One dict per tile, with the full path, the series number and the
+        x, y, z position in px
+    """
+
+    tiles = []
+    with open(tileconfig_path, "r") as tileconfig:
+        for line in tileconfig:
+            match = TILECONFIG_LINE.match(line.strip())
+            if not match:
+                continue
+            position = [float(value) for value in match.group(3).split(",")]
+            if len(position) == 2:
+                position.append(0.0)
+            tiles.append(
+                {
+                    "path": os.path.join(source_dir, match.group(1).strip()),
+                    "series": int(match.group(2) or 0),
+                    "x": position[0],
+                    "y": position[1],
+                    "z": position[2],
+                }
+            )
+
+    return tiles
 
-    This function uses ImageJ's FolderOpener to open all sequential images from a
-    directory as a virtual stack. The function is specifically designed for images
-    generated by the Grid/Collection stitcher. It automatically calculates
-    Z-dimensions based on the total number of images and the provided C and T
-    dimensions, then converts the stack to a proper hyperstack that is displayed
-    to the user.
 
-    Bio-Formats sometimes has limitations with very large XY dimensions, making this
-    approach necessary for large stitched datasets.
+def write_tile_positions(tileconfig_path, dimensions, tiles):
+    """Write tiles and their positions to a TileConfiguration file
 
     Parameters
     ----------
-    source : str
-        Directory path containing the sequential image files
-    image_dimensions_czt : list of int
-        Number of images in dimensions [c,z,t] where:
-        - c: number of channels
-        - z: number of z-slices (may be overridden based on actual files)
-        - t: number of timepoints
+    tileconfig_path : str
+        Path of the TileConfiguration file to write
+    dimensions : int
+        Number of dimensions (2D or 3D)
+    tiles : list of dict
+        The tiles as returned by `read_tileconfig`, the series being left
+        empty if it is None
+    """
+
+    lines = [
+        "# Define the number of dimensions we are working on",
+        "dim = " + str(dimensions),
+        " ",
+        "# Define the image coordinate",
+    ]
+    for tile in tiles:
+        position = [tile["x"], tile["y"], tile["z"]][:dimensions]
+        lines.append(
+            "%s; %s; (%s)"
+            % (
+                os.path.basename(tile["path"]),
+                "" if tile["series"] is None else tile["series"],
+                ", ".join([str(value) for value in position]),
+            )
+        )
+
+    with open(tileconfig_path, "w") as tileconfig:
+        tileconfig.write("\n".join(lines) + "\n")
+
+
+def get_tile_boxes(stage_metadata, geometry):
+    """Get the position and size of all tiles in px
+
+    Parameters
+    ----------
+    stage_metadata : object
+        Stage metadata as returned by `get_stage_coords_cached`
+    geometry : dict
+        Tile size as returned by `get_tile_geometry`
 
     Returns
     -------
-    None
-        The function displays the hyperstack but does not return it
+    tuple of (list of tuple, tuple)
+        The x, y, z position of each tile and the x, y, z size of the tiles.
+        For 2D mosaics z is 0 and the depth 1.
+    """
 
-    Notes
-    -----
-    Z-dimension is automatically recalculated based on the total number of images
-    found and the provided C and T dimensions, as the Grid/Collection stitcher may
-    add Z-planes during processing.
+    n_tiles = len(stage_metadata.relative_coordinates_x)
+    z_coordinates = [0.0] * n_tiles
+    depth = 1
+    if stage_metadata.dimensions == 3:
+        z_coordinates = stage_metadata.relative_coordinates_z
+        depth = int(stage_metadata.image_dimensions_czt[1])
+    positions = zip(
+        [float(value) for value in stage_metadata.relative_coordinates_x],
+        [float(value) for value in stage_metadata.relative_coordinates_y],
+        [float(value) for value in z_coordinates],
+    )
+
+    return positions, (geometry["size_x"], geometry["size_y"], depth)
+
+
+def find_overlapping_tiles(positions, tile_size):
+    """Find all pairs of overlapping tiles using a uniform grid
+
+    The tiles are sorted into grid cells of the tile size, so every tile only
+    spans up to two cells per axis and is only compared to the tiles sharing
+    one of its cells instead of to all other tiles.
+
+    Parameters
+    ----------
+    positions : list of tuple
+        The x, y, z position of each tile in px
+    tile_size : tuple
+        The x, y, z size of the tiles in px
+
+    Returns
+    -------
+    list of tuple
+        The indices (i, j) with i < j of all pairs of tiles that overlap
     """
 
-    c_end = image_dimensions_czt[0]
-    t_end = image_dimensions_czt[2]
+    def cell_range(position, size):
+        first = int(math.floor(position / size))
+        last = int(math.ceil((position + size) / size)) - 1
+        return range(first, max(first, last) + 1)
+
+    cells = {}
+    for index, position in enumerate(positions):
+        ranges = [cell_range(position[i], tile_size[i]) for i in range(3)]
+        for cell_x in ranges[0]:
+            for cell_y in ranges[1]:
+                for cell_z in ranges[2]:
+                    cells.setdefault((cell_x, cell_y, cell_z), []).append(index)
+
+    pairs = set()
+    for members in cells.values():
+        for i, first in enumerate(members):
+            for second in members[i + 1 :]:
+                pair = (min(first, second), max(first, second))
+                if pair in pairs:
+                    continue
+                if all(
+                    [
+                        abs(positions[first][axis] - positions[second][axis])
+                        < tile_size[axis]
+                        for axis in range(3)
+                    ]
+                ):
+                    pairs.add(pair)
+
+    return sorted(pairs)
+
+
+def find_connected_tiles(n_tiles, pairs):
+    """Split the overlap graph of the tiles into connected groups
 
-    imp = FolderOpener.open(str(source), "virtual")
-    total_images_in_stack = imp.getNSlices()
-    z_total = (
-        total_images_in_stack / (c_end * t_end)
-    )  # needs to be inferred rather than taken from raw image metadata as the G/C-stitcher might have added z-planes
-    imp2 = HyperStackConverter.toHyperStack(
-        imp, c_end, z_total, t_end, "default", "Color"
-    )  # xyczt (default), stays virtual
-    imp2.show()
+    Parameters
+    ----------
+    n_tiles : int
+        Number of tiles
+    pairs : list of tuple
+        Pairs of overlapping tiles, see `find_overlapping_tiles`
 
+    Returns
+    -------
+    list of list of int
+        The tile indices of each group, groups ordered by their first tile
+    """
 
-# ─── Main Code ────────────────────────────────────────────────────────────────
+    parents = range(n_tiles)
 
-if __name__ == "__main__":
-    IJ.log("\\Clear")
-    IJ.log("Script starting")
+    def find_root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
 
-    # start the process
-    execution_start_time = time.time()
+    for first, second in pairs:
+        root_first = find_root(first)
+        root_second = find_root(second)
+        if root_first != root_second:
+            parents[max(root_first, root_second)] = min(root_first, root_second)
 
-    if not filetype.startswith("."):
-        filetype = "." + filetype
+    groups = OrderedDict()
+    for index in range(n_tiles):
+        groups.setdefault(find_root(index), []).append(index)
 
-    # In case script is ran batch
-    source_info = pathtools.parse_path(source)
-    source = source_info["full"]
-    # source = fix_ij_dirs(source)
-    all_source_dirs = pathtools.find_dirs_containing_filetype(source, filetype)
+    return groups.values()
 
-    if only_register:
-        fusion_method = "Do not fuse images (only write TileConfiguration)"
-        IJ.log(
-            "The output will only be the txt file containing registered positions for the tiles."
+
+class TileReader(object):
+    """Plane-wise access to tiles, keeping a limited number of readers open
+
+    The Bio-Formats readers are kept open in least-recently-used order as
+    initializing a reader is expensive for most formats, but all readers of a
+    large mosaic would take up too much memory.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.readers = OrderedDict()
+        self.bytes_read = 0
+
+    def get_reader(self, path, series):
+        """Get an initialized reader for a file, set to the given series"""
+        reader = self.readers.pop(path, None)
+        if reader is None:
+            reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+            reader.setId(path)
+            if len(self.readers) >= self.max_open:
+                self.readers.popitem(last=False)[1].close()
+        self.readers[path] = reader
+        reader.setSeries(series)
+
+        return reader
+
+    def get_plane(self, tile, channel, z_plane, timepoint):
+        """Read a single plane of a tile as an ImageProcessor"""
+        reader = self.get_reader(tile["path"], tile["series"])
+        processor = reader.openProcessors(reader.getIndex(z_plane, channel, timepoint))[
+            0
+        ]
+        self.bytes_read += processor.getPixelCount() * processor.getBitDepth() / 8
+
+        return processor
+
+    def get_window(self, tile, channel, z_plane, timepoint, x, y, width, height):
+        """Read a rectangular part of a plane of a tile as an ImageProcessor"""
+        reader = self.get_reader(tile["path"], tile["series"])
+        processor = reader.openProcessors(
+            reader.getIndex(z_plane, channel, timepoint), x, y, width, height
+        )[0]
+        self.bytes_read += processor.getPixelCount() * processor.getBitDepth() / 8
+
+        return processor
+
+    def close(self):
+        """Close all open readers"""
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+
+def create_data_block(size, grid_position, block):
+    """Wrap the pixels of an 8, 16 or 32 bit ImageProcessor in an N5 block
+
+    Parameters
+    ----------
+    size : list of int
+        Size of the block in all dimensions of the dataset
+    grid_position : list of int
+        Position of the block in the grid of the dataset
+    block : ij.process.ImageProcessor
+        The pixels of the block
+
+    Returns
+    -------
+    org.janelia.saalfeldlab.n5.DataBlock
+        Block of the matching data type
+    """
+
+    block_class = {
+        8: ByteArrayDataBlock,
+        16: ShortArrayDataBlock,
+        32: FloatArrayDataBlock,
+    }[block.getBitDepth()]
+
+    return block_class(
+        jarray.array(size, "i"), jarray.array(grid_position, "l"), block.getPixels()
+    )
+
+
+class PyramidStripWriter(object):
+    """Write a multi-resolution image strip by strip
+
+    The image is passed in horizontal strips, which are downsampled in XY for
+    all resolution levels and cut into chunks of `FUSION_BLOCK_SIZE`. Strips
+    must have a height of `strip_height` (except the last one of a plane).
+    Subclasses store each chunk at its XYZ grid position in their
+    `write_block(setup, timepoint, level, grid_position, block)` method and
+    finish writing in `close()`. Chunks keep the bit depth of the strips,
+    subclasses storing a different one convert them in `convert_strip`.
+    """
+
+    def __init__(self, width, height, depth, bit_depth):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.bit_depth = bit_depth
+        self.factors = [1]
+        while (
+            len(self.factors) < MAX_RESOLUTION_LEVELS
+            and min(width, height) / (self.factors[-1] * 2) > 2 * FUSION_BLOCK_SIZE
+        ):
+            self.factors.append(self.factors[-1] * 2)
+        self.strip_height = FUSION_BLOCK_SIZE * self.factors[-1]
+        self.bytes_written = 0
+
+    def level_dimensions(self, factor):
+        """XYZ size of a resolution level"""
+        return [
+            int(math.ceil(self.width / float(factor))),
+            int(math.ceil(self.height / float(factor))),
+            self.depth,
+        ]
+
+    def convert_strip(self, strip):
+        """Convert a strip to the data type stored in the file"""
+        return strip
+
+    def write_strip(self, setup, timepoint, z_plane, y_start, strip):
+        """Write a strip of a plane to all resolution levels
+
+        Parameters
+        ----------
+        setup : int
+            The setup (i.e. channel) index
+        timepoint : int
+            The timepoint index
+        z_plane : int
+            The z index of the plane
+        y_start : int
+            First row of the strip in the full resolution plane
+        strip : ij.process.ImageProcessor
+            The strip, in the bit depth given to the constructor
+        """
+
+        strip = self.convert_strip(strip)
+        bytes_per_pixel = strip.getBitDepth() / 8
+        for level, factor in enumerate(self.factors):
+            level_width, level_height = self.level_dimensions(factor)[:2]
+            level_y = y_start / factor
+            rows = min(
+                int(math.ceil(strip.getHeight() / float(factor))),
+                level_height - level_y,
+            )
+            level_strip = strip
+            if factor > 1:
+                strip.setInterpolationMethod(ImageProcessor.BILINEAR)
+                level_strip = strip.resize(level_width, rows, True)
+            for block_y in range(0, rows, FUSION_BLOCK_SIZE):
+                block_height = min(FUSION_BLOCK_SIZE, rows - block_y)
+                for block_x in range(0, level_width, FUSION_BLOCK_SIZE):
+                    block_width = min(FUSION_BLOCK_SIZE, level_width - block_x)
+                    level_strip.setRoi(block_x, block_y, block_width, block_height)
+                    self.write_block(
+                        setup,
+                        timepoint,
+                        level,
+                        [
+                            block_x / FUSION_BLOCK_SIZE,
+                            (level_y + block_y) / FUSION_BLOCK_SIZE,
+                            z_plane,
+                        ],
+                        level_strip.crop(),
+                    )
+                    self.bytes_written += block_width * block_height * bytes_per_pixel
+
+
+class BdvHdf5Writer(PyramidStripWriter):
+    """Write a multi-resolution BigDataViewer HDF5 file strip by strip
+
+    The chunks are written compressed straight into the HDF5 container, using
+    the layout BigDataViewer expects. The container only holds 16 bit data: 8
+    bit data is stored with unchanged values, 32 bit data is scaled from
+    `value_range` to the full 16 bit range.
+    """
+
+    def __init__(
+        self,
+        h5_path,
+        width,
+        height,
+        depth,
+        bit_depth,
+        n_setups,
+        n_timepoints,
+        value_range=None,
+    ):
+        PyramidStripWriter.__init__(self, width, height, depth, bit_depth)
+        if bit_depth == 32 and value_range is None:
+            raise ValueError("32 bit data needs a value range to be scaled")
+        self.value_range = value_range
+
+        self.writer = N5HDF5Writer(h5_path, FUSION_BLOCK_SIZE, FUSION_BLOCK_SIZE, 1)
+        self.attributes = {}
+        compression = GzipCompression()
+        levels = len(self.factors)
+        for setup in range(n_setups):
+            self.write_small_dataset(
+                "s%02i/resolutions" % setup,
+                DataType.FLOAT64,
+                [value for factor in self.factors for value in (factor, factor, 1)],
+                levels,
+            )
+            self.write_small_dataset(
+                "s%02i/subdivisions" % setup,
+                DataType.INT32,
+                [FUSION_BLOCK_SIZE, FUSION_BLOCK_SIZE, 1] * levels,
+                levels,
+            )
+            for timepoint in range(n_timepoints):
+                for level, factor in enumerate(self.factors):
+                    dataset = self.dataset_path(setup, timepoint, level)
+                    self.writer.createDataset(
+                        dataset,
+                        jarray.array(self.level_dimensions(factor), "l"),
+                        jarray.array([FUSION_BLOCK_SIZE, FUSION_BLOCK_SIZE, 1], "i"),
+                        DataType.INT16,
+                        compression,
+                    )
+                    self.attributes[dataset] = self.writer.getDatasetAttributes(dataset)
+
+    def write_small_dataset(self, path, data_type, values, rows):
+        """Write a [rows][3] table like the resolutions in a single block"""
+        size = jarray.array([3, rows], "i")
+        self.writer.createDataset(
+            path, jarray.array([3, rows], "l"), size, data_type, RawCompression()
         )
-        IJ.log("As such, no HDF5 resaving or Imaris conversion will be happening.")
-    else:
-        fusion_method = "Linear Blending"
+        if data_type == DataType.FLOAT64:
+            block = DoubleArrayDataBlock(
+                size, jarray.array([0, 0], "l"), jarray.array(values, "d")
+            )
+        else:
+            block = IntArrayDataBlock(
+                size, jarray.array([0, 0], "l"), jarray.array(values, "i")
+            )
+        self.writer.writeBlock(path, self.writer.getDatasetAttributes(path), block)
+
+    def convert_strip(self, strip):
+        """Convert a strip to 16 bit"""
+        if strip.getBitDepth() == 32:
+            strip.setMinAndMax(*self.value_range)
+            return strip.convertToShort(True)
+        return strip.convertToShort(False)
+
+    def dataset_path(self, setup, timepoint, level):
+        """Path of the image data of a setup, timepoint and resolution level"""
+        return "t%05i/s%02i/%i/cells" % (timepoint, setup, level)
+
+    def write_block(self, setup, timepoint, level, grid_position, block):
+        """Write a chunk into the HDF5 file"""
+        dataset = self.dataset_path(setup, timepoint, level)
+        data_block = create_data_block(
+            [block.getWidth(), block.getHeight(), 1], grid_position, block
+        )
+        self.writer.writeBlock(dataset, self.attributes[dataset], data_block)
+
+    def close(self):
+        """Close the HDF5 file"""
+        self.writer.close()
 
-    if individual_series:
-        all_source_dirs = [
-            source_dirs
-            * len(
-                pathtools.listdir_matching(
-                    source_dirs, filetype, fullpath=True, sort=True
+
+class BlockWriteTask(Callable):
+    """Write a single chunk, to be run by an executor"""
+
+    def __init__(self, writer, dataset, attributes, data_block):
+        self.writer = writer
+        self.dataset = dataset
+        self.attributes = attributes
+        self.data_block = data_block
+
+    def call(self):
+        self.writer.writeBlock(self.dataset, self.attributes, self.data_block)
+
+
+class OmeZarrWriter(PyramidStripWriter):
+    """Write a multi-resolution OME-Zarr (NGFF 0.4) image strip by strip
+
+    Every resolution level is a TCZYX array of compressed chunks in the bit
+    depth of the image (8, 16 or 32 bit), which are written by a pool of threads so the disk bandwidth is used
+    while the next strips are being prepared. The number of chunks waiting to
+    be written is limited to keep the memory use bounded.
+    """
+
+    def __init__(
+        self,
+        zarr_path,
+        width,
+        height,
+        depth,
+        bit_depth,
+        n_channels,
+        n_timepoints,
+        calibration,
+        unit,
+        n_threads=None,
+    ):
+        PyramidStripWriter.__init__(self, width, height, depth, bit_depth)
+        self.zarr_path = zarr_path
+        self.n_channels = n_channels
+        self.n_timepoints = n_timepoints
+        self.calibration = calibration
+        self.unit = unit
+
+        n_threads = n_threads or Runtime.getRuntime().availableProcessors()
+        self.executor = Executors.newFixedThreadPool(n_threads)
+        self.max_pending = 4 * n_threads
+        self.pending = []
+
+        # NGFF 0.4 expects "/" separated chunk keys
+        self.writer = N5ZarrWriter(zarr_path, GsonBuilder(), "/")
+        self.attributes = {}
+        compression = GzipCompression()
+        for level, factor in enumerate(self.factors):
+            dataset = str(level)
+            self.writer.createDataset(
+                dataset,
+                jarray.array(
+                    self.level_dimensions(factor) + [n_channels, n_timepoints], "l"
+                ),
+                jarray.array([FUSION_BLOCK_SIZE, FUSION_BLOCK_SIZE, 1, 1, 1], "i"),
+                {8: DataType.UINT8, 16: DataType.UINT16, 32: DataType.FLOAT32}[
+                    bit_depth
+                ],
+                compression,
+            )
+            self.attributes[dataset] = self.writer.getDatasetAttributes(dataset)
+
+    def write_block(self, setup, timepoint, level, grid_position, block):
+        """Queue a chunk for writing by the thread pool"""
+        dataset = str(level)
+        data_block = create_data_block(
+            [block.getWidth(), block.getHeight(), 1, 1, 1],
+            grid_position + [setup, timepoint],
+            block,
+        )
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).get()
+        self.pending.append(
+            self.executor.submit(
+                BlockWriteTask(
+                    self.writer, dataset, self.attributes[dataset], data_block
                 )
             )
-            for source_dirs in all_source_dirs
+        )
+
+    def get_multiscales(self):
+        """Build the NGFF multiscales metadata of the image"""
+        space_axis_unit = {}
+        unit = unicode(self.unit or "")
+        for micro_sign in [unichr(0xB5), unichr(0x3BC)]:
+            unit = unit.replace(micro_sign, "u")
+        if unit in NGFF_UNITS:
+            space_axis_unit["unit"] = NGFF_UNITS[unit]
+        axes = [{"name": "t", "type": "time"}, {"name": "c", "type": "channel"}]
+        for name in ["z", "y", "x"]:
+            axis = {"name": name, "type": "space"}
+            axis.update(space_axis_unit)
+            axes.append(axis)
+
+        size_x, size_y, size_z = [float(value) for value in self.calibration]
+        datasets = []
+        for level, factor in enumerate(self.factors):
+            datasets.append(
+                {
+                    "path": str(level),
+                    "coordinateTransformations": [
+                        {
+                            "type": "scale",
+                            "scale": [
+                                1.0,
+                                1.0,
+                                size_z,
+                                size_y * factor,
+                                size_x * factor,
+                            ],
+                        }
+                    ],
+                }
+            )
+
+        return [
+            {
+                "version": "0.4",
+                "name": os.path.basename(self.zarr_path),
+                "axes": axes,
+                "datasets": datasets,
+            }
         ]
 
-    for dir_index, source_dir in enumerate(all_source_dirs):
-        IJ.log("Now working on " + source_dir)
-        print("bigdata= ", str(bigdata))
-        free_memory_bytes = MemoryTools().totalAvailableMemory()
-        folder_size_bytes = pathtools.folder_size(source_dir)
-        if free_memory_bytes / folder_size_bytes < 3.5:
-            bigdata = True
-            IJ.log("Not enough free RAM, switching to BigData mode (slow)")
+    def close(self):
+        """Wait for all chunks to be written and add the NGFF metadata"""
+        try:
+            for future in self.pending:
+                future.get()
+        finally:
+            self.executor.shutdown()
+        self.pending = []
+        with open(os.path.join(self.zarr_path, ".zattrs"), "w") as zattrs:
+            json.dump({"multiscales": self.get_multiscales()}, zattrs, indent=2)
 
-        all_images = pathtools.listdir_matching(
-            source_dir, filetype, fullpath=True, sort=True
-        )
 
-        ome_stage_metadata = (
-            bf.get_stage_coords(all_images)
-            if not individual_series
-            else bf.get_stage_coords(all_images[dir_index])
-        )
+def write_bdv_xml(xml_path, h5_path, sizes, n_setups, n_timepoints, calibration, unit):
+    """Write the BigDataViewer XML describing a HDF5 file
 
-        # if filetype == "ome.tif":
-        #     write_tileconfig(source_dir, ome_metadata[0], all_images, ome_metadata[1], ome_metadata[2], ome_metadata[3])
-        # else:
-        write_tileconfig(
-            source_dir,
-            ome_stage_metadata.dimensions,
-            ome_stage_metadata.series_names,
-            ome_stage_metadata.relative_coordinates_x,
-            ome_stage_metadata.relative_coordinates_y,
-            ome_stage_metadata.relative_coordinates_z,
-        )
+    Parameters
+    ----------
+    xml_path : str
+        Path of the XML file to write
+    h5_path : str
+        Path of the HDF5 file containing the image data
+    sizes : list of int
+        XYZ size of the full resolution image in px
+    n_setups : int
+        Number of setups, i.e. channels
+    n_timepoints : int
+        Number of timepoints
+    calibration : list of float
+        XYZ pixel size
+    unit : str
+        Unit of the pixel size
+    """
 
-        run_GC_stitcher(
-            source_dir if not individual_series else [all_images[dir_index]],
-            fusion_method,
-            bigdata,
-            quick,
-            reg_threshold,
+    size = " ".join([str(value) for value in sizes])
+    voxel_size = " ".join([str(value) for value in calibration])
+    affine = "%s 0 0 0 0 %s 0 0 0 0 %s 0" % tuple(calibration)
+
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<SpimData version="0.2">',
+        '  <BasePath type="relative">.</BasePath>',
+        "  <SequenceDescription>",
+        '    <ImageLoader format="bdv.hdf5">',
+        '      <hdf5 type="relative">%s</hdf5>' % os.path.basename(h5_path),
+        "    </ImageLoader>",
+        "    <ViewSetups>",
+    ]
+    for setup in range(n_setups):
+        lines += [
+            "      <ViewSetup>",
+            "        <id>%i</id>" % setup,
+            "        <name>channel %i</name>" % (setup + 1),
+            "        <size>%s</size>" % size,
+            "        <voxelSize>",
+            "          <unit>%s</unit>" % unit,
+            "          <size>%s</size>" % voxel_size,
+            "        </voxelSize>",
+            "        <attributes>",
+            "          <channel>%i</channel>" % (setup + 1),
+            "        </attributes>",
+            "      </ViewSetup>",
+        ]
+    lines.append('      <Attributes name="channel">')
+    for setup in range(n_setups):
+        lines.append(
+            "        <Channel><id>%i</id><name>%i</name></Channel>"
+            % (setup + 1, setup + 1)
         )
+    lines += [
+        "      </Attributes>",
+        "    </ViewSetups>",
+        '    <Timepoints type="range">',
+        "      <first>0</first>",
+        "      <last>%i</last>" % (n_timepoints - 1),
+        "    </Timepoints>",
+        "  </SequenceDescription>",
+        "  <ViewRegistrations>",
+    ]
+    for timepoint in range(n_timepoints):
+        for setup in range(n_setups):
+            lines += [
+                '    <ViewRegistration timepoint="%i" setup="%i">' % (timepoint, setup),
+                '      <ViewTransform type="affine">',
+                "        <affine>%s</affine>" % affine,
+                "      </ViewTransform>",
+                "    </ViewRegistration>",
+            ]
+    lines += ["  </ViewRegistrations>", "</SpimData>"]
+
+    with codecs.open(xml_path, "w", "utf-8") as xml_file:
+        xml_file.write("\n".join(lines) + "\n")
+
+
+def list_gc_planes(plane_dir):
+    """Find the planes the Grid/Collection stitcher wrote to a directory
+
+    Parameters
+    ----------
+    plane_dir : str
+        Output directory of the stitcher
+
+    Returns
+    -------
+    dict
+        Path of every plane, keyed by its zero-based (timepoint, channel, z)
+        index
+    """
+
+    planes = {}
+    for name in os.listdir(plane_dir):
+        match = GC_PLANE_NAME.match(name)
+        if match:
+            timepoint, z_plane, channel = [int(value) - 1 for value in match.groups()]
+            planes[(timepoint, channel, z_plane)] = os.path.join(plane_dir, name)
+
+    return planes
+
+
+def get_planes_value_range(paths):
+    """Get the minimum and maximum pixel value of a list of planes
+
+    Parameters
+    ----------
+    paths : list of str
+        Full paths to the plane files
+
+    Returns
+    -------
+    tuple of (float, float)
+        The smallest and the largest value
+    """
+
+    value_min, value_max = None, None
+    for path in paths:
+        plane = IJ.openImage(path).getProcessor()
+        plane.resetMinAndMax()
+        if value_min is None or plane.getMin() < value_min:
+            value_min = plane.getMin()
+        if value_max is None or plane.getMax() > value_max:
+            value_max = plane.getMax()
+
+    return value_min, value_max
+
+
+def write_gc_planes(plane_dir, create_writer):
+    """Write the planes fused by the Grid/Collection stitcher to a pyramid
+
+    In BigData mode the stitcher fuses one plane after the other into
+    `plane_dir`, using the chosen fusion method and the registered (subpixel)
+    positions. Every plane is read once and written strip by strip to all
+    resolution levels of the output file in its original bit depth, so the
+    fused image is never held in RAM nor opened as a virtual stack.
+
+    Parameters
+    ----------
+    plane_dir : str
+        Output directory of the stitcher
+    create_writer : callable
+        Called with the XYZ size, the number of channels and of timepoints,
+        the bit depth and the paths of all planes of the fused image, returns
+        the `PyramidStripWriter` to use
+
+    Returns
+    -------
+    dict
+        Number of bytes read from the planes and written to the file, the XYZ
+        size, the number of channels and the number of timepoints
+    """
+
+    planes = list_gc_planes(plane_dir)
+    if not planes:
+        raise IOError("No fused planes found in " + plane_dir)
+    n_timepoints, n_channels, depth = [
+        max([index[dim] for index in planes]) + 1 for dim in range(3)
+    ]
+    first_plane = IJ.openImage(planes[(0, 0, 0)])
+    width, height = first_plane.getWidth(), first_plane.getHeight()
+    bit_depth = first_plane.getBitDepth()
+    first_plane.close()
+
+    writer = create_writer(
+        [width, height, depth], n_channels, n_timepoints, bit_depth, planes.values()
+    )
+    IJ.log(
+        "writing %ix%ix%i px, %i channel(s), %i timepoint(s) at %i bit"
+        % (width, height, depth, n_channels, n_timepoints, bit_depth)
+    )
+    total_planes = n_timepoints * n_channels * depth
+    bytes_read = 0
+    try:
+        for timepoint in range(n_timepoints):
+            for channel in range(n_channels):
+                for z_plane in range(depth):
+                    IJ.showProgress(
+                        (timepoint * n_channels + channel) * depth + z_plane,
+                        total_planes,
+                    )
+                    path = planes[(timepoint, channel, z_plane)]
+                    plane = IJ.openImage(path).getProcessor()
+                    bytes_read += os.path.getsize(path)
+                    for y_start in range(0, height, writer.strip_height):
+                        plane.setRoi(
+                            0,
+                            y_start,
+                            width,
+                            min(writer.strip_height, height - y_start),
+                        )
+                        writer.write_strip(
+                            channel, timepoint, z_plane, y_start, plane.crop()
+                        )
+    finally:
+        IJ.showProgress(1.0)
+        writer.close()
+
+    return {
+        "bytes_read": bytes_read,
+        "bytes_written": writer.bytes_written,
+        "size": [width, height, depth],
+        "channels": n_channels,
+        "timepoints": n_timepoints,
+    }
+
+
+def write_gc_planes_to_bdv(plane_dir, savepath, calibration, unit):
+    """Write the planes fused by the stitcher to a BigDataViewer HDF5
+
+    See `write_gc_planes` for details. 32 bit planes are read twice, as their
+    value range is needed to scale them to 16 bit.
+
+    Parameters
+    ----------
+    plane_dir : str
+        Output directory of the stitcher
+    savepath : str
+        Path of the BigDataViewer XML to write, the HDF5 file is placed next
+        to it
+    calibration : list of float
+        XYZ pixel size
+    unit : str
+        Unit of the pixel size
+
+    Returns
+    -------
+    dict
+        Number of bytes read from the planes and written to the HDF5 file
+    """
+
+    h5_path = os.path.splitext(savepath)[0] + ".h5"
+    if os.path.exists(h5_path):
+        os.remove(h5_path)
 
-        calibrate_current_image(
-            ome_stage_metadata.image_calibration,
-            ome_stage_metadata.calibration_unit,
+    def create_writer(size, n_channels, n_timepoints, bit_depth, paths):
+        value_range = None
+        if bit_depth == 32:
+            value_range = get_planes_value_range(paths)
+        return BdvHdf5Writer(
+            h5_path, *(size + [bit_depth, n_channels, n_timepoints, value_range])
         )
 
-        if bigdata and not only_register:
-            if not bdv:
-                path = pathtools.join2(source_dir, "temp")
-                open_sequential_gcimages_from_folder(
-                    path, ome_stage_metadata.image_dimensions_czt
-                )
-                calibrate_current_image(
-                    ome_stage_metadata.image_calibration,
-                    ome_stage_metadata.calibration_unit,
-                )
-                path_to_image = save_current_image_as_bdv(
-                    all_images[0], filetype, source_dir
-                )
-                misc.convert_to_imaris(convert_to_ims, path_to_image)
-                shutil.rmtree(path, ignore_errors=True)  # remove temp folder
-            else:
-                path_to_image = save_current_image_as_bdv(
-                    all_images[0], filetype, source_dir
-                )
-                misc.convert_to_imaris(convert_to_ims, path_to_image)
+    written = write_gc_planes(plane_dir, create_writer)
+    write_bdv_xml(
+        savepath,
+        h5_path,
+        written["size"],
+        written["channels"],
+        written["timepoints"],
+        calibration,
+        unit,
+    )
 
-        if not bigdata and not bdv and not only_register:
-            path_to_image = save_current_image_with_BF_as_ics1(
-                all_images[0], filetype, source_dir
-            )
+    return {
+        "bytes_read": written["bytes_read"],
+        "bytes_written": written["bytes_written"],
+    }
 
-        if convert_to_ims:
-            misc.run_imarisconvert(path_to_image)
 
-        # run the garbage collector to clear the memory
-        # Seems to not work in a function and needs to be started several times with waits in between :(
-        IJ.log("collecting garbage...")
-        IJ.run("Collect Garbage", "")
-        time.sleep(60.0)
-        IJ.run("Collect Garbage", "")
-        time.sleep(60.0)
-        IJ.run("Collect Garbage", "")
-        time.sleep(60.0)
+def write_gc_planes_to_ome_zarr(plane_dir, savepath, calibration, unit):
+    """Write the planes fused by the stitcher to an OME-Zarr
+
+    See `write_gc_planes` for details.
+
+    Parameters
+    ----------
+    plane_dir : str
+        Output directory of the stitcher
+    savepath : str
+        Path of the .ome.zarr folder to write
+    calibration : list of float
+        XYZ pixel size
+    unit : str
+        Unit of the pixel size
+
+    Returns
+    -------
+    dict
+        Number of bytes read from the planes and written to the OME-Zarr
+    """
 
-    total_execution_time_min = misc.elapsed_time_since(execution_start_time)
+    if os.path.exists(savepath):
+        shutil.rmtree(savepath)
 
-    if email_address:
-        misc.send_notification_email(
-            "Stitching script", email_address, source, total_execution_time_min
+    def create_writer(size, n_channels, n_timepoints, bit_depth, paths):
+        return OmeZarrWriter(
+            savepath, *(size + [bit_depth, n_channels, n_timepoints, calibration, unit])
         )
-    else:
-        print("Email address field is empty, no email was sent")
-
-    # update the log
-    IJ.log("##### summary #####")
-    IJ.log("number of folders stitched: " + str(len(all_source_dirs)))
-    IJ.log("quick stitch by stage coordinates: " + str(quick))
-    IJ.log("save as BigDataViewer hdf5 instead: " + str(bdv))
-    IJ.log("conserve RAM= " + str(bigdata))
-    IJ.log("total time in [HH:MM:SS:ss]: " + str(total_execution_time_min))
-    IJ.log("All done")
-    IJ.selectWindow("Log")
-    IJ.saveAs("Text", os.path.join(source, "stitch_log"))
+
+    written = write_gc_planes(plane_dir, create_writer)
+
+    return {
+        "bytes_read": written["bytes_read"],
+        "bytes_written": written["bytes_written"],
+    }
+
+
+def save_current_image_as_ome_zarr(filename, filetype, target, calibration, unit):
+    """Save the currently active image as a multi-resolution OME-Zarr
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the image
+    filetype : str
+        The original filetype of the image
+    target : str
+        Directory where the image will be saved
+    calibration : list of float
+        XYZ pixel size
+    unit : str
+        Unit of the pixel size
+
+    Returns
+    -------
+    str
+        Path to save the data
+    """
+
+    imp = wm.getCurrentImage()
+    savename = filename.replace(filetype, "_stitched.ome.zarr")
+    savepath = os.path.join(target, savename)
+    IJ.log("now saving: " + str(savepath))
+    if os.path.exists(savepath):
+        shutil.rmtree(savepath)
+
+    n_channels, depth, n_timepoints = (
+        imp.getNChannels(),
+        imp.getNSlices(),
+        imp.getNFrames(),
+    )
+    writer = OmeZarrWriter(
+        savepath,
+        imp.getWidth(),
+        imp.getHeight(),
+        depth,
+        imp.getBitDepth(),
+        n_channels,
+        n_timepoints,
+        calibration,
+        unit,
+    )
+    stack = imp.getStack()
+    try:
+        for timepoint in range(n_timepoints):
+            for channel in range(n_channels):
+                for z_plane in range(depth):
+                    plane = stack.getProcessor(
+                        imp.getStackIndex(channel + 1, z_plane + 1, timepoint + 1)
+                    )
+                    for y_start in range(0, imp.getHeight(), writer.strip_height):
+                        plane.setRoi(
+                            0,
+                            y_start,
+                            imp.getWidth(),
+                            min(writer.strip_height, imp.getHeight() - y_start),
+                        )
+                        writer.write_strip(
+                            channel, timepoint, z_plane, y_start, plane.crop()
+                        )
+    finally:
+        writer.close()
+    imp.close()
+
+    return savepath
+
+
+def close_all_images():
+    """Close all images currently known to the WindowManager
+
+    Images are closed without asking to save any changes.
+
+    Returns
+    -------
+    int
+        Number of images that have been closed
+    """
+
+    image_ids = wm.getIDList()
+    if not image_ids:
+        return 0
+
+    for image_id in image_ids:
+        imp = wm.getImage(image_id)
+        if imp is None:
+            continue
+        imp.changes = False
+        imp.close()
+
+    return len(image_ids)
+
+
+def reclaim_memory(target_fraction, timeout, poll_interval=2.0):
+    """Free up RAM until a target share of the max heap is available
+
+    Leftover images are closed first, then the garbage collector is called
+    repeatedly until `MemoryTools().totalAvailableMemory()` reaches the target
+    or the timeout has passed. This replaces fixed waits after each folder, so
+    the next one starts as soon as the memory has actually been released.
+
+    Parameters
+    ----------
+    target_fraction : float
+        Share of the maximum heap size that should be available, e.g. 0.8
+    timeout : float
+        Maximum time to wait for the target to be reached, in seconds
+    poll_interval : float, optional
+        Time between two garbage collection attempts, in seconds, by default 2
+
+    Returns
+    -------
+    dict
+        Available bytes before and after, the number of closed images, the
+        time waited in seconds and whether the target has been reached
+    """
+
+    start_time = time.time()
+    available_before = MemoryTools().totalAvailableMemory()
+    target_bytes = Runtime.getRuntime().maxMemory() * target_fraction
+
+    closed_images = close_all_images()
+
+    IJ.run("Collect Garbage", "")
+    available = MemoryTools().totalAvailableMemory()
+    while available < target_bytes and time.time() - start_time < timeout:
+        time.sleep(poll_interval)
+        IJ.run("Collect Garbage", "")
+        available = MemoryTools().totalAvailableMemory()
+
+    waited = time.time() - start_time
+    target_reached = available >= target_bytes
+
+    IJ.log(
+        "reclaimed %.0f MB in %.1f s (closed %i images), %.0f MB available"
+        % (
+            (available - available_before) / 1024.0**2,
+            waited,
+            closed_images,
+            available / 1024.0**2,
+        )
+    )
+    if not target_reached:
+        IJ.log(
+            "RAM target of %.0f MB not reached within %i s, continuing anyway"
+            % (target_bytes / 1024.0**2, timeout)
+        )
+
+    return {
+        "available_before": available_before,
+        "available_after": available,
+        "closed_images": closed_images,
+        "waited": waited,
+        "target_reached": target_reached,
+    }
+
+
+def get_used_heap():
+    """Get the heap currently in use by the JVM
+
+    Returns
+    -------
+    long
+        Used heap in bytes
+    """
+
+    runtime = Runtime.getRuntime()
+    return runtime.totalMemory() - runtime.freeMemory()
+
+
+def get_files_size(paths):
+    """Get the total size of files, ignoring missing ones
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths of the files, folders (like OME-Zarr) are counted recursively
+
+    Returns
+    -------
+    long
+        Sum of the file sizes in bytes
+    """
+
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                total += get_files_size(
+                    [os.path.join(root, filename) for filename in filenames]
+                )
+
+    return total
+
+
+class HeapSampler(object):
+    """Track the peak heap usage in a background thread"""
+
+    def __init__(self, interval=HEAP_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = get_used_heap()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="heap-sampler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        """Sample the used heap until `stop` is called"""
+        while not self.stopped.isSet():
+            self.peak = max(self.peak, get_used_heap())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the peak heap usage in bytes"""
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak, get_used_heap())
+
+
+class StageProfiler(object):
+    """Measure the stages of the stitching of a folder
+
+    Each stage records its wall time, the sampled peak heap and, where they
+    are known, the bytes read and written. The latter are set on the dict
+    returned when entering the stage, together with "bytes_estimated" when
+    they are derived from file sizes instead of being counted while reading
+    or writing, e.g. for the stages run by the Grid/Collection stitcher.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run within the context as stage `name`"""
+        record = {
+            "stage": name,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "bytes_estimated": False,
+        }
+        sampler = HeapSampler()
+        start_time = time.time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.time() - start_time
+            record["peak_heap"] = sampler.stop()
+            self.stages.append(record)
+
+
+def get_conversion_stage(conversion):
+    """Describe a finished Imaris conversion like a measured stage
+
+    Parameters
+    ----------
+    conversion : dict
+        The conversion job, see `create_conversion_job`
+
+    Returns
+    -------
+    dict
+        The stage, ImarisConvert running as a separate process its heap is
+        unknown and its bytes are the sizes of the input and output files
+    """
+
+    return {
+        "stage": "imaris_conversion",
+        "wall_time": conversion["duration"],
+        "peak_heap": None,
+        "bytes_read": conversion.get("bytes_read", 0),
+        "bytes_written": conversion.get("bytes_written", 0),
+        "bytes_estimated": True,
+        "status": conversion["status"],
+    }
+
+
+def append_stage_record(log_path, run_start, result, stages):
+    """Append the stage measurements of a folder to a JSON-lines file
+
+    Records are appended as soon as a folder is finished, so a run that gets
+    killed still leaves the measurements of the folders done until then.
+
+    Parameters
+    ----------
+    log_path : str
+        Path to the JSON-lines file, one record per folder and run
+    run_start : float
+        Start time of the run, identifying its records
+    result : dict
+        Summary of the folder as returned by `stitch_directory`
+    stages : list of dict
+        The stages to record
+    """
+
+    record = OrderedDict(
+        [
+            (
+                "run_start",
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run_start)),
+            ),
+            ("source_dir", result["source_dir"]),
+            ("series_file", result.get("series_file")),
+            ("status", result["status"]),
+            ("bigdata", result["bigdata"]),
+            ("duration", result["duration"]),
+            ("stages", stages),
+        ]
+    )
+    with open(log_path, "a") as stage_log:
+        stage_log.write(json.dumps(record) + "\n")
+
+
+class CachedStageMetadata(object):
+    """Stage metadata restored from the sidecar cache of a folder
+
+    Provides the same attributes as the results of `bf.get_stage_coords` that
+    are listed in STAGE_METADATA_FIELDS.
+    """
+
+    def __init__(self, fields):
+        for key in STAGE_METADATA_FIELDS:
+            setattr(self, key, fields[key])
+
+
+def to_json_value(value):
+    """Convert a (Java) metadata value to something JSON can serialize
+
+    Parameters
+    ----------
+    value : object
+        Value to convert, lists and tuples are converted recursively
+
+    Returns
+    -------
+    object
+        The value as a list, number or string
+    """
+
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, (list, tuple)) or hasattr(value, "__iter__"):
+        return [to_json_value(item) for item in value]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def write_json_atomically(path, data):
+    """Write data to a JSON file without leaving a truncated file behind
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file
+    data : object
+        Data to serialize
+    """
+
+    # worker processes share the cache files, so every writer needs its own
+    # temporary file
+    handle, tmp_path = tempfile.mkstemp(
+        suffix=".tmp", prefix=os.path.basename(path), dir=os.path.dirname(path)
+    )
+    os.close(handle)
+    with open(tmp_path, "w") as json_file:
+        json.dump(data, json_file, indent=2)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.remove(path)  # os.rename can't replace files on Windows
+        os.rename(tmp_path, path)
+
+
+def get_files_fingerprint(filenames):
+    """Build a key identifying a list of files by name, size and mtime
+
+    Parameters
+    ----------
+    filenames : list of str
+        Full paths to the files
+
+    Returns
+    -------
+    str
+        Key that changes as soon as one of the files is added, removed or
+        modified
+    """
+
+    return "|".join(
+        [
+            "%s:%i:%.3f"
+            % (os.path.basename(f), os.path.getsize(f), os.path.getmtime(f))
+            for f in filenames
+        ]
+    )
+
+
+def get_stage_coords_cached(source_dir, filenames):
+    """Get the stage metadata of tiles, using a sidecar cache in the folder
+
+    Reading the full OME metadata of all tiles can take minutes, so the
+    relevant parts of the `bf.get_stage_coords` result are stored in a JSON
+    file keyed by the name, size and modification time of the tiles. A
+    repeated run on unchanged files skips Bio-Formats entirely.
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles, where the cache file is stored
+    filenames : str or list of str
+        Full path(s) to the tiles, passed on to `bf.get_stage_coords`
+
+    Returns
+    -------
+    object
+        Stage metadata, either the result of `bf.get_stage_coords` or a
+        CachedStageMetadata instance with the same attributes
+    """
+
+    cache_path = os.path.join(source_dir, STAGE_METADATA_CACHE)
+    file_list = [filenames] if isinstance(filenames, basestring) else filenames
+    key = get_files_fingerprint(file_list)
+
+    cache = {}
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+        except ValueError:
+            IJ.log("Ignoring corrupt metadata cache: " + cache_path)
+
+    if key in cache:
+        IJ.log("Using cached stage metadata from " + cache_path)
+        return CachedStageMetadata(cache[key])
+
+    stage_metadata = bf.get_stage_coords(filenames)
+    cache[key] = dict(
+        [
+            (field, to_json_value(getattr(stage_metadata, field)))
+            for field in STAGE_METADATA_FIELDS
+        ]
+    )
+    try:
+        write_json_atomically(cache_path, cache)
+    except (IOError, OSError) as err:
+        IJ.log("Unable to write metadata cache: %s" % err)
+
+    return stage_metadata
+
+
+def get_tile_geometry(path, series=0):
+    """Get the decoded size and bit depth of a tile from its file header
+
+    Parameters
+    ----------
+    path : str
+        Full path to the tile (or the multi-series file)
+    series : int, optional
+        Series to look at, by default 0
+
+    Returns
+    -------
+    dict
+        The XY size in px and the number of bytes per pixel
+    """
+
+    reader = ImageReader()
+    reader.setGroupFiles(False)
+    reader.setId(path)
+    try:
+        reader.setSeries(series)
+        return {
+            "size_x": reader.getSizeX(),
+            "size_y": reader.getSizeY(),
+            "bytes_per_pixel": FormatTools.getBytesPerPixel(reader.getPixelType()),
+        }
+    finally:
+        reader.close()
+
+
+def plan_stitching_memory(stage_metadata, geometry):
+    """Predict the peak RAM needed to stitch a mosaic
+
+    The prediction uses the decoded pixel data instead of the file sizes, so
+    compressed formats are accounted for correctly. In RAM mode, the
+    Grid/Collection stitcher holds all tiles, the fused image and a 32 bit
+    working copy of one fused channel. In BigData mode the peak is either the
+    registration of tile pairs on all cores (as 32 bit) or the plane-wise
+    fusion of the stitcher.
+
+    Parameters
+    ----------
+    stage_metadata : object
+        Stage metadata as returned by `get_stage_coords_cached`
+    geometry : dict
+        Tile size and bit depth as returned by `get_tile_geometry`
+
+    Returns
+    -------
+    dict
+        Number of tiles, the fused XYZ extent in px, the raw data size and the
+        predicted peak RAM of the RAM and the BigData mode, all in bytes
+    """
+
+    size_c, size_z, size_t = [
+        int(value) for value in stage_metadata.image_dimensions_czt
+    ]
+    size_x = geometry["size_x"]
+    size_y = geometry["size_y"]
+    bytes_per_pixel = geometry["bytes_per_pixel"]
+    n_tiles = len(stage_metadata.relative_coordinates_x)
+
+    def extent(coordinates, tile_size):
+        return int(math.ceil(max(coordinates) - min(coordinates))) + tile_size
+
+    extent_x = extent(stage_metadata.relative_coordinates_x, size_x)
+    extent_y = extent(stage_metadata.relative_coordinates_y, size_y)
+    extent_z = size_z
+    if stage_metadata.dimensions == 3:
+        extent_z = extent(stage_metadata.relative_coordinates_z, size_z)
+
+    tile_plane = size_x * size_y
+    data_bytes = n_tiles * tile_plane * size_z * size_c * size_t * bytes_per_pixel
+    fused_voxels = extent_x * extent_y * extent_z
+    ram_peak = (
+        data_bytes + fused_voxels * size_c * size_t * bytes_per_pixel + fused_voxels * 4
+    )
+
+    threads = Runtime.getRuntime().availableProcessors()
+    registration_peak = min(n_tiles, threads) * 2 * tile_plane * size_z * 4
+    # one plane of every tile and the fused plane, which is read back later
+    fusion_peak = (n_tiles * tile_plane + 2 * extent_x * extent_y) * bytes_per_pixel
+
+    return {
+        "tiles": n_tiles,
+        "extent": [extent_x, extent_y, extent_z],
+        "data_bytes": data_bytes,
+        "ram_peak": int(ram_peak * RAM_SAFETY_FACTOR),
+        "bigdata_peak": int(max(registration_peak, fusion_peak) * RAM_SAFETY_FACTOR),
+    }
+
+
+def choose_stitching_mode(plan, available_bytes):
+    """Pick the stitching mode for a folder based on its memory plan
+
+    Parameters
+    ----------
+    plan : dict
+        Memory plan as returned by `plan_stitching_memory`
+    available_bytes : long
+        RAM available for stitching
+
+    Returns
+    -------
+    str
+        "RAM" if the in-memory stitching fits, "BigData" otherwise
+    """
+
+    return "RAM" if plan["ram_peak"] <= available_bytes else "BigData"
+
+
+def get_job_images(source_dir, filetype, series_file=None):
+    """List the images stitched together by a job
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    filetype : str
+        Extension of the tiles, including the leading dot
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+        (stitch all files of the directory together)
+
+    Returns
+    -------
+    list of str
+        Full paths of the images
+    """
+
+    if series_file:
+        return [series_file]
+    return pathtools.listdir_matching(source_dir, filetype, fullpath=True, sort=True)
+
+
+def get_tileconfig_name(series_file=None):
+    """Get the name of the TileConfiguration file of a job
+
+    Multi-series files stitched individually each need their own file, as they
+    may be processed concurrently in the same directory.
+
+    Parameters
+    ----------
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    str
+        Name of the file, the registered positions are written to the same
+        name ending in ".registered.txt"
+    """
+
+    if not series_file:
+        return "TileConfiguration.txt"
+    basename = os.path.splitext(os.path.basename(series_file))[0]
+    return basename + "_TileConfiguration.txt"
+
+
+def plan_directory(source_dir, filetype, series_file=None):
+    """Build the memory plan of a folder from its metadata
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    filetype : str
+        Extension of the tiles, including the leading dot
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    dict
+        Memory plan as returned by `plan_stitching_memory`
+    """
+
+    images = get_job_images(source_dir, filetype, series_file)
+    stage_metadata = get_stage_coords_cached(source_dir, images)
+
+    return plan_stitching_memory(stage_metadata, get_tile_geometry(images[0]))
+
+
+def report_memory_plans(jobs, filetype, available_bytes, report_path):
+    """Log the memory plans of all folders and save them as CSV (dry-run)
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        Directory and multi-series file (or None) of each job to plan
+    filetype : str
+        Extension of the tiles, including the leading dot
+    available_bytes : long
+        RAM available for stitching a folder
+    report_path : str
+        Path of the CSV report
+    """
+
+    gigabyte = 1024.0**3
+    IJ.log("memory plan, %.1f GB available:" % (available_bytes / gigabyte))
+    lines = [
+        "folder,tiles,extent_x,extent_y,extent_z,data_GB,ram_peak_GB,bigdata_peak_GB,mode"
+    ]
+    for source_dir, series_file in jobs:
+        plan = plan_directory(source_dir, filetype, series_file)
+        mode = choose_stitching_mode(plan, available_bytes)
+        values = (
+            [series_file or source_dir, plan["tiles"]]
+            + plan["extent"]
+            + [
+                "%.2f" % (plan["data_bytes"] / gigabyte),
+                "%.2f" % (plan["ram_peak"] / gigabyte),
+                "%.2f" % (plan["bigdata_peak"] / gigabyte),
+                mode,
+            ]
+        )
+        lines.append(",".join([str(value) for value in values]))
+        IJ.log(
+            "%s: %i tiles, %s px, RAM mode %.1f GB, BigData mode %.1f GB -> %s"
+            % (
+                series_file or source_dir,
+                plan["tiles"],
+                "x".join([str(value) for value in plan["extent"]]),
+                plan["ram_peak"] / gigabyte,
+                plan["bigdata_peak"] / gigabyte,
+                mode,
+            )
+        )
+        if mode == "BigData" and plan["bigdata_peak"] > available_bytes:
+            IJ.log("WARNING: even the BigData mode is predicted to run out of RAM")
+
+    with open(report_path, "w") as report:
+        report.write("\n".join(lines) + "\n")
+    IJ.log("memory plan saved to " + report_path)
+
+
+def load_manifest(manifest_path):
+    """Load the run manifest of a source directory
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the manifest file
+
+    Returns
+    -------
+    dict
+        The manifest entries, keyed by folder (see `get_manifest_key`). Empty
+        if there is no (readable) manifest yet.
+    """
+
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except ValueError:
+        IJ.log("Ignoring corrupt manifest: " + manifest_path)
+        return {}
+
+
+def get_manifest_key(source_dir, series_file=None):
+    """Get the key of a folder (or a file within it) in the run manifest
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    str
+        The manifest key
+    """
+
+    if not series_file:
+        return source_dir
+    return "%s#%s" % (source_dir, os.path.basename(series_file))
+
+
+def get_output_files(path_to_image, convert_to_ims):
+    """List all files making up a stitching result
+
+    Parameters
+    ----------
+    path_to_image : str
+        Path of the saved image (.ids, BDV .xml or .ome.zarr folder)
+    convert_to_ims : bool
+        Whether an Imaris file is created from the image
+
+    Returns
+    -------
+    list of str
+        The image file, its companion file and the Imaris file
+    """
+
+    if path_to_image.endswith(".ome.zarr"):
+        # not converted to Imaris, see `stitch_directory`
+        return [path_to_image]
+
+    base = os.path.splitext(path_to_image)[0]
+    outputs = [path_to_image]
+    if path_to_image.endswith(".ids"):
+        outputs.append(base + ".ics")
+    elif path_to_image.endswith(".xml"):
+        outputs.append(base + ".h5")
+    if convert_to_ims:
+        outputs.append(base + ".ims")
+
+    return outputs
+
+
+def get_expected_outputs(source_dir, first_image, filetype, params, series_file=None):
+    """List the outputs a folder produces, for cleaning up after a crash
+
+    Only the format selected by the parameters is listed. Without BigData,
+    BigDataViewer or OME-Zarr output, the BigDataViewer files are listed as
+    well, as `stitch_directory` switches to BigData mode if RAM is short.
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    first_image : str
+        Path to the first tile, the outputs are named after it
+    filetype : str
+        Extension of the tiles, including the leading dot
+    params : dict
+        Parameters of the run, as recorded in the manifest
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    list of str
+        Paths of the outputs
+    """
+
+    registered_name = get_tileconfig_name(series_file).replace(
+        ".txt", ".registered.txt"
+    )
+    if params["only_register"]:
+        return [os.path.join(source_dir, registered_name)]
+
+    if params["ome_zarr"]:
+        suffixes = ["_stitched.ome.zarr"]
+    elif params["bdv"] or params["bigdata"]:
+        suffixes = ["_stitched.xml"]
+    else:
+        suffixes = ["_stitched.ids", "_stitched.xml"]
+    outputs = []
+    for suffix in suffixes:
+        outputs += get_output_files(
+            os.path.join(source_dir, first_image.replace(filetype, suffix)),
+            params["convert_to_ims"],
+        )
+
+    return outputs
+
+
+def is_up_to_date(entry, fingerprint, run_params):
+    """Check if a manifest entry covers the current inputs and parameters
+
+    Parameters
+    ----------
+    entry : dict or None
+        The manifest entry of the folder
+    fingerprint : str
+        Fingerprint of the current input files
+    run_params : dict
+        Parameters of the current run
+
+    Returns
+    -------
+    bool
+        True if the folder has been finished with the same inputs and
+        parameters and all of its outputs still exist
+    """
+
+    return bool(
+        entry
+        and entry["status"] == "done"
+        and entry["fingerprint"] == fingerprint
+        and entry["params"] == run_params
+        and all([os.path.exists(output) for output in entry["outputs"]])
+    )
+
+
+def remove_outputs(outputs, started=None):
+    """Remove leftovers of an interrupted folder
+
+    Parameters
+    ----------
+    outputs : list of str
+        Paths to remove, missing ones are ignored
+    started : float, optional
+        Start time of the interrupted run, older outputs were written by an
+        earlier run and are kept, by default None (remove all)
+    """
+
+    for output in outputs:
+        if started and os.path.exists(output) and os.path.getmtime(output) < started:
+            IJ.log("keeping output of an earlier run: " + output)
+        elif os.path.isdir(output):
+            shutil.rmtree(output, ignore_errors=True)
+        elif os.path.isfile(output):
+            IJ.log("removing incomplete output: " + output)
+            os.remove(output)
+
+
+def create_conversion_job(path_to_image, key):
+    """Describe the conversion of an image to Imaris5
+
+    Parameters
+    ----------
+    path_to_image : str
+        Path of the saved image (.ids or BDV .xml)
+    key : str
+        Manifest key of the folder the image belongs to
+
+    Returns
+    -------
+    dict
+        The job, its status being updated while it is processed
+    """
+
+    return {
+        "path": path_to_image,
+        "key": key,
+        "status": "queued",
+        "exit_code": None,
+        "duration": None,
+        "bytes_read": 0,
+        "bytes_written": 0,
+    }
+
+
+def run_imarisconvert(job):
+    """Convert an image to Imaris5 and store the outcome in the job
+
+    Same conversion as `misc.run_imarisconvert`, which doesn't report the exit
+    code of ImarisConvert.
+
+    Parameters
+    ----------
+    job : dict
+        The conversion job, see `create_conversion_job`
+
+    Returns
+    -------
+    dict
+        The job, with its status set to "done" or "failed"
+    """
+
+    start_time = time.time()
+    job["status"] = "running"
+    path_root, file_extension = os.path.splitext(job["path"])
+    if file_extension == ".ids":
+        # ImarisConvert needs the .ics of the pair
+        file_extension = ".ics"
+    command = 'ImarisConvert.exe -i "%s" -of Imaris5 -o "%s"' % (
+        path_root + file_extension,
+        path_root + ".ims",
+    )
+    IJ.log("Converting to Imaris5 .ims: " + job["path"])
+    try:
+        job["exit_code"] = subprocess.call(
+            command, shell=True, cwd=misc.locate_latest_imaris()
+        )
+    except (OSError, JavaException) as err:
+        IJ.log("Unable to run ImarisConvert: %s" % err)
+    job["duration"] = time.time() - start_time
+    job["bytes_read"] = get_files_size(get_output_files(job["path"], False))
+    job["bytes_written"] = get_files_size([path_root + ".ims"])
+    job["status"] = "done" if job["exit_code"] == 0 else "failed"
+    IJ.log(
+        "Conversion to .ims %s (exit code %s): %s"
+        % (
+            "finished" if job["status"] == "done" else "FAILED",
+            job["exit_code"],
+            job["path"],
+        )
+    )
+
+    return job
+
+
+class ImarisConversionQueue(object):
+    """Convert images to Imaris5 in a background thread
+
+    Jobs are converted one after the other while the main thread continues
+    with the next folder. Submitting blocks while `max_pending` jobs are
+    already waiting, so the conversions can't fall behind indefinitely.
+    """
+
+    def __init__(self, max_pending, on_finished=None):
+        self.jobs = []
+        self.on_finished = on_finished
+        self.queue = Queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.run, name="imaris-conversion")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def submit(self, job):
+        """Add a job to the queue, waiting if the queue is full"""
+        self.jobs.append(job)
+        self.queue.put(job)
+
+    def run(self):
+        """Process the jobs until `wait` is called"""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            run_imarisconvert(job)
+            if self.on_finished:
+                self.on_finished(job)
+
+    def outstanding(self):
+        """Get the jobs not finished yet"""
+        return [job for job in self.jobs if job["status"] in ["queued", "running"]]
+
+    def wait(self):
+        """Wait for all submitted jobs and stop the background thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def read_preview_plane(path, series, binning):
+    """Read a max projection of a tile at a reduced resolution
+
+    The pyramid level of the file closest to (but not beyond) the requested
+    binning is read if the format has one, the remaining factor is binned on
+    the fly. All channels and z-planes of the first timepoint are projected.
+
+    Parameters
+    ----------
+    path : str
+        Full path to the tile (or the multi-series file)
+    series : int
+        Series of the tile in the file
+    binning : int
+        Requested downscaling factor
+
+    Returns
+    -------
+    tuple of (ij.process.FloatProcessor, float, long)
+        The projection, the actual downscaling factor and the number of bytes
+        read
+    """
+
+    reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+    reader.setFlattenedResolutions(False)
+    reader.setId(path)
+    try:
+        reader.setSeries(series)
+        full_width = reader.getSizeX()
+        level = 0
+        for resolution in range(1, reader.getResolutionCount()):
+            reader.setResolution(resolution)
+            if full_width / float(reader.getSizeX()) > binning:
+                break
+            level = resolution
+        reader.setResolution(level)
+        remaining = max(1, int(round(binning * reader.getSizeX() / float(full_width))))
+
+        projection = None
+        bytes_read = 0
+        for channel in range(reader.getSizeC()):
+            for z_plane in range(reader.getSizeZ()):
+                plane = reader.openProcessors(reader.getIndex(z_plane, channel, 0))[0]
+                bytes_read += plane.getPixelCount() * plane.getBitDepth() / 8
+                plane = plane.convertToFloat()
+                if projection is None:
+                    projection = plane
+                else:
+                    projection.copyBits(plane, 0, 0, Blitter.MAX)
+    finally:
+        reader.close()
+
+    if remaining > 1:
+        projection.setInterpolationMethod(ImageProcessor.BILINEAR)
+        projection = projection.resize(
+            projection.getWidth() / remaining,
+            projection.getHeight() / remaining,
+            True,
+        )
+
+    return projection, full_width / float(projection.getWidth()), bytes_read
+
+
+def get_stage_tiles(all_images, stage_metadata, series_file=None):
+    """Combine the images of a job with their stage positions
+
+    Parameters
+    ----------
+    all_images : list of str
+        Full paths of the images, see `get_job_images`
+    stage_metadata : object
+        Stage metadata as returned by `get_stage_coords_cached`
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    list of dict
+        One dict per tile like the ones of `read_tileconfig`, the series being
+        None for single-series files
+    """
+
+    n_tiles = len(stage_metadata.relative_coordinates_x)
+    z_coordinates = stage_metadata.relative_coordinates_z or [0.0] * n_tiles
+    tiles = []
+    for index in range(n_tiles):
+        tiles.append(
+            {
+                "path": series_file or all_images[index],
+                "series": index if series_file else None,
+                "x": float(stage_metadata.relative_coordinates_x[index]),
+                "y": float(stage_metadata.relative_coordinates_y[index]),
+                "z": float(z_coordinates[index]),
+            }
+        )
+
+    return tiles
+
+
+def measure_shift(imp1, imp2, dimensionality):
+    """Measure the shift between two images by phase correlation
+
+    Parameters
+    ----------
+    imp1 : ij.ImagePlus
+        The reference image
+    imp2 : ij.ImagePlus
+        The image to align to the reference
+    dimensionality : int
+        2 for single planes, 3 for stacks
+
+    Returns
+    -------
+    tuple of (list of float, float)
+        The x, y, z position of `imp2` relative to `imp1` in px and the cross
+        correlation of the overlapping parts
+    """
+
+    params = StitchingParameters()
+    params.dimensionality = dimensionality
+    params.checkPeaks = CHECK_PEAKS
+    params.computeOverlap = True
+    params.subpixelAccuracy = True
+    params.channel1 = 0
+    params.channel2 = 0
+    result = PairWiseStitchingImgLib.stitchPairwise(
+        imp1, imp2, None, None, 1, 1, params
+    )
+    offset = [float(value) for value in result.getOffset()]
+    if len(offset) == 2:
+        offset.append(0.0)
+
+    return offset, result.getCrossCorrelation()
+
+
+def read_tile_window(tile_reader, tile, x, y, width, height):
+    """Read a window of a tile over all z-planes, projecting the channels
+
+    Parameters
+    ----------
+    tile_reader : TileReader
+        Reader giving access to the tiles
+    tile : dict
+        The tile, see `read_tileconfig`
+    x, y, width, height : int
+        The window in px
+
+    Returns
+    -------
+    ij.ImagePlus
+        32 bit stack of the window, the max projection of all channels of the
+        first timepoint
+    """
+
+    tile = {"path": tile["path"], "series": tile["series"] or 0}
+    reader = tile_reader.get_reader(tile["path"], tile["series"])
+    stack = ImageStack(width, height)
+    for z_plane in range(reader.getSizeZ()):
+        projection = None
+        for channel in range(reader.getSizeC()):
+            window = tile_reader.get_window(
+                tile, channel, z_plane, 0, x, y, width, height
+            ).convertToFloat()
+            if projection is None:
+                projection = window
+            else:
+                projection.copyBits(window, 0, 0, Blitter.MAX)
+        stack.addSlice(projection)
+
+    return ImagePlus("window", stack)
+
+
+def get_refine_windows(shift, tile_size, margin):
+    """Get the windows covering the predicted overlap of two tiles
+
+    Parameters
+    ----------
+    shift : list of float
+        Predicted x, y position of the second tile relative to the first one
+    tile_size : tuple
+        The x, y size of the tiles in px
+    margin : int
+        Search margin added around the overlap, in px
+
+    Returns
+    -------
+    tuple of (list of int, list of int) or None
+        The x, y, width, height of the window in the first and in the second
+        tile, None if the tiles don't overlap by a usable amount
+    """
+
+    windows = ([], [])
+    for axis in range(2):
+        size = tile_size[axis]
+        start = max(0.0, shift[axis]) - margin
+        end = min(size, shift[axis] + size) + margin
+        first = (max(0, int(start)), min(size, int(math.ceil(end))))
+        second = (
+            max(0, int(start - shift[axis])),
+            min(size, int(math.ceil(end - shift[axis]))),
+        )
+        if min(first[1] - first[0], second[1] - second[0]) < 2 * CHECK_PEAKS:
+            return None
+        windows[0].append(first)
+        windows[1].append(second)
+
+    return tuple(
+        [
+            [
+                window[0][0],
+                window[1][0],
+                window[0][1] - window[0][0],
+                window[1][1] - window[1][0],
+            ]
+            for window in windows
+        ]
+    )
+
+
+def measure_refined_shift(
+    tile_reader, tiles, pair, shift, tile_size, margin, dimensionality
+):
+    """Measure the shift of two tiles at full resolution in their overlap
+
+    Only the overlap predicted by `shift` plus `margin` is read from both
+    tiles (all z-planes for 3D stacks).
+
+    Parameters
+    ----------
+    tile_reader : TileReader
+        Reader giving access to the tiles
+    tiles : list of dict
+        The tiles, see `read_tileconfig`
+    pair : tuple of int
+        Indices (i, j) of the two tiles
+    shift : list of float
+        Predicted x, y position of tile j relative to tile i
+    tile_size : tuple
+        The x, y size of the tiles in px
+    margin : int
+        Search margin added around the overlap, in px
+    dimensionality : int
+        Number of dimensions (2D or 3D)
+
+    Returns
+    -------
+    tuple of (list of float, float) or None
+        The measured x, y, z position of tile j relative to tile i and the
+        cross correlation, None if the tiles don't overlap by a usable amount
+    """
+
+    windows = get_refine_windows(shift, tile_size, margin)
+    if not windows:
+        return None
+    window1, window2 = windows
+    offset, correlation = measure_shift(
+        read_tile_window(tile_reader, tiles[pair[0]], *window1),
+        read_tile_window(tile_reader, tiles[pair[1]], *window2),
+        dimensionality,
+    )
+    measured = [
+        window1[0] - window2[0] + offset[0],
+        window1[1] - window2[1] + offset[1],
+        offset[2] if dimensionality == 3 else 0.0,
+    ]
+
+    return measured, correlation
+
+
+def solve_tile_positions(initial, links):
+    """Find the tile positions best agreeing with the pairwise shifts
+
+    Runs the global optimization of the Grid/Collection stitcher: every tile
+    gets an mpicbg translation model, every link a point match between its
+    two tiles, and a `TileConfiguration` is optimized until the error
+    converges. Each group of linked tiles is laid out along a spanning tree of
+    the links first and the first tile of the group is fixed. Every group
+    keeps its mean initial position, tiles without links stay where they are.
+
+    Parameters
+    ----------
+    initial : list of list of float
+        The initial x, y, z position of each tile
+    links : list of dict
+        The measured links, each with the `pair` of tile indices (i, j) and the
+        `shift` of j relative to i
+
+    Returns
+    -------
+    list of list of float
+        The solved x, y, z position of each tile
+    """
+
+    positions = [list(position) for position in initial]
+    neighbours = [[] for _ in positions]
+    for link in links:
+        first, second = link["pair"]
+        neighbours[second].append((first, link["shift"], 1))
+        neighbours[first].append((second, link["shift"], -1))
+
+    groups = [
+        group
+        for group in find_connected_tiles(
+            len(positions), [link["pair"] for link in links]
+        )
+        if len(group) > 1
+    ]
+    for group in groups:
+        placed = set([group[0]])
+        queue = [group[0]]
+        while queue:
+            current = queue.pop(0)
+            for other, shift, sign in neighbours[current]:
+                if other in placed:
+                    continue
+                positions[other] = [
+                    positions[current][axis] - sign * shift[axis] for axis in range(3)
+                ]
+                placed.add(other)
+                queue.append(other)
+    if not groups:
+        return positions
+
+    tiles = []
+    for position in positions:
+        model = TranslationModel3D()
+        model.set(*position)
+        tiles.append(Tile(model))
+    for link in links:
+        # the origin of tile i matches the point at -shift in tile j
+        matches = ArrayList()
+        matches.add(
+            PointMatch(
+                Point(jarray.array([0.0, 0.0, 0.0], "d")),
+                Point(jarray.array([-value for value in link["shift"]], "d")),
+            )
+        )
+        tiles[link["pair"][0]].connect(tiles[link["pair"][1]], matches)
+
+    configuration = TileConfiguration()
+    for group in groups:
+        for index in group:
+            configuration.addTile(tiles[index])
+        configuration.fixTile(tiles[group[0]])
+    for tile in tiles:
+        tile.apply()
+    configuration.optimize(
+        OPTIMIZER_MAX_ERROR, OPTIMIZER_MAX_ITERATIONS, OPTIMIZER_MAX_PLATEAU
+    )
+
+    for group in groups:
+        for index in group:
+            positions[index] = list(
+                tiles[index].getModel().apply(jarray.array([0.0, 0.0, 0.0], "d"))
+            )
+        shift = [
+            sum([initial[index][axis] - positions[index][axis] for index in group])
+            / len(group)
+            for axis in range(3)
+        ]
+        for index in group:
+            positions[index] = [
+                positions[index][axis] + shift[axis] for axis in range(3)
+            ]
+
+    return positions
+
+
+def prune_links(initial, links):
+    """Solve the tile positions, removing links that don't agree with the others
+
+    Follows the global optimization of the Grid/Collection stitcher: as long
+    as the worst link is off by more than `MAX_AVG_DISPLACEMENT` times the
+    average error and by more than `ABSOLUTE_DISPLACEMENT` px, or the average
+    error itself is above `ABSOLUTE_DISPLACEMENT` px, the worst link is
+    removed and the positions are solved again.
+
+    Parameters
+    ----------
+    initial : list of list of float
+        The initial x, y, z position of each tile
+    links : list of dict
+        The measured links, see `solve_tile_positions`, the removed ones are
+        taken out of the list
+
+    Returns
+    -------
+    tuple of (list of list of float, int)
+        The solved positions and the number of links removed
+    """
+
+    removed = 0
+    while True:
+        positions = solve_tile_positions(initial, links)
+        if not links:
+            break
+        errors = [
+            math.sqrt(
+                sum(
+                    [
+                        (
+                            positions[link["pair"][1]][axis]
+                            - positions[link["pair"][0]][axis]
+                            - link["shift"][axis]
+                        )
+                        ** 2
+                        for axis in range(3)
+                    ]
+                )
+            )
+            for link in links
+        ]
+        worst = errors.index(max(errors))
+        average = sum(errors) / len(errors)
+        if not (
+            (
+                errors[worst] > MAX_AVG_DISPLACEMENT * average
+                and errors[worst] > ABSOLUTE_DISPLACEMENT
+            )
+            or average > ABSOLUTE_DISPLACEMENT
+        ):
+            break
+        links.pop(worst)
+        removed += 1
+
+    return positions, removed
+
+
+def register_coarse_to_fine(
+    tiles, tile_size, dimensionality, reg_threshold, registered_path
+):
+    """Register tiles on binned projections first, then refine at full resolution
+
+    For all overlapping pairs of tiles (see `find_overlapping_tiles`) the
+    shift is estimated by phase correlation of max projections binned by
+    `COARSE_REGISTRATION_BINNING`. It is then refined at full resolution, only
+    reading the predicted overlap plus `REFINE_MARGIN` of both tiles (all
+    z-planes for 3D stacks). Links correlating less than the regression
+    threshold are dropped and the global optimization removes the links that
+    don't agree with the others, see `prune_links`.
+
+    Parameters
+    ----------
+    tiles : list of dict
+        The tiles with their initial positions, see `read_tileconfig`
+    tile_size : tuple
+        The x, y, z size of the tiles in px
+    dimensionality : int
+        Number of dimensions (2D or 3D)
+    reg_threshold : float
+        Regression threshold, minimal cross correlation of a link
+    registered_path : str
+        Path of the TileConfiguration.registered.txt to write
+
+    Returns
+    -------
+    dict
+        Number of overlapping pairs, links used and links removed by the
+        global optimization and the bytes read
+    """
+
+    initial = [
+        [tile["x"], tile["y"], tile["z"] if dimensionality == 3 else 0.0]
+        for tile in tiles
+    ]
+    pairs = find_overlapping_tiles(initial, tile_size)
+
+    coarse = {}
+    bytes_read = 0
+    for index in sorted(set([i for pair in pairs for i in pair])):
+        plane, scale, plane_bytes = read_preview_plane(
+            tiles[index]["path"],
+            tiles[index]["series"] or 0,
+            COARSE_REGISTRATION_BINNING,
+        )
+        coarse[index] = (ImagePlus("coarse_%i" % index, plane), scale)
+        bytes_read += plane_bytes
+
+    tile_reader = TileReader()
+    links = []
+    try:
+        for first, second in pairs:
+            offset, correlation = measure_shift(coarse[first][0], coarse[second][0], 2)
+            scale = coarse[first][1]
+            shift = [
+                offset[0] * scale,
+                offset[1] * scale,
+                initial[second][2] - initial[first][2],
+            ]
+            refined = measure_refined_shift(
+                tile_reader,
+                tiles,
+                (first, second),
+                shift,
+                tile_size,
+                REFINE_MARGIN,
+                dimensionality,
+            )
+            if refined:
+                shift, correlation = refined
+            if correlation >= reg_threshold:
+                links.append(
+                    {
+                        "pair": (first, second),
+                        "shift": shift,
+                        "correlation": correlation,
+                    }
+                )
+    finally:
+        bytes_read += tile_reader.bytes_read
+        tile_reader.close()
+
+    positions, removed = prune_links(initial, links)
+
+    registered = []
+    for tile, position in zip(tiles, positions):
+        registered.append(dict(tile, x=position[0], y=position[1], z=position[2]))
+    write_tile_positions(registered_path, dimensionality, registered)
+
+    IJ.log(
+        "coarse-to-fine registration: %i overlapping pairs, %i links used, "
+        "%i removed by the global optimization" % (len(pairs), len(links), removed)
+    )
+
+    return {
+        "pairs": len(pairs),
+        "links": len(links),
+        "removed": removed,
+        "bytes_read": bytes_read,
+    }
+
+
+def register_overlapping_tiles(
+    tiles, pairs, tile_size, dimensionality, reg_threshold, registered_path
+):
+    """Register the overlapping pairs of tiles and optimize their positions
+
+    Like the Grid/Collection stitcher, the shift of a pair is measured by
+    phase correlation of the overlap predicted by the stage positions, but
+    only for the pairs found by `find_overlapping_tiles` instead of all pairs
+    of tiles. Links correlating less than the regression threshold are
+    dropped and the global optimization removes the links that don't agree
+    with the others, see `prune_links`. Every group of connected tiles keeps
+    its mean stage position.
+
+    Parameters
+    ----------
+    tiles : list of dict
+        The tiles with their stage positions, see `get_stage_tiles`
+    pairs : list of tuple
+        Pairs of overlapping tiles, see `find_overlapping_tiles`
+    tile_size : tuple
+        The x, y, z size of the tiles in px
+    dimensionality : int
+        Number of dimensions (2D or 3D)
+    reg_threshold : float
+        Regression threshold, minimal cross correlation of a link
+    registered_path : str
+        Path of the TileConfiguration.registered.txt to write
+
+    Returns
+    -------
+    dict
+        Number of links used and links removed by the global optimization and
+        the bytes read
+    """
+
+    initial = [
+        [tile["x"], tile["y"], tile["z"] if dimensionality == 3 else 0.0]
+        for tile in tiles
+    ]
+
+    tile_reader = TileReader()
+    links = []
+    try:
+        for first, second in pairs:
+            stage_shift = [
+                initial[second][axis] - initial[first][axis] for axis in range(3)
+            ]
+            measured = measure_refined_shift(
+                tile_reader,
+                tiles,
+                (first, second),
+                stage_shift,
+                tile_size,
+                0,
+                dimensionality,
+            )
+            if measured and measured[1] >= reg_threshold:
+                links.append(
+                    {
+                        "pair": (first, second),
+                        "shift": measured[0],
+                        "correlation": measured[1],
+                    }
+                )
+    finally:
+        bytes_read = tile_reader.bytes_read
+        tile_reader.close()
+
+    positions, removed = prune_links(initial, links)
+
+    registered = []
+    for tile, position in zip(tiles, positions):
+        registered.append(dict(tile, x=position[0], y=position[1], z=position[2]))
+    write_tile_positions(registered_path, dimensionality, registered)
+
+    IJ.log(
+        "pairwise registration: %i overlapping pairs, %i links used, "
+        "%i removed by the global optimization" % (len(pairs), len(links), removed)
+    )
+
+    return {"links": len(links), "removed": removed, "bytes_read": bytes_read}
+
+
+def stitch_preview(
+    source_dir, filetype, quick, reg_threshold, binning, series_file=None
+):
+    """Register and fuse a low-resolution preview of a mosaic
+
+    Max projections of the tiles are read at a reduced resolution (see
+    `read_preview_plane`) and stitched with the Grid/Collection stitcher in a
+    temporary folder. The fused preview is saved next to the tiles together
+    with the registered positions scaled up to the full resolution, which can
+    be used as the starting point of the full-resolution run. As the preview
+    is a projection, the z positions are kept from the stage.
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    filetype : str
+        Extension of the tiles, including the leading dot
+    quick : bool
+        Only use the stage coordinates, skip the registration
+    reg_threshold : float
+        Regression threshold for the registration
+    binning : int
+        Downscaling factor of the preview
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    dict
+        Summary of the preview, with the same keys as the one returned by
+        `stitch_directory`
+    """
+
+    start_time = time.time()
+    IJ.log("Now previewing " + (series_file or source_dir))
+    profiler = StageProfiler()
+
+    with profiler.stage("metadata"):
+        all_images = get_job_images(source_dir, filetype, series_file)
+        stage_metadata = get_stage_coords_cached(source_dir, all_images)
+
+    tiles = get_stage_tiles(all_images, stage_metadata, series_file)
+
+    preview_dir = os.path.join(source_dir, PREVIEW_DIR, "")
+    if os.path.exists(preview_dir):
+        shutil.rmtree(preview_dir)
+    os.makedirs(preview_dir)
+
+    with profiler.stage("preview_read") as stage:
+        preview_tiles = []
+        for index, tile in enumerate(tiles):
+            plane, scale, bytes_read = read_preview_plane(
+                tile["path"], tile["series"] or 0, binning
+            )
+            stage["bytes_read"] += bytes_read
+            preview_path = os.path.join(preview_dir, "tile_%04i.tif" % index)
+            IJ.saveAs(ImagePlus("tile_%04i" % index, plane), "Tiff", preview_path)
+            preview_tiles.append(
+                {
+                    "path": preview_path,
+                    "series": None,
+                    "x": tile["x"] / scale,
+                    "y": tile["y"] / scale,
+                    "z": 0.0,
+                    "scale": scale,
+                }
+            )
+        write_tile_positions(
+            os.path.join(preview_dir, "TileConfiguration.txt"), 2, preview_tiles
+        )
+
+    with profiler.stage("registration+fusion") as stage:
+        run_GC_stitcher(preview_dir, "Linear Blending", False, quick, reg_threshold)
+        imp = wm.getCurrentImage()
+        preview_path = os.path.join(
+            source_dir, all_images[0].replace(filetype, "_preview.tif")
+        )
+        IJ.log("now saving: " + preview_path)
+        IJ.saveAs(imp, "Tiff", preview_path)
+        imp.close()
+        stage["bytes_written"] = get_files_size([preview_path])
+
+    outputs = [preview_path]
+    registered_path = os.path.join(preview_dir, "TileConfiguration.registered.txt")
+    if not quick and os.path.isfile(registered_path):
+        # the stitcher keeps the tile names, map them back to the originals
+        registered = {}
+        for tile in read_tileconfig(registered_path, preview_dir):
+            registered[os.path.basename(tile["path"])] = tile
+        # the actual downscaling can differ between tiles (e.g. pyramid levels
+        # of different sizes), so every tile is scaled up by its own factor
+        for index, tile in enumerate(tiles):
+            preview_tile = registered["tile_%04i.tif" % index]
+            scale = preview_tiles[index]["scale"]
+            tile["x"] = preview_tile["x"] * scale
+            tile["y"] = preview_tile["y"] * scale
+        predicted_path = os.path.join(
+            source_dir,
+            get_tileconfig_name(series_file).replace(".txt", ".preview.registered.txt"),
+        )
+        write_tile_positions(predicted_path, stage_metadata.dimensions, tiles)
+        IJ.log("predicted registered positions saved to " + predicted_path)
+        outputs.append(predicted_path)
+
+    shutil.rmtree(preview_dir, ignore_errors=True)
+
+    return {
+        "source_dir": source_dir,
+        "series_file": series_file,
+        "status": "done",
+        "output": preview_path,
+        "outputs": outputs,
+        "bigdata": False,
+        "duration": time.time() - start_time,
+        "conversion": None,
+        "stages": profiler.stages,
+    }
+
+
+def stitch_directory(
+    source_dir,
+    filetype,
+    fusion_method,
+    quick,
+    bdv,
+    bigdata,
+    reg_threshold,
+    convert_to_ims,
+    only_register,
+    series_file=None,
+    conversion_queue=None,
+    preview_positions=False,
+    coarse_to_fine=False,
+    ome_zarr=False,
+):
+    """Run the whole stitching chain on the images of a single directory
+
+    The stage coordinates are read from the metadata and written to a
+    TileConfiguration.txt, the tiles are stitched with the Grid/Collection
+    stitcher and the fused result is saved (and converted to Imaris if
+    requested, in the background if a conversion queue is given).
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles to stitch
+    filetype : str
+        Extension of the tiles, including the leading dot
+    fusion_method : str
+        Fusion method to use
+    quick : bool
+        Only use the stage coordinates, skip the registration
+    bdv : bool
+        Save the result as BigDataViewer hdf5 instead of ICS
+    bigdata : bool
+        Use the slower mode requiring less RAM
+    reg_threshold : float
+        Regression threshold for the registration
+    convert_to_ims : bool
+        Convert the fused image to Imaris5
+    only_register : bool
+        Only write the TileConfiguration.registered.txt
+    series_file : str, optional
+        Full path to a multi-series file to stitch on its own, its outputs
+        being named after it, by default None (stitch all files of the
+        directory together)
+    conversion_queue : ImarisConversionQueue, optional
+        Queue for the Imaris conversion, by default None (convert right away)
+    preview_positions : bool, optional
+        Start from the positions registered by `stitch_preview` instead of the
+        stage coordinates if they are available, by default False
+    coarse_to_fine : bool, optional
+        Register the tiles with `register_coarse_to_fine` instead of the
+        Grid/Collection stitcher, by default False
+    ome_zarr : bool, optional
+        Save the result as OME-Zarr instead of ICS or hdf5, by default False
+
+    Returns
+    -------
+    dict
+        Summary of the folder: the source directory, the multi-series file
+        (None if the whole directory was stitched), the path to the fused
+        image (None if no image was saved), all files produced, whether the
+        BigData mode was used, the processing time in seconds, the Imaris
+        conversion job (None if no conversion was done) and the measurements
+        of each stage, see `StageProfiler`
+    """
+
+    start_time = time.time()
+    IJ.log("Now working on " + source_dir)
+    print("bigdata= ", str(bigdata))
+    profiler = StageProfiler()
+
+    with profiler.stage("metadata"):
+        all_images = get_job_images(source_dir, filetype, series_file)
+        ome_stage_metadata = get_stage_coords_cached(source_dir, all_images)
+        geometry = get_tile_geometry(all_images[0])
+        plan = plan_stitching_memory(ome_stage_metadata, geometry)
+
+    free_memory_bytes = MemoryTools().totalAvailableMemory()
+    if not bigdata and choose_stitching_mode(plan, free_memory_bytes) == "BigData":
+        bigdata = True
+        IJ.log(
+            "Not enough free RAM (%.1f GB predicted, %.1f GB available), "
+            "switching to BigData mode (slow)"
+            % (plan["ram_peak"] / 1024.0**3, free_memory_bytes / 1024.0**3)
+        )
+
+    # multi-series files are read with the positions from their metadata, the
+    # stitcher writes their TileConfiguration itself
+    tileconfig_name = get_tileconfig_name(series_file)
+    registered_name = tileconfig_name.replace(".txt", ".registered.txt")
+    preview_tileconfig = os.path.join(
+        source_dir, tileconfig_name.replace(".txt", ".preview.registered.txt")
+    )
+    from_preview = preview_positions and os.path.isfile(preview_tileconfig)
+    if from_preview or not series_file:
+        with profiler.stage("tileconfig") as stage:
+            if from_preview:
+                IJ.log("starting from the preview positions: " + preview_tileconfig)
+                shutil.copyfile(
+                    preview_tileconfig, os.path.join(source_dir, tileconfig_name)
+                )
+            else:
+                write_tileconfig(
+                    source_dir,
+                    ome_stage_metadata.dimensions,
+                    ome_stage_metadata.series_names,
+                    ome_stage_metadata.relative_coordinates_x,
+                    ome_stage_metadata.relative_coordinates_y,
+                    ome_stage_metadata.relative_coordinates_z,
+                )
+            stage["bytes_written"] = get_files_size(
+                [os.path.join(source_dir, tileconfig_name)]
+            )
+
+    # only the overlapping pairs of tiles are registered
+    pairs = None
+    if not quick and not series_file and not from_preview and not coarse_to_fine:
+        positions, tile_size = get_tile_boxes(ome_stage_metadata, geometry)
+        pairs = find_overlapping_tiles(positions, tile_size)
+        all_pairs = len(positions) * (len(positions) - 1) / 2
+        IJ.log(
+            "overlap graph: registering %i of %i possible tile pairs (-%.1f%%), "
+            "%i group(s) of connected tiles"
+            % (
+                len(pairs),
+                all_pairs,
+                100.0 * (all_pairs - len(pairs)) / max(all_pairs, 1),
+                len(find_connected_tiles(len(positions), pairs)),
+            )
+        )
+
+    # in BigData mode the stitcher writes the fused planes to a folder, from
+    # where they are written to the output file
+    plane_dir = None
+    if bigdata and not only_register:
+        plane_dir = os.path.join(
+            source_dir, all_images[0].replace(filetype, "_fused_planes")
+        )
+        if os.path.exists(plane_dir):
+            shutil.rmtree(plane_dir)  # left over from an interrupted run
+        os.makedirs(plane_dir)
+
+    # the stitcher reads all tiles for the registration and again for fusing
+    tiles_size = get_files_size(all_images)
+    if coarse_to_fine and not quick:
+        if from_preview:
+            tiles = read_tileconfig(preview_tileconfig, source_dir)
+        else:
+            tiles = get_stage_tiles(all_images, ome_stage_metadata, series_file)
+        with profiler.stage("registration") as stage:
+            stage["bytes_read"] = register_coarse_to_fine(
+                tiles,
+                get_tile_boxes(ome_stage_metadata, geometry)[1],
+                ome_stage_metadata.dimensions,
+                reg_threshold,
+                os.path.join(source_dir, registered_name),
+            )["bytes_read"]
+    elif pairs is not None:
+        with profiler.stage("registration") as stage:
+            stage["bytes_read"] = register_overlapping_tiles(
+                get_stage_tiles(all_images, ome_stage_metadata),
+                pairs,
+                tile_size,
+                ome_stage_metadata.dimensions,
+                reg_threshold,
+                os.path.join(source_dir, registered_name),
+            )["bytes_read"]
+    else:
+        # the stitcher registers and fuses in one go
+        stage_name = "registration" if only_register else "registration+fusion"
+        with profiler.stage(stage_name) as stage:
+            run_GC_stitcher(
+                source_dir if from_preview else series_file or source_dir,
+                REGISTER_ONLY if only_register else fusion_method,
+                bigdata,
+                quick,
+                reg_threshold,
+                tileconfig_name,
+                plane_dir,
+            )
+            stage["bytes_read"] = tiles_size * (1 if only_register else 2)
+            stage["bytes_estimated"] = True
+
+    registered_here = (coarse_to_fine and not quick) or pairs is not None
+    if registered_here and not only_register:
+        with profiler.stage("fusion") as stage:
+            run_GC_stitcher(
+                source_dir,
+                fusion_method,
+                bigdata,
+                True,
+                reg_threshold,
+                registered_name,
+                plane_dir,
+            )
+            stage["bytes_read"] = tiles_size
+            stage["bytes_estimated"] = True
+
+    path_to_image = None
+
+    if bigdata and not only_register:
+        suffix = "_stitched.ome.zarr" if ome_zarr else "_stitched.xml"
+        path_to_image = os.path.join(
+            source_dir, all_images[0].replace(filetype, suffix)
+        )
+        IJ.log("now saving: " + str(path_to_image))
+        if ome_zarr:
+            write_planes = write_gc_planes_to_ome_zarr
+        else:
+            write_planes = write_gc_planes_to_bdv
+        with profiler.stage("export") as stage:
+            stage.update(
+                write_planes(
+                    plane_dir,
+                    path_to_image,
+                    ome_stage_metadata.image_calibration,
+                    ome_stage_metadata.calibration_unit,
+                )
+            )
+        shutil.rmtree(plane_dir, ignore_errors=True)
+
+    if not bigdata and not only_register:
+        with profiler.stage("calibration"):
+            calibrate_current_image(
+                ome_stage_metadata.image_calibration,
+                ome_stage_metadata.calibration_unit,
+            )
+        with profiler.stage("export") as stage:
+            if ome_zarr:
+                path_to_image = save_current_image_as_ome_zarr(
+                    all_images[0],
+                    filetype,
+                    source_dir,
+                    ome_stage_metadata.image_calibration,
+                    ome_stage_metadata.calibration_unit,
+                )
+            elif bdv:
+                path_to_image = save_current_image_as_bdv(
+                    all_images[0], filetype, source_dir
+                )
+            else:
+                path_to_image = save_current_image_with_BF_as_ics1(
+                    all_images[0], filetype, source_dir
+                )
+            stage["bytes_written"] = get_files_size(
+                get_output_files(path_to_image, False)
+            )
+
+    conversion = None
+    if convert_to_ims and ome_zarr and path_to_image:
+        IJ.log("OME-Zarr output is not converted to Imaris")
+    elif convert_to_ims and path_to_image:
+        conversion = create_conversion_job(
+            path_to_image, get_manifest_key(source_dir, series_file)
+        )
+        if conversion_queue:
+            conversion_queue.submit(conversion)
+        else:
+            run_imarisconvert(conversion)
+
+    if only_register:
+        outputs = [os.path.join(source_dir, registered_name)]
+    else:
+        outputs = get_output_files(path_to_image, convert_to_ims)
+
+    return {
+        "source_dir": source_dir,
+        "series_file": series_file,
+        "status": "done",
+        "output": path_to_image,
+        "outputs": outputs,
+        "bigdata": bigdata,
+        "duration": time.time() - start_time,
+        "conversion": conversion,
+        "stages": profiler.stages,
+    }
+
+
+def get_worker_launcher(job_dir):
+    """Get what is needed to run this script in separate Fiji processes
+
+    The script is run from the jar of the update site, which the `--run`
+    option of the launcher can't use, so it is extracted from there into the
+    job directory.
+
+    Parameters
+    ----------
+    job_dir : str
+        Directory for the files of the workers, created if missing
+
+    Returns
+    -------
+    tuple of (str, str) or None
+        Path to the Fiji launcher and to the extracted script, None if either
+        of them can't be found
+    """
+
+    fiji_executable = get_fiji_executable()
+    if not fiji_executable:
+        IJ.log("WARNING: can't determine the Fiji launcher of this instance")
+        return None
+
+    stream = IJ.getClassLoader().getResourceAsStream(SCRIPT_RESOURCE)
+    if stream is None:
+        IJ.log("WARNING: can't find %s in the installed jars" % SCRIPT_RESOURCE)
+        return None
+    if not os.path.exists(job_dir):
+        os.makedirs(job_dir)
+    script_path = os.path.join(job_dir, os.path.basename(SCRIPT_RESOURCE))
+    try:
+        Files.copy(stream, Paths.get(script_path), StandardCopyOption.REPLACE_EXISTING)
+    finally:
+        stream.close()
+
+    return fiji_executable, script_path
+
+
+def predict_memory_footprint(source_dir, filetype, series_file=None):
+    """Predict the heap a worker needs to stitch the images of a folder
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory containing the tiles
+    filetype : str
+        Extension of the tiles, including the leading dot
+    series_file : str, optional
+        Full path to a multi-series file stitched on its own, by default None
+
+    Returns
+    -------
+    long
+        Predicted memory footprint in bytes
+    """
+
+    plan = plan_directory(source_dir, filetype, series_file)
+
+    return plan["ram_peak"] + FIJI_BASE_HEAP_BYTES
+
+
+def format_worker_params(params):
+    """Format script parameters for the `--run` command line option
+
+    Parameters
+    ----------
+    params : dict
+        Script parameters and their values
+
+    Returns
+    -------
+    str
+        Comma-separated list of key=value pairs, strings being quoted
+    """
+
+    formatted = []
+    for key in sorted(params):
+        value = params[key]
+        if isinstance(value, bool):
+            value = str(value).lower()
+        elif isinstance(value, basestring):
+            # backslashes would be read as escape characters, quotes would end
+            # the string
+            value = "'" + value.replace("\\", "/").replace("'", "\\'") + "'"
+        formatted.append("%s=%s" % (key, value))
+
+    return ",".join(formatted)
+
+
+def start_worker(fiji_executable, script_path, params, heap_bytes, log_path):
+    """Launch a headless Fiji process running this script on a single folder
+
+    Parameters
+    ----------
+    fiji_executable : str
+        Path to the Fiji launcher
+    script_path : str
+        Path of the script to run
+    params : dict
+        Script parameters for the worker
+    heap_bytes : long
+        Maximum heap size for the worker
+    log_path : str
+        File to which the output of the worker will be written
+
+    Returns
+    -------
+    tuple of (subprocess.Popen, file)
+        The worker process and the handle to its log file
+    """
+
+    return start_fiji(
+        fiji_executable,
+        heap_bytes,
+        ["--run", script_path, format_worker_params(params)],
+        log_path,
+    )
+
+
+def collect_worker_result(job, exit_code):
+    """Gather the result of a finished worker process
+
+    Parameters
+    ----------
+    job : dict
+        The job description, including the path to the worker's result file
+    exit_code : int
+        Exit code of the worker process
+
+    Returns
+    -------
+    dict
+        Summary of the folder as returned by `stitch_directory`, with an
+        additional exit code and the path to the worker's log. The status is
+        set to "failed" if the worker didn't write a result.
+    """
+
+    result = {
+        "source_dir": job["source_dir"],
+        "series_file": job["series_file"],
+        "status": "failed",
+        "output": None,
+        "outputs": [],
+        "bigdata": None,
+        "duration": time.time() - job["start_time"],
+        "conversion": None,
+    }
+    if os.path.isfile(job["result_path"]):
+        with open(job["result_path"], "r") as result_file:
+            result.update(json.load(result_file)[0])
+    # the worker gets the paths with normalized separators, keep the original
+    # ones identifying the job
+    result["source_dir"] = job["source_dir"]
+    result["series_file"] = job["series_file"]
+    result["exit_code"] = exit_code
+    result["log"] = job["log_path"]
+
+    return result
+
+
+def run_worker_pool(
+    jobs,
+    n_workers,
+    ram_budget,
+    worker_params,
+    job_dir,
+    launcher,
+    on_start=None,
+    on_result=None,
+):
+    """Stitch folders concurrently using several headless Fiji processes
+
+    Jobs are dispatched as long as the number of running workers is below
+    `n_workers` and the sum of their predicted memory footprints stays within
+    the RAM budget. A job larger than the budget is only started when no
+    other worker is running.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        Directory and multi-series file (None to stitch the whole directory)
+        of each job
+    n_workers : int
+        Maximum number of concurrent worker processes
+    ram_budget : long
+        RAM available for all workers together, in bytes
+    worker_params : dict
+        Script parameters shared by all workers
+    job_dir : str
+        Directory for the log and result files of the workers
+    launcher : tuple of (str, str)
+        Fiji launcher and script path, as returned by `get_worker_launcher`
+    on_start : callable, optional
+        Called with the directory and the multi-series file whenever a worker
+        is started, by default None
+    on_result : callable, optional
+        Called with the summary of each folder as soon as its worker has
+        finished, by default None
+
+    Returns
+    -------
+    list of dict
+        Summary of each job, in the order of `jobs`
+    """
+
+    fiji_executable, script_path = launcher
+
+    if not os.path.exists(job_dir):
+        os.makedirs(job_dir)
+
+    worker_jobs = []
+    for job_index, (source_dir, series_file) in enumerate(jobs):
+        footprint = predict_memory_footprint(
+            source_dir, worker_params["filetype"], series_file
+        )
+        worker_jobs.append(
+            {
+                "index": job_index,
+                "source_dir": source_dir,
+                "series_file": series_file,
+                "name": series_file or source_dir,
+                "footprint": footprint,
+                "heap": get_worker_heap(footprint, ram_budget),
+                "log_path": os.path.join(job_dir, "job_%03i.log" % job_index),
+                "result_path": os.path.join(job_dir, "job_%03i.json" % job_index),
+            }
+        )
+
+    results = []
+
+    def start(job):
+        """Launch the worker stitching the folder of a job"""
+        params = dict(worker_params)
+        params["source"] = job["source_dir"]
+        params["series_file"] = job["series_file"] or ""
+        params["worker_job"] = job["result_path"]
+        if on_start:
+            on_start(job["source_dir"], job["series_file"])
+        if os.path.isfile(job["result_path"]):
+            os.remove(job["result_path"])
+        IJ.log("worker started (%.1f GB): %s" % (job["heap"] / 1024.0**3, job["name"]))
+
+        return start_worker(
+            fiji_executable, script_path, params, job["heap"], job["log_path"]
+        )
+
+    def on_finished(job, exit_code):
+        """Collect the summary of the folder of a finished worker"""
+        result = collect_worker_result(job, exit_code)
+        result["index"] = job["index"]
+        results.append(result)
+        if on_result:
+            on_result(result)
+        IJ.log("worker finished [%s]: %s" % (result["status"], job["name"]))
+
+    run_workers(worker_jobs, n_workers, ram_budget, start, on_finished)
+    results.sort(key=lambda result: result["index"])
+
+    return results
+
+
+# ─── Main Code ────────────────────────────────────────────────────────────────
+
+if __name__ == "__main__":
+    IJ.log("\\Clear")
+    IJ.log("Script starting")
+
+    # start the process
+    execution_start_time = time.time()
+
+    if not filetype.startswith("."):
+        filetype = "." + filetype
+
+    # In case script is ran batch
+    source_info = pathtools.parse_path(source)
+    source = source_info["full"]
+    # source = fix_ij_dirs(source)
+    if worker_job:
+        # spawned by another instance to take care of this single folder, the
+        # subfolders are dispatched separately
+        Interpreter.batchMode = True
+        all_source_dirs = [os.path.join(source, "")]
+    else:
+        all_source_dirs = pathtools.find_dirs_containing_filetype(source, filetype)
+
+    if only_register:
+        fusion_method = REGISTER_ONLY
+        IJ.log(
+            "The output will only be the txt file containing registered positions for the tiles."
+        )
+        IJ.log("As such, no HDF5 resaving or Imaris conversion will be happening.")
+    else:
+        fusion_method = "Linear Blending"
+
+    # one job per directory, or per multi-series file if they are stitched
+    # individually, each directory being listed only once
+    all_jobs = []
+    for source_dir in all_source_dirs:
+        if worker_job and series_file:
+            all_jobs.append((source_dir, series_file, [series_file]))
+            continue
+        all_images = pathtools.listdir_matching(
+            source_dir, filetype, fullpath=True, sort=True
+        )
+        if individual_series:
+            all_jobs += [(source_dir, image, [image]) for image in all_images]
+        else:
+            all_jobs.append((source_dir, None, all_images))
+
+    run_params = {
+        "filetype": filetype,
+        "quick": quick,
+        "bdv": bdv,
+        "reg_threshold": reg_threshold,
+        "bigdata": bigdata,
+        "convert_to_ims": convert_to_ims,
+        "individual_series": individual_series,
+        "only_register": only_register,
+        "use_preview_positions": use_preview_positions,
+        "coarse_to_fine": coarse_to_fine,
+        "ome_zarr": ome_zarr,
+    }
+    folder_results = []
+    if plan_only:
+        report_memory_plans(
+            [(source_dir, job_file) for source_dir, job_file, _ in all_jobs],
+            filetype,
+            MemoryTools().totalAvailableMemory(),
+            os.path.join(source, MEMORY_PLAN_FILE),
+        )
+        all_jobs = []
+
+    if preview:
+        # previews are quick and not tracked in the manifest
+        for source_dir, job_file, _ in all_jobs:
+            folder_results.append(
+                stitch_preview(
+                    source_dir,
+                    filetype,
+                    quick,
+                    reg_threshold,
+                    preview_binning,
+                    job_file,
+                )
+            )
+            reclaim_memory(gc_target_pct / 100.0, gc_timeout)
+        all_jobs = []
+
+    manifest_path = os.path.join(source, STITCH_MANIFEST)
+    manifest = {} if worker_job else load_manifest(manifest_path)
+
+    # skip everything finished by a previous run with the same inputs and
+    # parameters, clean up what a previous run left unfinished
+    jobs = []
+    for source_dir, job_file, images in all_jobs:
+        job_name = job_file or source_dir
+        key = get_manifest_key(source_dir, job_file)
+        fingerprint = get_files_fingerprint(images)
+        entry = manifest.get(key)
+        if is_up_to_date(entry, fingerprint, run_params):
+            IJ.log("Skipping up-to-date job: " + job_name)
+            folder_results.append(
+                {
+                    "source_dir": source_dir,
+                    "series_file": job_file,
+                    "status": "skipped",
+                    "output": entry["outputs"][0] if entry["outputs"] else None,
+                    "outputs": entry["outputs"],
+                    "bigdata": None,
+                    "duration": 0.0,
+                    "conversion": None,
+                }
+            )
+            continue
+        if entry and entry["status"] != "done":
+            IJ.log("Cleaning up unfinished job: " + job_name)
+            remove_outputs(entry["outputs"], entry.get("started"))
+        manifest[key] = {
+            "status": "pending",
+            "fingerprint": fingerprint,
+            "params": run_params,
+            "outputs": get_expected_outputs(
+                source_dir, images[0], filetype, run_params, job_file
+            ),
+        }
+        jobs.append((source_dir, job_file))
+
+    # the manifest is also updated from the Imaris conversion thread
+    manifest_lock = threading.Lock()
+
+    def record_start(source_dir, job_file=None):
+        """Mark a folder as being processed in the manifest"""
+        if worker_job:
+            return
+        with manifest_lock:
+            key = get_manifest_key(source_dir, job_file)
+            manifest[key]["status"] = "running"
+            manifest[key]["started"] = time.time()
+            write_json_atomically(manifest_path, manifest)
+
+    def record_result(result):
+        """Store the outcome of a folder in the manifest"""
+        if worker_job:
+            return
+        with manifest_lock:
+            key = get_manifest_key(result["source_dir"], result["series_file"])
+            entry = manifest[key]
+            entry["status"] = result["status"]
+            if result["status"] == "done":
+                entry["outputs"] = result["outputs"]
+                entry["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            conversion = result.get("conversion")
+            if conversion:
+                # the folder is only complete once its .ims has been written
+                entry["conversion"] = conversion
+                if result["status"] == "done" and conversion["status"] != "done":
+                    entry["status"] = (
+                        "failed" if conversion["status"] == "failed" else "converting"
+                    )
+            write_json_atomically(manifest_path, manifest)
+
+    stage_log_path = os.path.join(source, STAGE_LOG)
+    # folders logged while their conversion was still running
+    unlogged_conversions = {}
+
+    def record_stages(result):
+        """Append the stage measurements of a finished folder to the log"""
+        if worker_job or "stages" not in result:
+            return
+        with manifest_lock:
+            stages = list(result["stages"])
+            conversion = result.get("conversion")
+            if conversion and conversion["status"] in ["done", "failed"]:
+                stages.append(get_conversion_stage(conversion))
+            elif conversion:
+                unlogged_conversions[id(conversion)] = result
+            append_stage_record(stage_log_path, execution_start_time, result, stages)
+
+    def record_conversion(job):
+        """Store the outcome of a background Imaris conversion in the manifest"""
+        if worker_job:
+            return
+        with manifest_lock:
+            result = unlogged_conversions.pop(id(job), None)
+            if result:
+                append_stage_record(
+                    stage_log_path,
+                    execution_start_time,
+                    result,
+                    [get_conversion_stage(job)],
+                )
+            entry = manifest.get(job["key"])
+            # entries not recorded yet pick up the status in `record_result`
+            if not entry or entry.get("conversion") is not job:
+                return
+            if entry["status"] == "converting":
+                entry["status"] = job["status"]
+            write_json_atomically(manifest_path, manifest)
+
+    conversion_queue = None
+
+    launcher = None
+    worker_dir = os.path.join(source, "stitch_workers")
+    if n_workers > 1 and not worker_job:
+        launcher = get_worker_launcher(worker_dir)
+        if not launcher:
+            IJ.log(
+                "WARNING: parallel mode not available, stitching all folders "
+                + "in this instance"
+            )
+
+    def record_worker_result(result):
+        """Store the outcome of a folder stitched by a worker process"""
+        record_result(result)
+        record_stages(result)
+
+    if launcher:
+        ram_budget = ram_budget_gb * 1024**3 if ram_budget_gb else get_physical_memory()
+        IJ.log(
+            "Stitching %i jobs with up to %i workers, RAM budget %.1f GB"
+            % (len(jobs), n_workers, ram_budget / 1024.0**3)
+        )
+        worker_params = dict(run_params)
+        worker_params.update(
+            {
+                "email_address": "",
+                "gc_target_pct": gc_target_pct,
+                "gc_timeout": gc_timeout,
+                "n_workers": 1,
+                "ram_budget_gb": 0,
+                "plan_only": False,
+                "imaris_queue_depth": imaris_queue_depth,
+                "preview": False,
+                "preview_binning": preview_binning,
+            }
+        )
+        folder_results += run_worker_pool(
+            jobs,
+            n_workers,
+            ram_budget,
+            worker_params,
+            worker_dir,
+            launcher,
+            on_start=record_start,
+            on_result=record_worker_result,
+        )
+    else:
+        if convert_to_ims and not only_register:
+            conversion_queue = ImarisConversionQueue(
+                imaris_queue_depth, on_finished=record_conversion
+            )
+        for source_dir, job_file in jobs:
+            record_start(source_dir, job_file)
+            result = stitch_directory(
+                source_dir,
+                filetype,
+                fusion_method,
+                quick,
+                bdv,
+                bigdata,
+                reg_threshold,
+                convert_to_ims,
+                only_register,
+                job_file,
+                conversion_queue,
+                use_preview_positions,
+                coarse_to_fine,
+                ome_zarr,
+            )
+            record_result(result)
+            folder_results.append(result)
+
+            # close leftovers and run the garbage collector until enough RAM is
+            # available again instead of waiting a fixed amount of time
+            IJ.log("collecting garbage...")
+            profiler = StageProfiler()
+            with profiler.stage("gc"):
+                reclaim_memory(gc_target_pct / 100.0, gc_timeout)
+            result["stages"] += profiler.stages
+            record_stages(result)
+
+    if conversion_queue:
+        outstanding = conversion_queue.outstanding()
+        if outstanding:
+            IJ.log(
+                "waiting for %i outstanding Imaris conversion(s)..." % len(outstanding)
+            )
+        conversion_queue.wait()
+
+    if worker_job:
+        # the summary is done by the instance that spawned this worker
+        with open(worker_job, "w") as result_file:
+            json.dump(folder_results, result_file, indent=2)
+        IJ.log("Worker done")
+    elif plan_only:
+        # nothing was stitched, keep the stitch_log of the last real run
+        IJ.log("Planning done, nothing was stitched")
+    else:
+        total_execution_time_min = misc.elapsed_time_since(execution_start_time)
+
+        if email_address:
+            misc.send_notification_email(
+                "Stitching script", email_address, source, total_execution_time_min
+            )
+        else:
+            print("Email address field is empty, no email was sent")
+
+        # update the log
+        IJ.log("##### summary #####")
+        IJ.log("number of jobs stitched: " + str(len(jobs)))
+        IJ.log(
+            "number of up-to-date jobs skipped: "
+            + str(
+                len([1 for result in folder_results if result["status"] == "skipped"])
+            )
+        )
+        IJ.log("quick stitch by stage coordinates: " + str(quick))
+        IJ.log("save as BigDataViewer hdf5 instead: " + str(bdv))
+        IJ.log("save as OME-Zarr instead: " + str(ome_zarr))
+        IJ.log(
+            "conserve RAM= "
+            + str(bigdata or any([result["bigdata"] for result in folder_results]))
+        )
+        for result in folder_results:
+            IJ.log(
+                "%s: %s in %.0f s -> %s"
+                % (
+                    result.get("series_file") or result["source_dir"],
+                    result["status"],
+                    result["duration"],
+                    result["output"],
+                )
+            )
+            conversion = result.get("conversion")
+            if conversion:
+                IJ.log(
+                    "    Imaris conversion: %s (exit code %s) in %.0f s"
+                    % (
+                        conversion["status"],
+                        conversion["exit_code"],
+                        conversion["duration"] or 0.0,
+                    )
+                )
+        IJ.log("total time in [HH:MM:SS:ss]: " + str(total_execution_time_min))
+        IJ.log("stage measurements appended to " + stage_log_path)
+        IJ.log("All done")
+        IJ.selectWindow("Log")
+        IJ.saveAs("Text", os.path.join(source, "stitch_log"))